@@ -42,9 +42,19 @@ setup(name='XonStat',
       zip_safe=False,
       test_suite='xonstat',
       install_requires = requires,
+      extras_require = {
+          # columnar weapon snapshots (xonstat.snapshot)
+          'analytics': ['numpy'],
+      },
       entry_points = """\
       [paste.app_factory]
       main = xonstat:main
+      [console_scripts]
+      xonstat_replay_spool = xonstat.scripts.replay_spool:main
+      xonstat_rebuild_summaries = xonstat.scripts.rebuild:main
+      xonstat_backfill_nicks = xonstat.scripts.backfill_nicks:main
+      xonstat_import_games = xonstat.scripts.import_games:main
+      xonstat_snapshot_weapons = xonstat.scripts.snapshot_weapons:main
       """,
       paster_plugins=['pyramid'],
       )
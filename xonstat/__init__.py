@@ -1,86 +1,150 @@
 import pyramid_jinja2
 import sqlahelper
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
+from pyramid.events import ContextFound
+from pyramid.mako_templating import renderer_factory as mako_renderer_factory
+from pyramid.settings import asbool
+from xonstat.cache import configure_caches
+from xonstat.engine import engine_from_settings
+from xonstat.httpcache import cached_view, configure_response_cache
+from xonstat.metrics import (MetricsMiddleware, configure_metrics,
+        instrument_engine, route_found, timed_renderer)
 from xonstat.models import initialize_db
+from xonstat.ranking import configure_rankings
+from xonstat.settings import validate_settings
+from xonstat.spool import spool_from_settings, start_workers
 from xonstat.views import * 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    # setup the database engine
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    # refuse to start with settings that would fail later
+    validate_settings(settings)
+
+    # setup the pooled database engine
+    engine = engine_from_settings(settings)
     sqlahelper.add_engine(engine)
 
+    # time requests, statements and templates for /metrics
+    timed = asbool(settings.get('xonstat.metrics.enabled', True))
+    if timed:
+        configure_metrics(settings)
+        instrument_engine(engine)
+
     # initialize database structures
-    initialize_db(engine)
+    initialize_db(engine, verify=settings.get('xonstat.verify_schema',
+        'off').strip().lower())
+
+    # size the in-process caches of server, map and player ids
+    configure_caches(settings)
+    configure_response_cache(settings)
+    configure_rankings(settings)
 
     config = Configurator(settings=settings)
 
-    config.add_renderer('.jinja2', pyramid_jinja2.renderer_factory)
+    # when spooling, stats_submit only stores the submission and a pool of
+    # workers records it in the background
+    spool = spool_from_settings(settings)
+    if spool is not None:
+        config.registry.spool = spool
+        start_workers(spool=spool, settings=settings)
+
+    if timed:
+        config.add_renderer('.mako', timed_renderer(mako_renderer_factory))
+        config.add_renderer('.jinja2',
+                timed_renderer(pyramid_jinja2.renderer_factory))
+        config.add_subscriber(route_found, ContextFound)
+    else:
+        config.add_renderer('.jinja2', pyramid_jinja2.renderer_factory)
 
     config.add_static_view('static', 'xonstat:static')
 
+    # the read-only pages are served from the response cache, tagged with
+    # what a submission invalidates them by; a finished game never changes
+    def add_page(name, pattern, view, renderer, *tags, **kw):
+        config.add_route(name=name, pattern=pattern)
+        config.add_view(view=view, route_name=name, renderer=renderer,
+                decorator=cached_view(*tags, **kw))
+
     # ROOT ROUTE
-    config.add_route(name="main_index", pattern="/", view=main_index,
-            renderer='main_index.mako') 
+    add_page("main_index", "/", main_index, 'main_index.mako', 'games')
 
     # PLAYER ROUTES
-    config.add_route(name="player_game_index_default", 
-            pattern="/player/{player_id:\d+}/games", 
-            view=player_game_index, renderer='player_game_index.mako') 
+    add_page("player_game_index_default", "/player/{player_id:\d+}/games",
+            player_game_index, 'player_game_index.mako',
+            'player:{player_id}')
 
-    config.add_route(name="player_game_index", 
-            pattern="/player/{player_id:\d+}/games/page/{page:\d+}", 
-            view=player_game_index, renderer='player_game_index.mako') 
+    add_page("player_game_index",
+            "/player/{player_id:\d+}/games/page/{page:\d+}",
+            player_game_index, 'player_game_index.mako',
+            'player:{player_id}')
 
-    config.add_route(name="player_index_paged", 
-            pattern="/players/page/{page:\d+}", view=player_index, 
-            renderer='player_index.mako') 
+    add_page("player_index_paged", "/players/page/{page:\d+}", player_index,
+            'player_index.mako', 'games')
 
-    config.add_route(name="player_index", pattern="/players", view=player_index, 
-            renderer='player_index.mako') 
+    add_page("player_index", "/players", player_index, 'player_index.mako',
+            'games')
 
-    config.add_route(name="player_info", pattern="/player/{id:\d+}", view=player_info, 
-            renderer='player_info.mako') 
+    add_page("player_info", "/player/{id:\d+}", player_info,
+            'player_info.mako', 'player:{id}')
 
     # GAME ROUTES
-    config.add_route(name="game_index", pattern="/games", view=game_index, 
-            renderer='game_index.mako') 
+    add_page("game_index", "/games", game_index, 'game_index.mako', 'games')
 
-    config.add_route(name="game_index_paged", pattern="/games/page/{page:\d+}", 
-            view=game_index, renderer='game_index.mako') 
+    add_page("game_index_paged", "/games/page/{page:\d+}", game_index,
+            'game_index.mako', 'games')
 
-    config.add_route(name="game_info", pattern="/game/{id:\d+}", view=game_info, 
-            renderer='game_info.mako') 
+    add_page("game_info", "/game/{id:\d+}", game_info, 'game_info.mako',
+            immutable=True)
 
     # SERVER ROUTES
-    config.add_route(name="server_index_paged", 
-            pattern="/servers/page/{page:\d+}", view=server_index, 
-            renderer='server_index.mako') 
+    add_page("server_index_paged", "/servers/page/{page:\d+}", server_index,
+            'server_index.mako', 'games')
+
+    add_page("server_index", "/servers", server_index, 'server_index.mako',
+            'games')
 
-    config.add_route(name="server_index", pattern="/servers", view=server_index, 
-            renderer='server_index.mako') 
+    add_page("server_game_index_default", "/server/{server_id:\d+}/games",
+            server_game_index, 'server_game_index.mako',
+            'server:{server_id}')
 
-    config.add_route(name="server_game_index", 
-            pattern="/server/{server_id:\d+}/games/page/{page:\d+}", 
-            view=server_game_index, renderer='server_game_index.mako') 
+    add_page("server_game_index",
+            "/server/{server_id:\d+}/games/page/{page:\d+}",
+            server_game_index, 'server_game_index.mako',
+            'server:{server_id}')
 
-    config.add_route(name="server_info", pattern="/server/{id:\d+}", view=server_info, 
-            renderer='server_info.mako') 
+    add_page("server_info", "/server/{id:\d+}", server_info,
+            'server_info.mako', 'server:{id}')
 
     # MAP ROUTES
-    config.add_route(name="map_index_paged", 
-            pattern="/maps/page/{page:\d+}", view=map_index, 
-            renderer='map_index.mako') 
+    add_page("map_index_paged", "/maps/page/{page:\d+}", map_index,
+            'map_index.mako', 'games')
 
-    config.add_route(name="map_index", pattern="/maps", view=map_index, 
-            renderer='map_index.mako') 
+    add_page("map_index", "/maps", map_index, 'map_index.mako', 'games')
 
-    config.add_route(name="map_info", pattern="/map/{id:\d+}", view=map_info, 
-            renderer='map_info.mako') 
+    add_page("map_info", "/map/{id:\d+}", map_info, 'map_info.mako',
+            'map:{id}')
+
+    # RANKING ROUTES
+    add_page("ranking_index", "/rankings/{game_type_cd}", ranking_index,
+            'ranking_index.mako', 'games')
+
+    # EXPORT ROUTES
+    config.add_route(name="export",
+            pattern="/export/{kind:games|scoreboards|weapons}."
+                "{format:ndjson|csv}",
+            view=export)
 
     config.add_route(name="stats_submit", pattern="stats/submit", 
             view=stats_submit, renderer='index.jinja2') 
 
-    return config.make_wsgi_app()
+    config.add_route(name="db_status", pattern="stats/db", 
+            view=db_status, renderer='json') 
+
+    config.add_route(name="metrics", pattern="metrics",
+            view=prometheus_metrics)
+
+    app = config.make_wsgi_app()
+    if timed:
+        app = MetricsMiddleware(app)
+    return app
@@ -0,0 +1,185 @@
+import datetime
+import logging
+import sqlalchemy
+import sqlalchemy.sql.functions as func
+from xonstat.batch import increment_rows, insert_rows
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+# days shown on the server and map pages
+CHART_DAYS = 30
+
+
+def record_players(session=None, cls=None, key=None, day=None, value=None,
+        player_ids=None):
+    """
+    Records the players that played on a server (or map) in a day,
+    returning how many hadn't played there that day before. Players
+    recorded already, possibly by a concurrent transaction, are skipped by
+    the insert itself. Parameters:
+
+    session - SQLAlchemy database session factory
+    cls - ServerDailyPlayer or MapDailyPlayer
+    key - server_id or map_id
+    day - the day the game started
+    value - the server or map id
+    player_ids - ids of the tracked players of the game
+    """
+    if not player_ids:
+        return 0
+
+    return insert_rows(session=session, table=cls.__table__,
+            rows=[{'day_dt':day, key:value, 'player_id':player_id}
+                for player_id in player_ids],
+            keys=['day_dt', key, 'player_id'])
+
+
+def update_activity(session=None, game=None, participants=None):
+    """
+    Adds a newly recorded game to the hourly and daily activity summary
+    tables, in the same transaction. Parameters:
+
+    session - SQLAlchemy database session factory
+    game - the Game that was recorded
+    participants - list of (Player, PlayerRecord) tuples of the players
+        that have stats in the game
+    """
+    day = game.start_dt.date()
+
+    increment_rows(session=session, table=HourlyActivity.__table__,
+            keys=['hour_dt', 'server_id', 'map_id', 'game_type_cd'],
+            rows=[{'hour_dt':game.start_dt.replace(minute=0, second=0,
+                microsecond=0), 'server_id':game.server_id,
+                'map_id':game.map_id, 'game_type_cd':game.game_type_cd,
+                'games':1, 'player_games':len(participants)}])
+
+    player_ids = sorted(set(player.player_id
+        for (player, record) in participants
+        if player.player_id > LAST_SENTINEL_ID))
+
+    for (cls, player_cls, key, value) in (
+            (ServerDailyActivity, ServerDailyPlayer, 'server_id',
+                game.server_id),
+            (MapDailyActivity, MapDailyPlayer, 'map_id', game.map_id)):
+        new = record_players(session=session, cls=player_cls, key=key,
+                day=day, value=value, player_ids=player_ids)
+        increment_rows(session=session, table=cls.__table__,
+                keys=['day_dt', key], rows=[{'day_dt':day, key:value,
+                    'games':1, 'players':new}])
+
+
+def daily_activity(session=None, server_id=None, map_id=None,
+        days=CHART_DAYS, today=None):
+    """
+    Returns the activity of a server or map over its last days, oldest
+    first, as dictionaries with the day, the games started, the distinct
+    tracked players and the games started in the busiest hour. Only the
+    summary rows of those days are read. Parameters:
+
+    session - SQLAlchemy database session factory
+    server_id - the server to report on, or
+    map_id - the map to report on
+    days - number of days to report on
+    today - the last day to report on, by default the current (UTC) day
+    """
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+    first = today - datetime.timedelta(days=days - 1)
+
+    if server_id is not None:
+        (cls, column, value) = (ServerDailyActivity, HourlyActivity.server_id,
+                server_id)
+        key = ServerDailyActivity.server_id
+    else:
+        (cls, column, value) = (MapDailyActivity, HourlyActivity.map_id,
+                map_id)
+        key = MapDailyActivity.map_id
+
+    activity = {}
+    for i in range(days):
+        day = first + datetime.timedelta(days=i)
+        activity[day] = {'day':day, 'games':0, 'players':0, 'peak':0}
+
+    for row in session.query(cls.day_dt, cls.games, cls.players).\
+            filter(key == value).\
+            filter(cls.day_dt >= first).\
+            filter(cls.day_dt <= today):
+        activity[row.day_dt].update(games=row.games, players=row.players)
+
+    start = datetime.datetime.combine(first, datetime.time())
+    end = datetime.datetime.combine(today, datetime.time()) + \
+            datetime.timedelta(days=1)
+    for (hour_dt, games) in session.query(HourlyActivity.hour_dt,
+            func.sum(HourlyActivity.games)).\
+            filter(column == value).\
+            filter(HourlyActivity.hour_dt >= start).\
+            filter(HourlyActivity.hour_dt < end).\
+            group_by(HourlyActivity.hour_dt):
+        day = activity[hour_dt.date()]
+        day['peak'] = max(day['peak'], games)
+
+    return [activity[day] for day in sorted(activity.keys())]
+
+
+def truncate_sql(session=None, column=None, unit=None):
+    """
+    Returns SQL truncating a timestamp column to the 'hour' or the 'day',
+    as the DateTime and Date columns of the summary tables store them.
+    """
+    if session.bind.dialect.name == 'postgresql':
+        if unit == 'hour':
+            return "date_trunc('hour', {0})".format(column)
+        return "cast({0} as date)".format(column)
+
+    # SQLAlchemy stores dates and times as text elsewhere
+    if unit == 'hour':
+        return "strftime('%Y-%m-%d %H:00:00.000000', {0})".format(column)
+    return "date({0})".format(column)
+
+
+def rebuild_activity(session=None):
+    """
+    Recomputes the activity summary tables from the games and
+    player_game_stats tables. The caller commits.
+    """
+    for cls in (HourlyActivity, ServerDailyActivity, MapDailyActivity,
+            ServerDailyPlayer, MapDailyPlayer):
+        session.query(cls).delete()
+
+    hour = truncate_sql(session=session, column='g.start_dt', unit='hour')
+    day = truncate_sql(session=session, column='g.start_dt', unit='day')
+
+    session.execute(sqlalchemy.text(
+        "insert into summary_hourly_activity (hour_dt, server_id, map_id, "
+        "game_type_cd, games, player_games) "
+        "select {0}, g.server_id, g.map_id, g.game_type_cd, count(*), "
+        "coalesce(sum(s.players), 0) "
+        "from games g left outer join "
+        "(select game_id, count(*) as players from player_game_stats "
+        "group by game_id) s on s.game_id = g.game_id "
+        "group by {0}, g.server_id, g.map_id, g.game_type_cd".format(hour)))
+
+    for key in ('server_id', 'map_id'):
+        scope = key.split('_')[0]
+        session.execute(sqlalchemy.text(
+            "insert into summary_{0}_day_players (day_dt, {1}, player_id) "
+            "select distinct {2}, g.{1}, s.player_id "
+            "from games g, player_game_stats s "
+            "where s.game_id = g.game_id "
+            "and s.player_id > {3}".format(scope, key, day,
+                LAST_SENTINEL_ID)))
+
+        session.execute(sqlalchemy.text(
+            "insert into summary_{0}_days (day_dt, {1}, games, players) "
+            "select {2}, g.{1}, count(*), 0 "
+            "from games g "
+            "group by {2}, g.{1}".format(scope, key, day)))
+
+        session.execute(sqlalchemy.text(
+            "update summary_{0}_days set players = "
+            "(select count(*) from summary_{0}_day_players p "
+            "where p.day_dt = summary_{0}_days.day_dt "
+            "and p.{1} = summary_{0}_days.{1})".format(scope, key)))
+
+    log.info("Rebuilt activity.")
@@ -0,0 +1,262 @@
+import datetime
+import logging
+import cStringIO
+import sqlalchemy
+import sqlalchemy.sql.functions as func
+from sqlalchemy.sql.expression import bindparam
+
+log = logging.getLogger(__name__)
+
+# SQLite refuses statements with more than 999 bound parameters, so keep
+# every multi-row insert comfortably below that
+MAX_PARAMS = 900
+
+
+def reserve_ids(session=None, column=None, count=0):
+    """
+    Reserves a block of primary key values for rows that will be inserted
+    with explicit ids, using a single statement on PostgreSQL. Elsewhere
+    the block follows the largest id, and the transaction takes the write
+    lock first. Parameters:
+
+    session - SQLAlchemy database session factory
+    column - the serial primary key column to reserve values from
+    count - how many values are needed
+    """
+    if count == 0:
+        return []
+
+    if session.bind.dialect.name == 'postgresql':
+        return [row[0] for row in session.execute(sqlalchemy.text(
+            "select nextval(pg_get_serial_sequence(:table, :column)) "
+            "from generate_series(1, :count)"),
+            {'table':column.table.name, 'column':column.name,
+                'count':count})]
+
+    # other backends (SQLite) have no sequences but allow one writer at a
+    # time, and a transaction that has written keeps the lock until it
+    # ends. An update that matches no rows takes the lock if this one
+    # hasn't written yet, so no other writer can insert past max + 1
+    # before the reserved ids are used.
+    session.execute(column.table.update().where(column == None).\
+            values({column.name:column}))
+    max_id = session.query(func.max(column)).scalar() or 0
+    return range(max_id + 1, max_id + 1 + count)
+
+
+def with_defaults(table=None, rows=None):
+    """
+    Returns the rows with the Python side defaults (e.g. default=0) of the
+    columns they leave out filled in, as an ORM flush would. Statements
+    built by hand bypass SQLAlchemy's own handling of them.
+    """
+    defaults = [column for column in table.c if column.default is not None
+            and (column.default.is_scalar or column.default.is_callable)]
+
+    filled = []
+    for row in rows:
+        missing = [column for column in defaults if column.key not in row]
+        if missing:
+            row = dict(row)
+            for column in missing:
+                if column.default.is_scalar:
+                    row[column.key] = column.default.arg
+                else:
+                    row[column.key] = column.default.arg(None)
+        filled.append(row)
+    return filled
+
+
+def insert_rows(session=None, table=None, rows=None, keys=None,
+        update=None):
+    """
+    Inserts a list of row dictionaries into a table using multi-row
+    INSERT ... VALUES statements instead of one statement per row. Rows
+    are grouped by the columns they set so that columns left out fall back
+    to their defaults, exactly as with an ORM flush. Keys that do not name
+    a column of the table are ignored. Returns the number of rows written.
+
+    With keys, a row whose key exists already, e.g. because a concurrent
+    transaction inserted it first, doesn't fail the statement: it is left
+    alone, or updated with the update expressions, through INSERT ... ON
+    CONFLICT (PostgreSQL 9.5 or SQLite 3.24 and up). Parameters:
+
+    session - SQLAlchemy database session factory
+    table - the Table to insert into
+    rows - list of dictionaries mapping column names to values
+    keys - names of the unique columns that identify a row, if any
+    update - dictionary mapping the names of the columns to change when
+        the key exists to SQL expressions, which can refer to the values
+        being inserted as excluded.<column>
+    """
+    groups = {}
+    for row in with_defaults(table=table, rows=rows):
+        columns = tuple(sorted(key for key in row if key in table.c))
+        groups.setdefault(columns, []).append(row)
+
+    preparer = session.bind.dialect.identifier_preparer
+    conflict = ''
+    if keys:
+        conflict = ' on conflict ({0}) do nothing'.format(', '.join(
+            preparer.quote(table.c[name].name, None) for name in keys))
+        if update:
+            conflict = conflict.replace('do nothing', 'do update set ' +
+                    ', '.join('{0} = {1}'.format(preparer.quote(
+                        table.c[name].name, None), expression)
+                        for (name, expression) in sorted(update.items())))
+
+    statements = 0
+    written = 0
+    for (columns, group) in groups.items():
+        per_statement = max(1, MAX_PARAMS / len(columns))
+        column_list = ', '.join(preparer.quote(table.c[column].name, None)
+                for column in columns)
+
+        for start in range(0, len(group), per_statement):
+            params = []
+            values = []
+            for (i, row) in enumerate(group[start:start+per_statement]):
+                names = []
+                for (j, column) in enumerate(columns):
+                    name = 'r{0}c{1}'.format(i, j)
+                    params.append(bindparam(name, row[column],
+                        type_=table.c[column].type))
+                    names.append(':' + name)
+                values.append('(' + ', '.join(names) + ')')
+
+            result = session.execute(sqlalchemy.text("insert into {0} ({1}) "
+                "values {2}{3}".format(preparer.format_table(table),
+                    column_list, ', '.join(values), conflict),
+                bindparams=params))
+            written += result.rowcount
+            statements += 1
+
+    log.debug("Inserted {0} rows into {1} using {2} statements.".format(
+        len(rows), table.name, statements))
+    return written
+
+
+def increment_rows(session=None, table=None, keys=None, rows=None):
+    """
+    Adds values to the counter columns of a summary table, creating the
+    rows that don't exist yet, with INSERT ... ON CONFLICT DO UPDATE: a key
+    that a concurrent transaction creates first (the first game on a new
+    map, or of a new day) is added to rather than inserted twice. Rows
+    with the same key are summed first and a None value leaves the counter
+    unchanged, so a counter stays NULL until something is added to it,
+    like SUM() would. Parameters:
+
+    session - SQLAlchemy database session factory
+    table - the summary Table
+    keys - names of the columns making up the primary key
+    rows - list of dictionaries holding the key values and the amounts to
+        add
+    """
+    merged = {}
+    for row in rows:
+        key = tuple(row[name] for name in keys)
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+
+        for (name, value) in row.items():
+            if name not in keys and value is not None:
+                if merged[key].get(name) is None:
+                    merged[key][name] = value
+                else:
+                    merged[key][name] += value
+
+    # rows are grouped by the counters they add to, since counters left out
+    # of the insert get their column defaults but mustn't be updated; they
+    # are written in key order, so that concurrent transactions lock them
+    # in the same order
+    groups = {}
+    for key in sorted(merged.keys()):
+        row = dict((name, value) for (name, value) in merged[key].items()
+                if value is not None)
+        counters = tuple(sorted(name for name in row if name not in keys))
+        groups.setdefault(counters, []).append(row)
+
+    preparer = session.bind.dialect.identifier_preparer
+    for (counters, group) in groups.items():
+        insert_rows(session=session, table=table, rows=group, keys=keys,
+                update=dict((counter, 'coalesce({0}.{1}, 0) + '
+                    'excluded.{1}'.format(preparer.format_table(table),
+                        preparer.quote(table.c[counter].name, None)))
+                    for counter in counters))
+
+
+# characters escaped in COPY's text format
+COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+        ('\r', '\\r'))
+
+
+def copy_value(value):
+    """
+    Formats a value as a field of COPY's text format. None is \\N (NULL) and
+    intervals are written as a number of seconds.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.timedelta):
+        return '{0} seconds'.format(value.days * 86400 + value.seconds)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    for (char, escaped) in COPY_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def copy_rows(session=None, table=None, rows=None):
+    """
+    Loads rows into a PostgreSQL table with COPY, the fastest way to bulk
+    load it. Parameters:
+
+    session - SQLAlchemy database session factory
+    table - the Table to load
+    rows - list of dictionaries mapping column names to values
+    """
+    rows = with_defaults(table=table, rows=rows)
+    columns = sorted(set(key for row in rows for key in row
+        if key in table.c))
+
+    data = cStringIO.StringIO()
+    for row in rows:
+        data.write('\t'.join(copy_value(row.get(column))
+            for column in columns) + '\n')
+    data.seek(0)
+
+    preparer = session.bind.dialect.identifier_preparer
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert("copy {0} ({1}) from stdin".format(
+            preparer.format_table(table), ', '.join(preparer.quote(
+                table.c[column].name, None) for column in columns)), data)
+    finally:
+        cursor.close()
+
+
+def load_rows(session=None, table=None, rows=None):
+    """
+    Bulk loads rows into a table in the current transaction: with COPY on
+    PostgreSQL, and with one executemany per set of columns elsewhere.
+    Parameters:
+
+    session - SQLAlchemy database session factory
+    table - the Table to load
+    rows - list of dictionaries mapping column names to values
+    """
+    if len(rows) == 0:
+        return
+
+    if session.bind.dialect.name == 'postgresql':
+        copy_rows(session=session, table=table, rows=rows)
+        return
+
+    groups = {}
+    for row in with_defaults(table=table, rows=rows):
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        session.execute(table.insert(), group)
@@ -0,0 +1,68 @@
+import random
+
+WEAPONS = ('laser', 'shotgun', 'uzi', 'grenadelauncher', 'electro',
+        'crylink', 'nex', 'hagar', 'rocketlauncher', 'minelayer', 'hlac',
+        'seeker', 'sniperrifle', 'fireball', 'hook', 'tuba')
+
+
+def make_body(players=16, game_type_cd='ctf', timestamp=1306014455,
+        map_name='stormkeep', server_name='Bench Server', seed=None,
+        bots=0, untracked=0, hashkeys=None):
+    """
+    Generates a stats submission body in the format Xonotic servers POST to
+    stats/submit. Parameters:
+
+    players - how many players to include
+    game_type_cd - the game type (e.g. dm, ctf)
+    timestamp - the T (game start) value, in epoch seconds
+    map_name - the M value
+    server_name - the S value
+    seed - seed for the random stat values, for repeatable bodies
+    bots - how many of the players are bots (bot#N hashkeys)
+    untracked - how many of the players are untracked (player#N hashkeys)
+    hashkeys - hashkeys to draw the tracked players from, so that players
+        come back across submissions; random new ones by default
+    """
+    rand = random.Random(seed)
+    lines = ['V 1', 'R .1', 'T %d' % timestamp, 'G %s' % game_type_cd,
+            'M %s' % map_name, 'S %s' % server_name, 'C 0', 'W 5']
+
+    if hashkeys is not None:
+        tracked = rand.sample(hashkeys, players - bots - untracked)
+    else:
+        tracked = ['%040x' % rand.getrandbits(160)
+                for i in range(players - bots - untracked)]
+    keys = tracked + ['bot#%d' % i for i in range(bots)] + \
+            ['player#%d' % i for i in range(untracked)]
+
+    for (i, hashkey) in enumerate(keys):
+        lines.append('P %s' % hashkey)
+        lines.append('n ^%dplayer^7%d' % (i % 10, i))
+        if game_type_cd != 'dm':
+            lines.append('t %d' % (5, 14)[i % 2])
+        lines.append('e matches 1')
+        lines.append('e joins 1')
+        lines.append('e scoreboardvalid 1')
+        lines.append('e rank %d' % (i + 1))
+        lines.append('e alivetime %.6f' % rand.uniform(60, 1200))
+        lines.append('e scoreboard-score %d' % rand.randint(-5, 150))
+        lines.append('e scoreboard-kills %d' % rand.randint(0, 60))
+        lines.append('e scoreboard-deaths %d' % rand.randint(0, 60))
+        lines.append('e scoreboard-suicides %d' % rand.randint(0, 5))
+        if game_type_cd == 'ctf':
+            lines.append('e scoreboard-caps %d' % rand.randint(0, 5))
+            lines.append('e scoreboard-pickups %d' % rand.randint(0, 10))
+            lines.append('e scoreboard-returns %d' % rand.randint(0, 10))
+            lines.append('e scoreboard-drops %d' % rand.randint(0, 10))
+            lines.append('e scoreboard-fckills %d' % rand.randint(0, 10))
+
+        for weapon_cd in rand.sample(WEAPONS, rand.randint(2, 8)):
+            fired = rand.randint(1, 500)
+            hit = rand.randint(0, fired)
+            lines.append('e acc-%s-cnt-fired %d' % (weapon_cd, fired))
+            lines.append('e acc-%s-fired %f' % (weapon_cd, fired * 80.0))
+            lines.append('e acc-%s-cnt-hit %d' % (weapon_cd, hit))
+            lines.append('e acc-%s-hit %f' % (weapon_cd, hit * 60.0))
+            lines.append('e acc-%s-frags %d' % (weapon_cd, hit / 10))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,83 @@
+"""
+Times xonstat.util.html_colors and strip_colors, cold and memoized,
+against the multi-pass implementations they replaced. Run with:
+
+    python -m xonstat.bench.colors
+"""
+import random
+import re
+import timeit
+from xonstat.util import html_colors, strip_colors
+
+
+def legacy_strip_colors(str=None):
+    str = re.sub(r'\^x\w\w\w', '', str)
+    str = re.sub(r'\^\d', '', str)
+    return str
+
+
+def legacy_html_colors(str=None):
+    orig = str
+    str = re.sub(r'\^x(\w)(\w)(\w)', 
+            "<span style='color:#\g<1>\g<1>\g<2>\g<2>\g<3>\g<3>'>", str)
+    str = re.sub(r'\^1', "<span style='color:#FF9900'>", str)
+    str = re.sub(r'\^2', "<span style='color:#33FF00'>", str)
+    str = re.sub(r'\^3', "<span style='color:#FFFF00'>", str)
+    str = re.sub(r'\^4', "<span style='color:#3366FF'>", str)
+    str = re.sub(r'\^5', "<span style='color:#33FFFF'>", str)
+    str = re.sub(r'\^6', "<span style='color:#FF3366'>", str)
+    str = re.sub(r'\^7', "<span style='color:#FFFFFF'>", str)
+    str = re.sub(r'\^8', "<span style='color:#999999'>", str)
+    str = re.sub(r'\^9', "<span style='color:#666666'>", str)
+    str = re.sub(r'\^0', "<span style='color:#333333'>", str)
+
+    for span in range(len(re.findall(r'\^x\w\w\w|\^\d', orig))):
+        str += "</span>"
+
+    return str
+
+
+def make_nicks(count=500, seed=0):
+    """
+    Builds nicks with a mix of ^x and ^N colour codes.
+    """
+    rand = random.Random(seed)
+    nicks = []
+    for i in range(count):
+        parts = []
+        for j in range(rand.randint(1, 4)):
+            if rand.random() < 0.5:
+                parts.append('^x%03x' % rand.randint(0, 0xfff))
+            else:
+                parts.append('^%d' % rand.randint(0, 9))
+            parts.append(''.join(rand.choice('abcdefghijklmnop')
+                for k in range(rand.randint(2, 6))))
+        nicks.append(''.join(parts))
+    return nicks
+
+
+def main():
+    nicks = make_nicks()
+    runs = 20
+
+    def timed(func):
+        return min(timeit.repeat(lambda: [func(nick) for nick in nicks],
+            repeat=3, number=runs)) / (runs * len(nicks)) * 1e6
+
+    def cold(func):
+        def run(nick):
+            func.memo.clear()
+            return func(nick)
+        return run
+
+    print("%-14s %12s %12s %12s" % ('function', 'legacy (us)', 'cold (us)',
+        'memo (us)'))
+    for (name, legacy, func) in (
+            ('html_colors', legacy_html_colors, html_colors),
+            ('strip_colors', legacy_strip_colors, strip_colors)):
+        print("%-14s %12.2f %12.2f %12.2f" % (name, timed(legacy),
+            timed(cold(func)), timed(func)))
+
+
+if __name__ == '__main__':
+    main()
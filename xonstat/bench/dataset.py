@@ -0,0 +1,234 @@
+"""
+Fills an empty database with a synthetic game history for the read path
+benchmarks (xonstat.bench.views). Activity is skewed like the real thing:
+a few busy servers host most games, a few maps are played most often and
+a small core of players shows up in a large share of the games. Run with:
+
+    python -m xonstat.bench.dataset sqlite:///bench.db --games 1000000
+
+Rows are written with explicit ids in large executemany batches, and the
+summary tables are rebuilt once at the end.
+"""
+import bisect
+import datetime
+import optparse
+import random
+import sys
+import time
+import sqlalchemy
+from xonstat.activity import rebuild_activity
+from xonstat.bench import WEAPONS
+from xonstat.leaderboard import rebuild_leaderboards
+from xonstat.models import *
+from xonstat.rating import rebuild_ratings
+from xonstat.rollup import rebuild_player_totals
+
+GAME_TYPES = (('dm', 'Deathmatch', 6), ('ctf', 'Capture The Flag', 3),
+        ('tdm', 'Team Deathmatch', 1))
+
+# games written per transaction
+BATCH_SIZE = 1000
+
+
+class Zipf(object):
+    """
+    Draws 0-based ranks with probability proportional to 1 / (rank + 1)^s,
+    so low ranks are drawn far more often than high ones.
+    """
+    def __init__(self, count, s=1.0, rand=None):
+        self.rand = rand
+        self.cumulative = []
+        total = 0.0
+        for rank in range(count):
+            total += 1.0 / (rank + 1) ** s
+            self.cumulative.append(total)
+
+    def draw(self):
+        return bisect.bisect_left(self.cumulative,
+                self.rand.random() * self.cumulative[-1])
+
+
+def seed_codes(conn):
+    """
+    Adds the game type and weapon codes the generated stats refer to.
+    """
+    for (table, rows) in ((cd_game_type_table, [{'game_type_cd':code,
+                'descr':descr} for (code, descr, weight) in GAME_TYPES]),
+            (cd_weapon_table, [{'weapon_cd':weapon_cd,
+                'descr':weapon_cd.capitalize()} for weapon_cd in WEAPONS])):
+        key = list(table.primary_key.columns)[0]
+        existing = set(row[0] for row in conn.execute(
+            sqlalchemy.select([key])))
+        rows = [row for row in rows if row[key.name] not in existing]
+        if rows:
+            conn.execute(table.insert(), rows)
+
+
+def generate(engine=None, games=100000, servers=200, maps=100,
+        players=50000, seed=0):
+    """
+    Writes the servers, maps, players and games with their player and
+    weapon stats. The database must not hold any games yet. Parameters:
+
+    engine - engine of the database to fill
+    games - number of games to generate
+    servers - number of servers
+    maps - number of maps
+    players - number of tracked players
+    seed - seed for a repeatable dataset
+    """
+    rand = random.Random(seed)
+    conn = engine.connect()
+    try:
+        with conn.begin():
+            seed_codes(conn)
+            conn.execute(servers_table.insert(), [{'server_id':i + 1,
+                'name':'Server %d' % (i + 1)} for i in range(servers)])
+            conn.execute(maps_table.insert(), [{'map_id':i + 1,
+                'name':'map%d' % (i + 1)} for i in range(maps)])
+
+            rows = []
+            for i in range(players):
+                nick = '^%dplayer^7%d' % (i % 10, i + 3)
+                (stripped, html) = render_nick(nick)
+                rows.append({'player_id':i + 3, 'nick':nick,
+                    'stripped_nick':stripped, 'nick_html':html})
+            conn.execute(players_table.insert(), rows)
+            conn.execute(hashkeys_table.insert(), [{'player_id':i + 3,
+                'hashkey':'%040x' % rand.getrandbits(160)}
+                for i in range(players)])
+
+        server_ranks = Zipf(servers, s=1.2, rand=rand)
+        map_ranks = Zipf(maps, s=1.0, rand=rand)
+        player_ranks = Zipf(players, s=0.9, rand=rand)
+        game_types = []
+        for (code, descr, weight) in GAME_TYPES:
+            game_types.extend([code] * weight)
+
+        start_dt = datetime.datetime(2011, 1, 1)
+        pgstat_id = 0
+        pwstat_id = 0
+        started = time.time()
+        for first in range(0, games, BATCH_SIZE):
+            game_rows = []
+            pgstat_rows = []
+            pwstat_rows = []
+            last = min(first + BATCH_SIZE, games)
+            for game_id in range(first + 1, last + 1):
+                game_type_cd = rand.choice(game_types)
+                start_dt += datetime.timedelta(seconds=rand.randint(1, 600))
+                game_rows.append({'game_id':game_id, 'start_dt':start_dt,
+                    'game_type_cd':game_type_cd,
+                    'server_id':server_ranks.draw() + 1,
+                    'map_id':map_ranks.draw() + 1,
+                    'duration':datetime.timedelta(seconds=rand.randint(300,
+                        1200))})
+
+                # distinct tracked players, plus the odd bot or untracked
+                # player
+                count = rand.randint(2, 16)
+                player_ids = set()
+                while len(player_ids) < count:
+                    player_ids.add(player_ranks.draw() + LAST_SENTINEL_ID + 1)
+                player_ids = list(player_ids)
+                if rand.random() < 0.2:
+                    player_ids.append(1)
+                if rand.random() < 0.1:
+                    player_ids.append(2)
+                rand.shuffle(player_ids)
+
+                for (rank, player_id) in enumerate(player_ids):
+                    pgstat_id += 1
+                    nick = '^%dplayer^7%d' % (player_id % 10, player_id)
+                    (stripped, html) = render_nick(nick)
+                    values = {'player_game_stat_id':pgstat_id,
+                            'player_id':player_id, 'game_id':game_id,
+                            'stat_type':'game', 'nick':nick,
+                            'stripped_nick':stripped, 'nick_html':html,
+                            'team':None, 'rank':rank + 1,
+                            'alivetime':datetime.timedelta(
+                                seconds=rand.randint(60, 1200)),
+                            'kills':rand.randint(0, 60),
+                            'deaths':rand.randint(0, 60),
+                            'suicides':rand.randint(0, 5),
+                            'score':rand.randint(-5, 150), 'captures':None,
+                            'pickups':None, 'drops':None, 'returns':None,
+                            'carrier_frags':None}
+                    if game_type_cd != 'dm':
+                        values['team'] = (5, 14)[rank % 2]
+                    if game_type_cd == 'ctf':
+                        for column in ('captures', 'pickups', 'drops',
+                                'returns', 'carrier_frags'):
+                            values[column] = rand.randint(0, 10)
+                    pgstat_rows.append(values)
+
+                    for weapon_cd in rand.sample(WEAPONS, rand.randint(2, 5)):
+                        pwstat_id += 1
+                        fired = rand.randint(1, 500)
+                        hit = rand.randint(0, fired)
+                        pwstat_rows.append({'player_weapon_stats_id':pwstat_id,
+                            'player_id':player_id, 'game_id':game_id,
+                            'player_game_stat_id':pgstat_id,
+                            'weapon_cd':weapon_cd, 'max':fired * 80,
+                            'actual':hit * 60, 'fired':fired, 'hit':hit,
+                            'frags':hit / 10})
+
+            with conn.begin():
+                conn.execute(games_table.insert(), game_rows)
+                conn.execute(player_game_stats_table.insert(), pgstat_rows)
+                conn.execute(player_weapon_stats_table.insert(), pwstat_rows)
+
+            done = first + len(game_rows)
+            if done % (BATCH_SIZE * 50) == 0 or done == games:
+                print("%d games, %d player stats, %d weapon stats "
+                        "(%.0f games/s)" % (done, pgstat_id, pwstat_id,
+                            done / (time.time() - started)))
+
+        # ids were given explicitly, so move the sequences past them
+        if engine.dialect.name == 'postgresql':
+            for (table, column, value) in (('games', 'game_id', games),
+                    ('players', 'player_id', players + 2),
+                    ('player_game_stats', 'player_game_stat_id', pgstat_id),
+                    ('player_weapon_stats', 'player_weapon_stats_id',
+                        pwstat_id),
+                    ('servers', 'server_id', servers),
+                    ('maps', 'map_id', maps)):
+                conn.execute("select setval(pg_get_serial_sequence("
+                        "'{0}', '{1}'), {2})".format(table, column, value))
+    finally:
+        conn.close()
+
+    session = DBSession()
+    try:
+        rebuild_leaderboards(session=session)
+        rebuild_player_totals(session=session)
+        rebuild_activity(session=session)
+        rebuild_ratings(session=session)
+        session.commit()
+    finally:
+        DBSession.remove()
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage="%prog [options] sqlalchemy_url")
+    parser.add_option('--games', type='int', default=100000)
+    parser.add_option('--servers', type='int', default=200)
+    parser.add_option('--maps', type='int', default=100)
+    parser.add_option('--players', type='int', default=50000)
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("a database url is required")
+
+    engine = sqlalchemy.create_engine(args[0])
+    initialize_db(engine)
+    if DBSession.query(Game).first() is not None:
+        parser.error("the database already holds games")
+    DBSession.remove()
+
+    generate(engine=engine, games=options.games, servers=options.servers,
+            maps=options.maps, players=options.players, seed=options.seed)
+
+
+if __name__ == '__main__':
+    main()
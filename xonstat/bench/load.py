@@ -0,0 +1,207 @@
+"""
+Fires generated stats submissions at stats_submit from several threads and
+reports throughput, latency percentiles and SQL statements per submission.
+Run with:
+
+    python -m xonstat.bench.load [options] [sqlalchemy url]
+
+By default the application is loaded in process, on a throwaway SQLite
+file or on the given database URL (e.g. a scratch PostgreSQL xonstatdb).
+With --http the submissions are POSTed to a running server instead, and
+the statement counts are read from its /metrics endpoint.
+"""
+import optparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from xonstat.bench import make_body
+
+# servers and maps submissions are spread over
+SERVERS = ['Load Server %d' % i for i in range(5)]
+MAPS = ('stormkeep', 'aggressor', 'runningman', 'downer', 'silentsiege',
+        'solarium', 'warfare', 'afterslime')
+
+
+def make_bodies(count=100, min_players=2, max_players=24, pool=500,
+        seed=0):
+    """
+    Generates a mix of dm and ctf submissions, some with bots and untracked
+    players, drawn from a fixed pool of returning players. Parameters:
+
+    count - how many submissions to generate
+    min_players - fewest players in a game
+    max_players - most players in a game
+    pool - how many distinct tracked players there are
+    seed - seed for repeatable submissions
+    """
+    rand = random.Random(seed)
+    hashkeys = ['%040x' % rand.getrandbits(160)
+            for i in range(max(pool, max_players))]
+    bodies = []
+    for i in range(count):
+        players = rand.randint(min_players, max_players)
+        bots = rand.choice((0, 0, 0, rand.randint(0, players / 2)))
+        untracked = rand.choice((0, 0, rand.randint(0, (players - bots) / 4)))
+        bodies.append(make_body(players=players,
+            game_type_cd=rand.choice(('dm', 'dm', 'ctf')),
+            timestamp=1306014455 + i * 600,
+            map_name=rand.choice(MAPS), server_name=rand.choice(SERVERS),
+            seed=rand.random(), bots=bots, untracked=untracked,
+            hashkeys=hashkeys))
+    return bodies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def submit_statements(text):
+    """
+    Returns the statements counted for the stats_submit route in a
+    Prometheus /metrics page.
+    """
+    for line in text.splitlines():
+        if line.startswith('xonstat_request_statements_total{route='
+                '"stats_submit"}'):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+class InProcess(object):
+    """
+    Posts submissions straight into a WSGI application built by
+    xonstat.main.
+    """
+    def __init__(self, url=None, bulk=True, threads=8):
+        from xonstat import main
+        self.app = main({}, **{'sqlalchemy.url':url,
+            'sqlalchemy.pool_size':str(threads),
+            'mako.directories':'xonstat:templates',
+            'xonstat.bulk_submit':str(bulk).lower(),
+            'xonstat.metrics.enabled':'true',
+            'xonstat.metrics.slow_query_ms':'0',
+            'xonstat.sqlite.journal_mode':'wal'})
+
+    def post(self, body):
+        from webob import Request
+        request = Request.blank('/stats/submit', POST=body)
+        request.content_type = 'text/plain'
+        return request.get_response(self.app).status_int
+
+    def statements(self):
+        from xonstat.metrics import prometheus_text
+        return submit_statements(prometheus_text())
+
+
+class OverHttp(object):
+    """
+    POSTs submissions to a running server.
+    """
+    def __init__(self, base=None):
+        self.base = base.rstrip('/')
+
+    def post(self, body):
+        try:
+            return urllib2.urlopen(self.base + '/stats/submit', body).getcode()
+        except urllib2.HTTPError as e:
+            return e.code
+
+    def statements(self):
+        return submit_statements(
+                urllib2.urlopen(self.base + '/metrics').read())
+
+
+def run(target=None, bodies=None, threads=8):
+    """
+    Posts the bodies from a number of threads, returning the elapsed time,
+    the latency of every submission and the number that failed.
+    """
+    queue = list(reversed(bodies))
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                body = queue.pop()
+            start = time.time()
+            try:
+                status = target.post(body)
+            except Exception:
+                status = None
+            with lock:
+                latencies.append(time.time() - start)
+                if status != 200:
+                    failures.append(status)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.time() - start, latencies, len(failures))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [sqlalchemy url]")
+    parser.add_option('-n', '--submissions', type='int', default=200)
+    parser.add_option('-c', '--concurrency', type='int', default=8)
+    parser.add_option('--min-players', type='int', default=2)
+    parser.add_option('--max-players', type='int', default=24)
+    parser.add_option('--pool', type='int', default=500,
+            help="distinct tracked players")
+    parser.add_option('--row-by-row', action='store_true', default=False,
+            help="write stats with the ORM instead of multi-row inserts")
+    parser.add_option('--http', metavar='URL',
+            help="POST to a running server at URL instead")
+    parser.add_option('--seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+
+    bodies = make_bodies(count=options.submissions,
+            min_players=options.min_players, max_players=options.max_players,
+            pool=options.pool, seed=options.seed)
+
+    directory = None
+    if options.http:
+        target = OverHttp(base=options.http)
+    else:
+        if args:
+            url = args[0]
+        else:
+            directory = tempfile.mkdtemp()
+            url = 'sqlite:///' + os.path.join(directory, 'load.db')
+        target = InProcess(url=url, bulk=not options.row_by_row,
+                threads=options.concurrency)
+
+    try:
+        before = target.statements()
+        (elapsed, latencies, failed) = run(target=target, bodies=bodies,
+                threads=options.concurrency)
+        statements = target.statements() - before
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print("%-28s %10d" % ('submissions', len(bodies)))
+    print("%-28s %10d" % ('failed', failed))
+    print("%-28s %10d" % ('threads', options.concurrency))
+    print("%-28s %10.1f" % ('submissions/s', len(bodies) / elapsed))
+    for (name, fraction) in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        print("%-28s %10.2f" % ('latency %s (ms)' % name,
+            percentile(latencies, fraction) * 1000))
+    print("%-28s %10.2f" % ('latency max (ms)', max(latencies) * 1000))
+    print("%-28s %10.1f" % ('statements/submission',
+        float(statements) / len(bodies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Times xonstat.parser.parse_submission on large multi-player bodies against
+the line-splitting parser it replaced. Run with:
+
+    python -m xonstat.bench.parser
+"""
+import re
+import timeit
+from xonstat.bench import make_body
+from xonstat.parser import parse_submission
+
+
+def legacy_parse(body):
+    """
+    The original parse_body loop plus the per-weapon key scan done by
+    create_player_weapon_stats, kept here as the baseline.
+    """
+    game_meta = {}
+    player_events = {}
+    players = []
+
+    for line in body.split('\n'):
+        try:
+            (key, value) = line.strip().split(' ', 1)
+
+            if key in 'V' 'T' 'G' 'M' 'S' 'C' 'R' 'W':
+                game_meta[key] = value
+
+            if key == 'P':
+                if len(player_events) != 0:
+                    players.append(player_events)
+                    player_events = {}
+
+                player_events[key] = value
+
+            if key == 'e':
+                (subkey, subvalue) = value.split(' ', 1)
+                player_events[subkey] = subvalue
+            if key == 'n':
+                player_events[key] = value
+            if key == 't':
+                player_events[key] = value
+        except:
+            pass
+
+    if len(player_events) > 0:
+        players.append(player_events)
+
+    for player_events in players:
+        for (key, value) in player_events.items():
+            matched = re.search("acc-(.*?)-cnt-fired", key)
+            if matched:
+                weapon_cd = matched.group(1)
+                for suffix in ('-cnt-fired', '-fired', '-cnt-hit', '-hit',
+                        '-frags'):
+                    if 'acc-' + weapon_cd + suffix in player_events:
+                        int(round(float(
+                            player_events['acc-' + weapon_cd + suffix])))
+
+    return (game_meta, players)
+
+
+def main():
+    print("%8s %10s %12s %12s %8s" % ('players', 'bytes', 'legacy (ms)',
+        'parser (ms)', 'speedup'))
+    for players in (8, 16, 32, 64, 128):
+        body = make_body(players=players, seed=players)
+        runs = 200
+        legacy = min(timeit.repeat(lambda: legacy_parse(body), repeat=3,
+            number=runs)) / runs * 1000
+        parser = min(timeit.repeat(lambda: parse_submission(body), repeat=3,
+            number=runs)) / runs * 1000
+        print("%8d %10d %12.3f %12.3f %7.2fx" % (players, len(body), legacy,
+            parser, legacy / parser))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Times the database work done when a process starts: reflecting every
+table, as initialize_db used to, against creating the declared tables
+(a no-op on an existing database) and the optional verification mode.
+Run with:
+
+    python -m xonstat.bench.startup [sqlalchemy url]
+
+The default is a throwaway SQLite file; pass a PostgreSQL URL of an
+existing xonstatdb to see the effect of network round trips.
+"""
+import os
+import sys
+import tempfile
+import timeit
+import sqlalchemy
+from xonstat.models import Base, verify_schema
+
+
+def main(argv=sys.argv):
+    if len(argv) > 1:
+        url = argv[1]
+        path = None
+    else:
+        (handle, path) = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        url = 'sqlite:///' + path
+
+    try:
+        engine = sqlalchemy.create_engine(url)
+        Base.metadata.create_all(engine)
+
+        def declared():
+            Base.metadata.create_all(engine)
+
+        def reflect():
+            declared()
+            sqlalchemy.MetaData(bind=engine, reflect=True)
+
+        def verify():
+            declared()
+            verify_schema(engine=engine)
+
+        runs = 20
+        print("%-24s %10s" % ('startup work', 'ms'))
+        for (name, func) in (('declared + reflect (old)', reflect),
+                ('declared tables', declared),
+                ('declared + verify', verify)):
+            elapsed = min(timeit.repeat(func, repeat=3, number=runs)) / runs
+            print("%-24s %10.2f" % (name, elapsed * 1000))
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Times the read path views against a database filled by
+xonstat.bench.dataset, calling each view function directly with a Pyramid
+testing request (no rendering). The results can be saved as JSON and
+compared with an earlier run, e.g. from the previous commit. Run with:
+
+    python -m xonstat.bench.views sqlite:///bench.db --output after.json \\
+            --compare before.json
+"""
+import datetime
+import json
+import optparse
+import os
+import subprocess
+import sys
+import timeit
+import sqlalchemy
+from pyramid import testing
+from sqlalchemy import event
+from xonstat.models import *
+from xonstat.pagination import encode_token, row_counts
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.abspath(__file__))).\
+                        communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def find_cases(session):
+    """
+    Returns (name, view, matchdict, params) tuples for the pages worth
+    timing: the busiest and a typical player and server, and first and
+    deep pages of the game lists.
+    """
+    from xonstat.views import (game_index, main_index, player_info,
+            server_game_index)
+
+    players = session.query(PlayerGameTotal.player_id).\
+            order_by(PlayerGameTotal.games.desc())
+    busiest_player = players.first()[0]
+    typical_player = players.offset(players.count() / 2).first()[0]
+
+    servers = session.query(ServerGameSummary.server_id).\
+            order_by(ServerGameSummary.games.desc())
+    busiest_server = servers.first()[0]
+    typical_server = servers.offset(servers.count() / 2).first()[0]
+
+    # a token from the middle of the history, as deep paging produces
+    middle_game = session.query(sqlalchemy.func.max(Game.game_id)).\
+            scalar() / 2
+    middle_server_game = session.query(Game.game_id).\
+            filter(Game.server_id == busiest_server).\
+            order_by(Game.game_id.desc()).\
+            offset(session.query(ServerGameSummary.games).\
+                filter_by(server_id=busiest_server).scalar() / 2).\
+            first()[0]
+
+    return [('main_index', main_index, {}, {}),
+            ('player_info busiest', player_info, {'id':busiest_player}, {}),
+            ('player_info typical', player_info, {'id':typical_player}, {}),
+            ('game_index first', game_index, {}, {}),
+            ('game_index deep', game_index, {},
+                {'after':encode_token(middle_game)}),
+            ('server_game_index busiest', server_game_index,
+                {'server_id':busiest_server}, {}),
+            ('server_game_index typical', server_game_index,
+                {'server_id':typical_server}, {}),
+            ('server_game_index deep', server_game_index,
+                {'server_id':busiest_server},
+                {'after':encode_token(middle_server_game)})]
+
+
+def time_case(statements, view, matchdict, params, runs=20):
+    """
+    Calls a view runs times after a warm-up call, returning its timings in
+    milliseconds and the statements a single call executes. statements is
+    the list the engine appends every executed statement to.
+    """
+    def call():
+        request = testing.DummyRequest(params=params)
+        request.matchdict = dict(matchdict)
+        view(request)
+        DBSession.remove()
+
+    testing.setUp()
+    try:
+        call()
+        before = len(statements)
+        call()
+        executed = len(statements) - before
+
+        timings = sorted(t * 1000 for t in timeit.repeat(call, repeat=runs,
+            number=1))
+    finally:
+        testing.tearDown()
+
+    return {'min':timings[0], 'median':timings[len(timings) / 2],
+            'max':timings[-1], 'statements':executed}
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(usage="%prog [options] sqlalchemy_url")
+    parser.add_option('--runs', type='int', default=20)
+    parser.add_option('--output', help="file to save the results to")
+    parser.add_option('--compare', help="results of an earlier run")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("a database url is required")
+
+    engine = sqlalchemy.create_engine(args[0])
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    initialize_db(engine)
+    row_counts.clear()
+
+    session = DBSession()
+    sizes = dict((name, session.execute("select count(*) from " + name).\
+            scalar()) for name in ('games', 'players', 'player_game_stats',
+                'player_weapon_stats'))
+    cases = find_cases(session)
+    DBSession.remove()
+
+    results = {'revision':git_revision(),
+            'created':datetime.datetime.utcnow().isoformat(),
+            'database':engine.dialect.name, 'rows':sizes, 'views':{}}
+    for (name, view, matchdict, params) in cases:
+        results['views'][name] = time_case(statements, view, matchdict,
+                params, runs=options.runs)
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['views']
+
+    print("%-28s %10s %10s %6s %10s %8s" % ('view', 'min (ms)',
+        'median', 'stmts', 'baseline', 'change'))
+    for (name, view, matchdict, params) in cases:
+        result = results['views'][name]
+        if name in baseline:
+            before = baseline[name]['median']
+            compared = ("%10.2f %+7.1f%%" % (before,
+                (result['median'] - before) / before * 100))
+        else:
+            compared = "%10s %8s" % ('-', '-')
+        print("%-28s %10.2f %10.2f %6d %s" % (name, result['min'],
+            result['median'], result['statements'], compared))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+from xonstat.models import DBSession, Player
+
+log = logging.getLogger(__name__)
+
+
+class IdentityCache(object):
+    """
+    A bounded, thread-safe LRU cache mapping natural keys (server names,
+    map names, hashkeys) to database ids. Entries expire after ttl seconds.
+
+    Ids of rows created by the current transaction are staged per thread
+    and only become visible to other threads once the transaction commits.
+    A rollback throws them away, so a cached id always names a row that
+    was committed.
+    """
+    def __init__(self, name=None, maxsize=1000, ttl=3600):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _staged(self):
+        if not hasattr(self._local, 'staged'):
+            self._local.staged = {}
+        return self._local.staged
+
+    def get(self, key):
+        """
+        Returns the id cached for key, or None on a miss.
+        """
+        staged = self._staged()
+        with self._lock:
+            if key in staged:
+                self.hits += 1
+                return staged[key]
+
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+
+            # re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, staged=False):
+        """
+        Caches value for key. Staged entries are only visible to the
+        current thread until commit() is called.
+        """
+        if staged:
+            self._staged()[key] = value
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._staged().pop(key, None)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def commit(self):
+        """
+        Publishes the entries staged by the current thread.
+        """
+        staged = self._staged()
+        for (key, value) in staged.items():
+            self.put(key, value)
+        staged.clear()
+
+    def rollback(self):
+        """
+        Throws away the entries staged by the current thread.
+        """
+        self._staged().clear()
+
+    def clear(self):
+        self.rollback()
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size':len(self._entries), 'hits':self.hits,
+                    'misses':self.misses}
+
+
+# server name -> server_id, map name -> map_id, hashkey -> player_id
+server_ids = IdentityCache(name='server_ids')
+map_ids = IdentityCache(name='map_ids')
+player_ids = IdentityCache(name='player_ids')
+
+# hashes of recently recorded submissions (see xonstat.dedup)
+submissions = IdentityCache(name='submissions')
+
+caches = (server_ids, map_ids, player_ids, submissions)
+
+
+def configure_caches(settings):
+    """
+    Applies the xonstat.cache.size and xonstat.cache.ttl settings to the
+    identity caches.
+    """
+    for cache in caches:
+        cache.maxsize = int(settings.get('xonstat.cache.size', cache.maxsize))
+        cache.ttl = int(settings.get('xonstat.cache.ttl', cache.ttl))
+        cache.clear()
+
+
+def cache_stats():
+    """
+    Returns the size and hit/miss counters of every identity cache, keyed
+    by cache name.
+    """
+    return dict((cache.name, cache.stats()) for cache in caches)
+
+
+def cached_instance(session=None, cls=None, **values):
+    """
+    Returns a persistent instance of a mapped class for a row known to
+    exist, without querying for it. Only the given column values are
+    loaded; any other attribute is fetched from the database on first
+    access. Parameters:
+
+    session - SQLAlchemy database session factory
+    cls - the mapped class (e.g. Server)
+    values - column values of the row, including its primary key
+    """
+    mapper = class_mapper(cls)
+
+    # build the instance the way a query would, bypassing __init__ so that
+    # no attribute is marked as changed
+    instance = mapper.class_manager.new_instance()
+    for (key, value) in values.items():
+        set_committed_value(instance, key, value)
+    instance_state(instance).key = mapper.identity_key_from_instance(instance)
+
+    return session.merge(instance, load=False)
+
+
+# column values of the bot and anonymous player records, loaded once and
+# kept for the life of the process since they never change
+SENTINEL_COLUMNS = ('player_id', 'nick', 'stripped_nick', 'nick_html')
+_sentinels = {}
+
+
+def sentinel_player(session=None, player_id=None):
+    """
+    Returns the Player record every bot (id 1) or every untracked player
+    (id 2) is recorded as. Only the first call in a process queries it.
+    Parameters:
+
+    session - SQLAlchemy database session factory
+    player_id - 1 or 2
+    """
+    values = _sentinels.get(player_id)
+    if values is None:
+        player = session.query(Player).filter_by(player_id=player_id).one()
+        values = dict((name, getattr(player, name))
+                for name in SENTINEL_COLUMNS)
+        _sentinels[player_id] = values
+    return cached_instance(session=session, cls=Player, **values)
+
+
+def _commit(session):
+    for cache in caches:
+        cache.commit()
+
+
+def _rollback(session):
+    for cache in caches:
+        cache.rollback()
+
+
+event.listen(DBSession, 'after_commit', _commit)
+event.listen(DBSession, 'after_rollback', _rollback)
@@ -0,0 +1,110 @@
+import calendar
+import datetime
+import hashlib
+import logging
+from sqlalchemy.exc import IntegrityError
+from xonstat.batch import load_rows
+from xonstat.cache import submissions
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+# hashes written per statement by the rebuild
+BATCH_SIZE = 10000
+
+
+class DuplicateSubmission(Exception):
+    """
+    Raised for a submission of a game that has already been recorded,
+    typically a game server retrying a POST that timed out.
+    """
+    def __init__(self, digest=None):
+        Exception.__init__(self,
+                "Submission {0} was already recorded.".format(digest))
+        self.digest = digest
+
+
+def submission_hash(game_meta):
+    """
+    Returns the hex digest identifying the game a submission describes:
+    the server, start time (T, in whole seconds), map and game type. A
+    retried POST carries the same values, even if the body differs in
+    whitespace or line endings.
+    """
+    values = []
+    for value in (game_meta['S'], int(float(game_meta['T'])),
+            game_meta['M'], game_meta['G']):
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        values.append(unicode(value))
+    return hashlib.sha1(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+
+def check_recent(game_meta):
+    """
+    Raises DuplicateSubmission if the submission was recorded recently by
+    this process, without touching the database. Returns its hash.
+    """
+    digest = submission_hash(game_meta)
+    if submissions.get(digest) is not None:
+        raise DuplicateSubmission(digest)
+    return digest
+
+
+def claim_submission(session=None, game_meta=None):
+    """
+    Records the hash of a submission before any of its game is written,
+    raising DuplicateSubmission if it was recorded before. Recently seen
+    hashes are answered from memory; otherwise the primary key of the
+    submission_hashes table decides, so there is no lookup ahead of the
+    insert. The caller commits. Parameters:
+
+    session - SQLAlchemy database session factory
+    game_meta - dictionary of game metadata from the submission
+    """
+    digest = check_recent(game_meta)
+    try:
+        session.execute(SubmissionHash.__table__.insert(),
+                {'hash':digest, 'create_dt':datetime.datetime.utcnow()})
+    except IntegrityError:
+        # committed by another request (or before the process started)
+        submissions.put(digest, True)
+        raise DuplicateSubmission(digest)
+
+    submissions.put(digest, True, staged=True)
+    return digest
+
+
+def rebuild_submission_hashes(session=None):
+    """
+    Recomputes the submission hashes of every recorded game, e.g. for the
+    games recorded before duplicates were detected. Only the first of any
+    duplicates already in the history gets a hash. The caller commits.
+    """
+    session.query(SubmissionHash).delete()
+
+    query = session.query(Server.name, Game.start_dt, Map.name,
+            Game.game_type_cd).\
+            filter(Server.server_id == Game.server_id).\
+            filter(Map.map_id == Game.map_id).\
+            order_by(Game.game_id)
+
+    create_dt = datetime.datetime.utcnow()
+    seen = set()
+    rows = []
+    for (server_name, start_dt, map_name, game_type_cd) in \
+            query.yield_per(BATCH_SIZE):
+        digest = submission_hash({'S':server_name,
+            'T':calendar.timegm(start_dt.utctimetuple()), 'M':map_name,
+            'G':game_type_cd})
+        if digest in seen:
+            continue
+        seen.add(digest)
+        rows.append({'hash':digest, 'create_dt':create_dt})
+
+    for start in range(0, len(rows), BATCH_SIZE):
+        load_rows(session=session, table=SubmissionHash.__table__,
+                rows=rows[start:start + BATCH_SIZE])
+
+    submissions.clear()
+    log.info("Rebuilt {0} submission hashes.".format(len(rows)))
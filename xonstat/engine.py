@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)
+
+# pool options that only make sense for a QueuePool
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+# SQLite pragmas applied to every new connection, by setting name
+SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size')
+
+# upper bounds (seconds) of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class CheckoutStats(object):
+    """
+    Counts pool checkouts and how long they waited for a connection, which
+    grows once every pooled connection is busy.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.buckets = [0] * len(WAIT_BUCKETS)
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            for (i, bound) in enumerate(WAIT_BUCKETS):
+                if wait <= bound:
+                    self.buckets[i] += 1
+
+    def snapshot(self):
+        """
+        Returns the counters as a dictionary. buckets holds cumulative
+        (upper bound, count) pairs.
+        """
+        with self._lock:
+            return {'checkouts':self.checkouts,
+                    'timeouts':self.timeouts,
+                    'wait_total':self.wait_total,
+                    'wait_max':self.wait_max,
+                    'buckets':zip(WAIT_BUCKETS, self.buckets)}
+
+
+checkout_stats = CheckoutStats()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long each checkout waited in
+    checkout_stats.
+    """
+    def connect(self):
+        start = time.time()
+        try:
+            conn = QueuePool.connect(self)
+        except exc.TimeoutError:
+            checkout_stats.record(time.time() - start, timed_out=True)
+            raise
+        checkout_stats.record(time.time() - start)
+        return conn
+
+
+def ping_connection(dbapi_conn, connection_record, connection_proxy):
+    """
+    Checks that a pooled connection still works before handing it out.
+    A DisconnectionError makes the pool retry with a fresh connection.
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute("select 1")
+    except Exception as e:
+        log.warn("Discarding dead pooled connection: {0}".format(e))
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def sqlite_pragmas(settings):
+    """
+    Returns the (name, value) pairs of the xonstat.sqlite.* pragmas that
+    are set.
+    """
+    return [(name, settings['xonstat.sqlite.' + name])
+            for name in SQLITE_PRAGMAS
+            if settings.get('xonstat.sqlite.' + name)]
+
+
+def engine_from_settings(settings):
+    """
+    Creates the database engine from the sqlalchemy.* settings. Server
+    databases and SQLite files get a TimedQueuePool, sized by pool_size,
+    max_overflow, pool_timeout and pool_recycle. SQLite connections get the
+    xonstat.sqlite.* pragmas and, with xonstat.db.pre_ping, every checkout
+    is tested first.
+    """
+    url = make_url(settings['sqlalchemy.url'])
+    sqlite = url.drivername.startswith('sqlite')
+
+    options = dict(settings)
+    extra = {}
+    if sqlite and (not url.database or url.database == ':memory:'):
+        # an in-memory database lives in a single connection
+        for name in POOL_OPTIONS:
+            options.pop('sqlalchemy.' + name, None)
+    else:
+        extra['poolclass'] = TimedQueuePool
+        if sqlite:
+            # connections move between threads through the pool
+            extra['connect_args'] = {'check_same_thread':False}
+
+    engine = engine_from_config(options, 'sqlalchemy.', **extra)
+
+    if sqlite:
+        pragmas = sqlite_pragmas(settings)
+        if pragmas:
+            def set_pragmas(dbapi_conn, connection_record):
+                cursor = dbapi_conn.cursor()
+                for (name, value) in pragmas:
+                    cursor.execute("pragma {0}={1}".format(name, value))
+                cursor.close()
+
+            event.listen(engine, 'connect', set_pragmas)
+
+    if asbool(settings.get('xonstat.db.pre_ping', False)):
+        event.listen(engine, 'checkout', ping_connection)
+
+    log.info("Created {0} engine for {1} with {2}.".format(url.drivername,
+        url.database, engine.pool.__class__.__name__))
+    return engine
+
+
+def pool_status(engine=None):
+    """
+    Returns the checkout counters along with the current state of the
+    engine's pool.
+    """
+    status = checkout_stats.snapshot()
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        status.update({'size':pool.size(), 'checked_in':pool.checkedin(),
+            'checked_out':pool.checkedout(), 'overflow':pool.overflow()})
+    return status
@@ -0,0 +1,411 @@
+import calendar
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pyramid.response import Response
+from pyramid.settings import asbool
+from sqlalchemy import event
+from xonstat.models import DBSession
+
+log = logging.getLogger(__name__)
+
+# a year, the longest max-age HTTP/1.1 allows
+IMMUTABLE_MAX_AGE = 31536000
+
+
+class MemoryBackend(object):
+    """
+    Keeps rendered responses in a bounded, thread-safe LRU dictionary
+    local to the process.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None:
+                return None
+
+            self._entries[key] = item
+            return item[0]
+
+    def put(self, key, entry, tags):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskBackend(object):
+    """
+    Keeps rendered responses in a local SQLite file, so that they survive
+    restarts and are shared (and invalidated) by every process of a
+    deployment. The oldest entries are dropped beyond maxsize.
+    """
+    def __init__(self, path=None, maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        conn = self._connect()
+        try:
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("create table if not exists responses ("
+                    "key text primary key, "
+                    "body blob not null, "
+                    "content_type text, "
+                    "charset text, "
+                    "etag text not null, "
+                    "last_modified real not null, "
+                    "expires real)")
+            conn.execute("create index if not exists responses_modified_ix "
+                    "on responses (last_modified)")
+            conn.execute("create table if not exists response_tags ("
+                    "tag text not null, "
+                    "key text not null, "
+                    "primary key (tag, key))")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # losing a cached page on a crash costs nothing
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("pragma synchronous=off")
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute("select body, content_type, charset, etag, "
+                    "last_modified, expires from responses where key = ?",
+                    (key,)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        return {'body':str(row[0]), 'content_type':row[1], 'charset':row[2],
+                'etag':row[3], 'last_modified':row[4], 'expires':row[5]}
+
+    def put(self, key, entry, tags):
+        conn = self._connect()
+        try:
+            conn.execute("begin immediate")
+            conn.execute("delete from response_tags where key = ?", (key,))
+            conn.execute("insert or replace into responses (key, body, "
+                    "content_type, charset, etag, last_modified, expires) "
+                    "values (?, ?, ?, ?, ?, ?, ?)", (key,
+                        buffer(entry['body']), entry['content_type'],
+                        entry['charset'], entry['etag'],
+                        entry['last_modified'], entry['expires']))
+            conn.executemany("insert into response_tags (tag, key) "
+                    "values (?, ?)", [(tag, key) for tag in tags])
+
+            excess = conn.execute("select count(*) from responses").\
+                    fetchone()[0] - self.maxsize
+            if excess > 0:
+                self._delete(conn, [row[0] for row in conn.execute(
+                    "select key from responses order by last_modified "
+                    "limit ?", (excess,))])
+            conn.execute("commit")
+        finally:
+            conn.close()
+
+    def _delete(self, conn, keys):
+        for key in keys:
+            conn.execute("delete from responses where key = ?", (key,))
+            conn.execute("delete from response_tags where key = ?", (key,))
+
+    def invalidate(self, tags):
+        conn = self._connect()
+        try:
+            conn.execute("begin immediate")
+            keys = set()
+            for tag in tags:
+                keys.update(row[0] for row in conn.execute(
+                    "select key from response_tags where tag = ?", (tag,)))
+            self._delete(conn, keys)
+            conn.execute("commit")
+            return len(keys)
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            conn.execute("delete from responses")
+            conn.execute("delete from response_tags")
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute("select count(*) from responses").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class ResponseCache(object):
+    """
+    Caches the rendered pages of read-only views, keyed by path and query
+    string. Each page is tagged with the servers, maps and players it shows
+    and is thrown away when a submission touching one of them commits.
+    Pages that never change (a finished game) are marked immutable.
+    """
+    def __init__(self, backend=None, ttl=300, enabled=True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped by every invalidation, so that a page rendered from data
+        # older than the invalidation isn't stored after it
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the entry cached for key, or None on a miss.
+        """
+        entry = self.backend.get(key)
+        if entry is not None and entry['expires'] is not None and \
+                entry['expires'] < time.time():
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, response, tags=(), immutable=False, generation=None):
+        """
+        Caches a rendered response under key, returning the entry, or None
+        if the response was rendered before the latest invalidation.
+        """
+        now = time.time()
+        entry = {'body':response.body,
+                'content_type':response.content_type,
+                'charset':response.charset,
+                'etag':hashlib.md5(response.body).hexdigest(),
+                'last_modified':float(int(now)),
+                'expires':None if immutable else now + self.ttl}
+
+        if generation is not None and generation != self.generation:
+            return None
+
+        self.backend.put(key, entry, list(tags))
+        return entry
+
+    def invalidate(self, tags):
+        """
+        Throws away every entry carrying one of the tags.
+        """
+        with self._lock:
+            self.generation += 1
+        count = self.backend.invalidate(list(tags))
+        with self._lock:
+            self.invalidations += count
+        log.debug("Invalidated {0} cached responses.".format(count))
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.generation += 1
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size':len(self.backend), 'hits':self.hits,
+                    'misses':self.misses, 'invalidations':self.invalidations}
+
+
+response_cache = ResponseCache(backend=MemoryBackend())
+
+
+def configure_response_cache(settings):
+    """
+    Sets up the response cache from the xonstat.response_cache.* settings.
+    The backend is either memory (per process) or disk, a SQLite file at
+    xonstat.response_cache.path shared by all processes.
+    """
+    size = int(settings.get('xonstat.response_cache.size', 1000))
+    if settings.get('xonstat.response_cache.backend', 'memory') == 'disk':
+        backend = DiskBackend(path=settings['xonstat.response_cache.path'],
+                maxsize=size)
+    else:
+        backend = MemoryBackend(maxsize=size)
+
+    response_cache.backend = backend
+    response_cache.ttl = int(settings.get('xonstat.response_cache.ttl',
+        response_cache.ttl))
+    response_cache.enabled = asbool(settings.get(
+        'xonstat.response_cache.enabled', True))
+    response_cache.clear()
+
+
+def cached_response(request, entry, immutable=False, status='MISS'):
+    """
+    Builds the response for a cached entry, or a 304 Not Modified when the
+    client already has it.
+    """
+    not_modified = False
+    if request.if_none_match:
+        not_modified = entry['etag'] in request.if_none_match
+    elif request.if_modified_since is not None:
+        not_modified = calendar.timegm(
+                request.if_modified_since.utctimetuple()) >= \
+                        entry['last_modified']
+
+    if not_modified:
+        response = Response(status=304)
+        del response.content_type
+    else:
+        response = Response(body=entry['body'],
+                content_type=entry['content_type'])
+        if entry['charset']:
+            response.charset = entry['charset']
+
+    response.etag = entry['etag']
+    response.last_modified = entry['last_modified']
+    if immutable:
+        response.headers['Cache-Control'] = \
+                'public, max-age={0}, immutable'.format(IMMUTABLE_MAX_AGE)
+    else:
+        # clients revalidate every time, which costs a 304 at most
+        response.headers['Cache-Control'] = \
+                'public, max-age=0, must-revalidate'
+    response.headers['X-Cache'] = status
+    return response
+
+
+def cached_view(*tags, **kw):
+    """
+    Returns a view decorator (for add_view's decorator argument) that
+    serves the rendered page from the response cache. Parameters:
+
+    tags - names the page is invalidated by, formatted with the route's
+        matchdict, e.g. 'player:{id}'
+    immutable - whether the page never changes once it renders
+    """
+    immutable = kw.get('immutable', False)
+
+    def decorator(view):
+        def wrapper(context, request):
+            cache = response_cache
+            if not cache.enabled or request.method not in ('GET', 'HEAD'):
+                return view(context, request)
+
+            key = request.path_qs
+            entry = cache.get(key)
+            if entry is not None:
+                return cached_response(request, entry, immutable=immutable,
+                        status='HIT')
+
+            generation = cache.generation
+            response = view(context, request)
+            if response.status_int != 200:
+                return response
+
+            entry = cache.put(key, response,
+                    tags=[tag.format(**request.matchdict) for tag in tags],
+                    immutable=immutable, generation=generation)
+            if entry is None:
+                return response
+            return cached_response(request, entry, immutable=immutable)
+
+        return wrapper
+    return decorator
+
+
+_local = threading.local()
+
+
+def _staged():
+    if not hasattr(_local, 'tags'):
+        _local.tags = set()
+    return _local.tags
+
+
+def invalidate_on_commit(tags):
+    """
+    Stages tags to be invalidated once the current transaction commits, so
+    that a page can't be cached again from data that is about to change.
+    A rollback throws them away.
+    """
+    _staged().update(tags)
+
+
+def game_tags(game=None, players=None):
+    """
+    Returns the tags of the pages that change when a game is recorded: the
+    lists of games, servers, maps and players, and the pages of the game's
+    server, map and players.
+    """
+    tags = set(['games', 'server:{0}'.format(game.server_id),
+        'map:{0}'.format(game.map_id)])
+    tags.update('player:{0}'.format(player.player_id) for player in players)
+    return tags
+
+
+def _commit(session):
+    tags = _staged()
+    if tags:
+        response_cache.invalidate(tags)
+        tags.clear()
+
+
+def _rollback(session):
+    _staged().clear()
+
+
+event.listen(DBSession, 'after_commit', _commit)
+event.listen(DBSession, 'after_rollback', _rollback)
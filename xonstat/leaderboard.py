@@ -0,0 +1,45 @@
+import logging
+import sqlalchemy
+from xonstat.batch import increment_rows
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+
+def update_leaderboards(session=None, game=None):
+    """
+    Adds a newly recorded game to the leaderboard summary tables, in the
+    same transaction. The top players are ranked by rating instead (see
+    xonstat.ranking). Parameters:
+
+    session - SQLAlchemy database session factory
+    game - the Game that was recorded
+    """
+    increment_rows(session=session, table=ServerGameSummary.__table__,
+            keys=['server_id'], rows=[{'server_id':game.server_id, 'games':1}])
+
+    increment_rows(session=session, table=MapGameSummary.__table__,
+            keys=['map_id'], rows=[{'map_id':game.map_id, 'games':1}])
+
+
+def rebuild_leaderboards(session=None):
+    """
+    Recomputes the leaderboard summary tables from the games table. The
+    caller commits.
+    """
+    for cls in (ServerGameSummary, MapGameSummary):
+        session.query(cls).delete()
+
+    session.execute(sqlalchemy.text(
+        "insert into summary_server_games (server_id, games) "
+        "select server_id, count(*) "
+        "from games "
+        "group by server_id"))
+
+    session.execute(sqlalchemy.text(
+        "insert into summary_map_games (map_id, games) "
+        "select map_id, count(*) "
+        "from games "
+        "group by map_id"))
+
+    log.info("Rebuilt leaderboards.")
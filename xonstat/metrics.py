@@ -0,0 +1,314 @@
+import logging
+import threading
+import time
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the request duration histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+        10.0)
+
+# requests that matched no route (static files, 404s)
+NO_ROUTE = '-'
+
+
+class RouteStats(object):
+    """
+    Counters of the requests handled by one route. All times are seconds.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.db = 0.0
+        self.statements = 0
+        self.template = 0.0
+        self.buckets = [0] * len(REQUEST_BUCKETS)
+
+    def add(self, timer, error=False):
+        self.requests += 1
+        self.errors += int(error)
+        self.wall += timer.wall
+        self.db += timer.db
+        self.statements += timer.statements
+        self.template += timer.template
+        for (i, bound) in enumerate(REQUEST_BUCKETS):
+            if timer.wall <= bound:
+                self.buckets[i] += 1
+
+
+class RequestTimer(object):
+    """
+    What one request spent its time on, filled in while it runs.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.route = NO_ROUTE
+        self.wall = 0.0
+        self.db = 0.0
+        self.statements = 0
+        self.template = 0.0
+
+
+class Metrics(object):
+    """
+    Collects the per route request counters and the slow query count for
+    the /metrics endpoint. The timer of the request being handled by a
+    thread is kept in a thread local, where the engine and renderer hooks
+    add to it.
+    """
+    def __init__(self, slow_query=1.0):
+        self.slow_query = slow_query
+        self.slow_queries = 0
+        self.routes = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current(self):
+        """
+        Returns the timer of the request handled by this thread, if any.
+        """
+        return getattr(self._local, 'timer', None)
+
+    def start(self):
+        self._local.timer = RequestTimer()
+        return self._local.timer
+
+    def finish(self, error=False):
+        timer = self.current()
+        if timer is None:
+            return
+        self._local.timer = None
+
+        timer.wall = time.time() - timer.start
+        with self._lock:
+            if timer.route not in self.routes:
+                self.routes[timer.route] = RouteStats()
+            self.routes[timer.route].add(timer, error=error)
+
+    def query(self, statement, parameters, duration):
+        timer = self.current()
+        if timer is not None:
+            timer.db += duration
+            timer.statements += 1
+
+        if self.slow_query and duration >= self.slow_query:
+            with self._lock:
+                self.slow_queries += 1
+            log.warn("Slow query ({0:.3f}s) in {1}: {2} {3!r}".format(
+                duration, timer.route if timer else 'background', statement,
+                parameters))
+
+    def reset(self):
+        with self._lock:
+            self.slow_queries = 0
+            self.routes = {}
+
+
+metrics = Metrics()
+
+
+def configure_metrics(settings):
+    """
+    Applies the xonstat.metrics.slow_query_ms setting; 0 turns slow query
+    logging off.
+    """
+    metrics.slow_query = int(settings.get('xonstat.metrics.slow_query_ms',
+        1000)) / 1000.0
+    metrics.reset()
+
+
+def instrument_engine(engine):
+    """
+    Times every statement the engine executes, adding it to the current
+    request's timer and logging it when it is slow.
+    """
+    def before_execute(conn, cursor, statement, parameters, context,
+            executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def after_execute(conn, cursor, statement, parameters, context,
+            executemany):
+        start = conn.info['query_start'].pop()
+        metrics.query(statement, parameters, time.time() - start)
+
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+
+
+def timed_renderer(factory):
+    """
+    Wraps a renderer factory (e.g. the mako one) so that the time spent
+    rendering templates is added to the current request's timer.
+    """
+    def timed_factory(info):
+        renderer = factory(info)
+
+        def render(value, system):
+            start = time.time()
+            try:
+                return renderer(value, system)
+            finally:
+                timer = metrics.current()
+                if timer is not None:
+                    timer.template += time.time() - start
+
+        return render
+    return timed_factory
+
+
+def route_found(event):
+    """
+    ContextFound subscriber naming the route the request is timed under.
+    """
+    timer = metrics.current()
+    route = getattr(event.request, 'matched_route', None)
+    if timer is not None and route is not None:
+        timer.route = route.name
+
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware timing every request through the application,
+    including the ones that fail.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        statuses = []
+
+        def timed_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        metrics.start()
+        try:
+            result = self.app(environ, timed_start_response)
+        except:
+            metrics.finish(error=True)
+            raise
+
+        def finish(error=False):
+            metrics.finish(error=error or not statuses or
+                    statuses[0][:1] == '5')
+
+        return TimedBody(result, finish)
+
+
+class TimedBody(object):
+    """
+    The response body of a timed request. The request is timed until the
+    server closes the body, so rendering a streamed body is counted too.
+    """
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+        self.error = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.body:
+                yield chunk
+        except:
+            self.error = True
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish(error=self.error)
+
+
+def _labels(**labels):
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).\
+            replace('\\', '\\\\').replace('"', '\\"'))
+            for (name, value) in sorted(labels.items())) + '}'
+
+
+def prometheus_text(checkout=None, caches=None):
+    """
+    Renders the request counters, and optionally the pool checkout
+    counters and cache counters, in the Prometheus text exposition format.
+    Parameters:
+
+    checkout - dictionary from CheckoutStats.snapshot()
+    caches - dictionary of cache name to its stats() dictionary
+    """
+    with metrics._lock:
+        routes = sorted((name, dict(stats.__dict__))
+                for (name, stats) in metrics.routes.items())
+        slow_queries = metrics.slow_queries
+
+    lines = []
+
+    def family(name, kind, text):
+        lines.append("# HELP {0} {1}".format(name, text))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+    family('xonstat_request_duration_seconds', 'histogram',
+            'Wall time of requests, by route.')
+    for (route, stats) in routes:
+        for (bound, count) in zip(REQUEST_BUCKETS, stats['buckets']):
+            lines.append("xonstat_request_duration_seconds_bucket{0} {1}".\
+                    format(_labels(route=route, le=bound), count))
+        lines.append("xonstat_request_duration_seconds_bucket{0} {1}".\
+                format(_labels(route=route, le='+Inf'), stats['requests']))
+        lines.append("xonstat_request_duration_seconds_sum{0} {1!r}".\
+                format(_labels(route=route), stats['wall']))
+        lines.append("xonstat_request_duration_seconds_count{0} {1}".\
+                format(_labels(route=route), stats['requests']))
+
+    for (name, key, text) in (
+            ('xonstat_request_errors_total', 'errors',
+                'Requests that failed, by route.'),
+            ('xonstat_request_db_seconds_total', 'db',
+                'Time spent executing SQL statements, by route.'),
+            ('xonstat_request_statements_total', 'statements',
+                'SQL statements executed, by route.'),
+            ('xonstat_request_template_seconds_total', 'template',
+                'Time spent rendering templates, by route.')):
+        family(name, 'counter', text)
+        for (route, stats) in routes:
+            lines.append("{0}{1} {2!r}".format(name, _labels(route=route),
+                stats[key]))
+
+    family('xonstat_slow_queries_total', 'counter',
+            'SQL statements slower than xonstat.metrics.slow_query_ms.')
+    lines.append("xonstat_slow_queries_total {0}".format(slow_queries))
+
+    if checkout is not None:
+        family('xonstat_db_checkout_wait_seconds', 'histogram',
+                'Time spent waiting to check out a pooled connection.')
+        for (bound, count) in checkout['buckets']:
+            lines.append("xonstat_db_checkout_wait_seconds_bucket{0} {1}".\
+                    format(_labels(le=bound), count))
+        lines.append("xonstat_db_checkout_wait_seconds_bucket{0} {1}".format(
+            _labels(le='+Inf'), checkout['checkouts']))
+        lines.append("xonstat_db_checkout_wait_seconds_sum {0!r}".format(
+            checkout['wait_total']))
+        lines.append("xonstat_db_checkout_wait_seconds_count {0}".format(
+            checkout['checkouts']))
+
+        family('xonstat_db_checkout_timeouts_total', 'counter',
+                'Checkouts that timed out waiting for a connection.')
+        lines.append("xonstat_db_checkout_timeouts_total {0}".format(
+            checkout['timeouts']))
+
+    if caches:
+        for key in ('hits', 'misses'):
+            family('xonstat_cache_{0}_total'.format(key), 'counter',
+                    'Cache {0}, by cache.'.format(key))
+            for (name, stats) in sorted(caches.items()):
+                lines.append("xonstat_cache_{0}_total{1} {2}".format(key,
+                    _labels(cache=name), stats[key]))
+
+        family('xonstat_cache_size', 'gauge', 'Cache entries, by cache.')
+        for (name, stats) in sorted(caches.items()):
+            lines.append("xonstat_cache_size{0} {1}".format(
+                _labels(cache=name), stats['size']))
+
+    return "\n".join(lines) + "\n"
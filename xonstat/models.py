@@ -1,21 +1,39 @@
+import datetime
+import logging
 import sqlalchemy
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, Float, \
+        ForeignKey, Index, Integer, Interval, String, Table, Text, event
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from xonstat.util import strip_colors, html_colors, pretty_date
 
+log = logging.getLogger(__name__)
+
 DBSession = scoped_session(sessionmaker())
 Base = declarative_base()
 
 # define objects for all tables
 class Player(object):
 
+    def set_nick(self, nick):
+        """
+        Sets the nick along with its stripped and HTML renderings.
+        """
+        self.nick = nick
+        (self.stripped_nick, self.nick_html) = render_nick(nick)
+
     def nick_html_colors(self):
-        return html_colors(self.nick)
+        # rows written before the renderings were stored
+        if self.nick_html is None:
+            return html_colors(self.nick)
+        return self.nick_html
 
     def nick_strip_colors(self):
-        return strip_colors(self.nick)
+        if self.stripped_nick is None:
+            return strip_colors(self.nick)
+        return self.stripped_nick
 
     def __repr__(self):
         return "<Player(%s, %s, %s, %s)>" % (self.player_id, self.nick, 
@@ -88,10 +106,14 @@ class PlayerGameStat(object):
         % (self.player_id, self.game_id, self.create_dt, self.stat_type)
 
     def nick_stripped(self):
-        return strip_colors(self.nick)
+        if self.stripped_nick is None:
+            return strip_colors(self.nick)
+        return self.stripped_nick
 
     def nick_html_colors(self):
-        return html_colors(self.nick)
+        if self.nick_html is None:
+            return html_colors(self.nick)
+        return self.nick_html
 
     def team_html_color(self):
         # blue
@@ -136,41 +158,504 @@ class Hashkey(object):
         return "<Hashkey(%s, %s)>" % (self.player_id, self.hashkey)
 
 
-def initialize_db(engine=None):
+# the xonstatdb tables, declared rather than reflected so that starting a
+# process needs no schema queries (see verify_schema)
+def create_dt_column():
+    return Column('create_dt', DateTime, default=datetime.datetime.utcnow)
+
+
+players_table = Table('players', Base.metadata,
+    Column('player_id', Integer, primary_key=True),
+    Column('nick', String(64)),
+    Column('location', String(100)),
+    Column('email_addr', String(255)),
+    Column('active_ind', Boolean, default=True),
+    create_dt_column(),
+    # renderings of nick, see Player.set_nick
+    Column('stripped_nick', String(64)),
+    Column('nick_html', Text),
+)
+
+hashkeys_table = Table('hashkeys', Base.metadata,
+    Column('player_id', Integer, ForeignKey('players.player_id'),
+        nullable=False),
+    Column('hashkey', Text, primary_key=True),
+    Column('active_ind', Boolean, default=True),
+    create_dt_column(),
+)
+
+servers_table = Table('servers', Base.metadata,
+    Column('server_id', Integer, primary_key=True),
+    Column('name', String(64)),
+    Column('location', String(100)),
+    Column('ip_addr', String(50)),
+    Column('max_players', Integer),
+    Column('pure_ind', Boolean, default=True),
+    Column('revision', String(10)),
+    Column('active_ind', Boolean, default=True),
+    create_dt_column(),
+)
+
+maps_table = Table('maps', Base.metadata,
+    Column('map_id', Integer, primary_key=True),
+    Column('name', String(64)),
+    Column('version', Integer, default=1),
+    Column('pk3_name', String(100)),
+    Column('curl_url', String(1000)),
+    create_dt_column(),
+)
+
+cd_game_type_table = Table('cd_game_type', Base.metadata,
+    Column('game_type_cd', String(10), primary_key=True),
+    Column('descr', String(100)),
+    Column('active_ind', Boolean, default=True),
+)
+
+cd_weapon_table = Table('cd_weapon', Base.metadata,
+    Column('weapon_cd', String(15), primary_key=True),
+    Column('descr', String(100)),
+    Column('active_ind', Boolean, default=True),
+)
+
+cd_mutator_table = Table('cd_mutator', Base.metadata,
+    Column('mutator_cd', String(10), primary_key=True),
+    Column('name', String(20)),
+    Column('descr', String(100)),
+    Column('active_ind', Boolean, default=True),
+)
+
+cd_achievement_table = Table('cd_achievement', Base.metadata,
+    Column('achievement_cd', String(10), primary_key=True),
+    Column('descr', String(100)),
+    Column('limit', Integer),
+    Column('active_ind', Boolean, default=True),
+)
+
+achievements_table = Table('achievements', Base.metadata,
+    Column('achievement_id', Integer, primary_key=True),
+    Column('player_id', Integer, ForeignKey('players.player_id')),
+    Column('achievement_cd', String(10),
+        ForeignKey('cd_achievement.achievement_cd')),
+    create_dt_column(),
+)
+
+db_version_table = Table('db_version', Base.metadata,
+    Column('version', String(10), primary_key=True),
+    Column('descr', String(100)),
+    Column('active_ind', Boolean, default=True),
+    create_dt_column(),
+)
+
+games_table = Table('games', Base.metadata,
+    Column('game_id', Integer, primary_key=True),
+    Column('start_dt', DateTime, nullable=False),
+    Column('game_type_cd', String(10),
+        ForeignKey('cd_game_type.game_type_cd'), nullable=False),
+    Column('server_id', Integer, ForeignKey('servers.server_id'),
+        nullable=False),
+    Column('map_id', Integer, ForeignKey('maps.map_id'), nullable=False),
+    Column('duration', Interval),
+    Column('winner', Integer),
+    create_dt_column(),
+)
+
+game_mutators_table = Table('game_mutators', Base.metadata,
+    Column('game_id', Integer, ForeignKey('games.game_id'),
+        primary_key=True),
+    Column('mutator_cd', String(10), ForeignKey('cd_mutator.mutator_cd'),
+        primary_key=True),
+    create_dt_column(),
+)
+
+map_game_types_table = Table('map_game_types', Base.metadata,
+    Column('map_id', Integer, ForeignKey('maps.map_id'), primary_key=True),
+    Column('game_type_cd', String(10),
+        ForeignKey('cd_game_type.game_type_cd'), primary_key=True),
+    create_dt_column(),
+)
+
+player_game_stats_table = Table('player_game_stats', Base.metadata,
+    Column('player_game_stat_id', Integer, primary_key=True),
+    Column('player_id', Integer, ForeignKey('players.player_id'),
+        nullable=False),
+    Column('game_id', Integer, ForeignKey('games.game_id'), nullable=False),
+    Column('stat_type', String(50)),
+    Column('nick', String(64)),
+    Column('team', Integer),
+    Column('rank', Integer),
+    Column('alivetime', Interval),
+    Column('kills', Integer),
+    Column('deaths', Integer),
+    Column('suicides', Integer),
+    Column('score', Integer),
+    Column('time', Interval),
+    Column('held', Interval),
+    Column('captures', Integer),
+    Column('pickups', Integer),
+    Column('carrier_frags', Integer),
+    Column('drops', Integer),
+    Column('returns', Integer),
+    Column('collects', Integer),
+    Column('destroys', Integer),
+    Column('destroys_holding_key', Integer),
+    Column('pushes', Integer),
+    Column('pushed', Integer),
+    create_dt_column(),
+    # renderings of nick, filled in by stats_submit
+    Column('stripped_nick', String(64)),
+    Column('nick_html', Text),
+)
+
+player_weapon_stats_table = Table('player_weapon_stats', Base.metadata,
+    Column('player_weapon_stats_id', Integer, primary_key=True),
+    Column('player_id', Integer, ForeignKey('players.player_id'),
+        nullable=False),
+    Column('game_id', Integer, ForeignKey('games.game_id'), nullable=False),
+    Column('player_game_stat_id', Integer,
+        ForeignKey('player_game_stats.player_game_stat_id'),
+        nullable=False),
+    Column('weapon_cd', String(15), ForeignKey('cd_weapon.weapon_cd'),
+        nullable=False),
+    Column('actual', Integer, default=0),
+    Column('max', Integer, default=0),
+    Column('hit', Integer, default=0),
+    Column('fired', Integer, default=0),
+    Column('frags', Integer, default=0),
+    create_dt_column(),
+)
+
+# indexes the "top N", "recent games" and scoreboard queries depend on;
+# the game_id suffixes let the per-server and per-player game lists seek
+# to a page
+Index('games_start_dt_ix', games_table.c.start_dt)
+Index('games_server_id_game_id_ix', games_table.c.server_id,
+        games_table.c.game_id)
+Index('player_game_stats_player_id_game_id_ix',
+        player_game_stats_table.c.player_id, player_game_stats_table.c.game_id)
+Index('player_game_stats_game_id_ix', player_game_stats_table.c.game_id)
+Index('players_stripped_nick_ix', players_table.c.stripped_nick)
+
+# every bot is recorded as player 1 and every untracked player as player 2;
+# players above this id are the tracked ones, and only their games count
+# towards totals, activity, ratings and weapon snapshots
+LAST_SENTINEL_ID = 2
+
+
+def create_sentinel_players(target, connection, **kw):
+    """
+    Adds the players every bot and every untracked player is recorded as
+    to a freshly created players table.
+    """
+    connection.execute(players_table.insert(), [
+        {'player_id':1, 'nick':'Bot'},
+        {'player_id':2, 'nick':'Anonymous Player'}])
+
+    # the explicit ids left the serial sequence behind
+    if connection.dialect.name == 'postgresql':
+        connection.execute("select setval(pg_get_serial_sequence("
+                "'players', 'player_id'), 2)")
+
+event.listen(players_table, 'after_create', create_sentinel_players)
+
+# now map the tables and the objects together
+mapper(PlayerAchievement, achievements_table)
+mapper(Achievement, cd_achievement_table)
+mapper(GameType, cd_game_type_table)
+mapper(Mutator, cd_mutator_table)
+mapper(Weapon, cd_weapon_table)
+mapper(GameMutator, game_mutators_table)
+mapper(Game, games_table)
+mapper(Hashkey, hashkeys_table)
+mapper(MapGameType, map_game_types_table)
+mapper(Map, maps_table)
+mapper(PlayerGameStat, player_game_stats_table)
+mapper(Player, players_table)
+mapper(PlayerWeaponStat, player_weapon_stats_table)
+mapper(Server, servers_table)
+
+
+# summary tables maintained by stats_submit, created by initialize_db
+class ServerGameSummary(Base):
+    """
+    Number of games played on a server, for the top servers list.
+    """
+    __tablename__ = 'summary_server_games'
+
+    server_id = Column(Integer, primary_key=True, autoincrement=False)
+    games = Column(Integer, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return "<ServerGameSummary(%s, %s)>" % (self.server_id, self.games)
+
+
+class MapGameSummary(Base):
+    """
+    Number of games played on a map, for the top maps list.
+    """
+    __tablename__ = 'summary_map_games'
+
+    map_id = Column(Integer, primary_key=True, autoincrement=False)
+    games = Column(Integer, nullable=False, default=0, index=True)
+
+    def __repr__(self):
+        return "<MapGameSummary(%s, %s)>" % (self.map_id, self.games)
+
+
+class PlayerGameTotal(Base):
+    """
+    Totals of a player's game stats over all games, for the player page.
+    A counter stays NULL until a game reports it, like SUM() would.
+    """
+    __tablename__ = 'summary_player_games'
+
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+    games = Column(Integer, nullable=False, default=0)
+    # sum and count of the non-null ranks, for the average rank
+    rank_total = Column(BigInteger, nullable=False, default=0)
+    ranked_games = Column(Integer, nullable=False, default=0)
+    alivetime_secs = Column(BigInteger)
+    kills = Column(BigInteger)
+    deaths = Column(BigInteger)
+    suicides = Column(BigInteger)
+    score = Column(BigInteger)
+    captures = Column(BigInteger)
+    pickups = Column(BigInteger)
+    drops = Column(BigInteger)
+    returns = Column(BigInteger)
+    carrier_frags = Column(BigInteger)
+    collects = Column(BigInteger)
+    destroys = Column(BigInteger)
+    destroys_holding_key = Column(BigInteger)
+    pushes = Column(BigInteger)
+    pushed = Column(BigInteger)
+
+    def __repr__(self):
+        return "<PlayerGameTotal(%s, %s)>" % (self.player_id, self.games)
+
+
+class PlayerWeaponTotal(Base):
+    """
+    Totals of a player's accuracy stats for one weapon over all games.
+    """
+    __tablename__ = 'summary_player_weapons'
+
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+    weapon_cd = Column(String(15), primary_key=True)
+    actual = Column(BigInteger, nullable=False, default=0)
+    max = Column(BigInteger, nullable=False, default=0)
+    hit = Column(BigInteger, nullable=False, default=0)
+    fired = Column(BigInteger, nullable=False, default=0)
+    frags = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<PlayerWeaponTotal(%s, %s)>" % (self.player_id,
+                self.weapon_cd)
+
+
+class PlayerRating(Base):
+    """
+    A player's skill rating in one game type (see xonstat.rating) and the
+    rated games it is based on.
+    """
+    __tablename__ = 'player_ratings'
+
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+    game_type_cd = Column(String(10), primary_key=True)
+    rating = Column(Float, nullable=False)
+    games = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<PlayerRating(%s, %s, %s)>" % (self.player_id,
+                self.game_type_cd, self.rating)
+
+
+Index('player_ratings_game_type_cd_rating_ix',
+        PlayerRating.__table__.c.game_type_cd,
+        PlayerRating.__table__.c.rating)
+
+
+class HourlyActivity(Base):
+    """
+    Games started in an hour on a server and map with a game type, and
+    the player stats recorded for them, for the activity charts.
+    """
+    __tablename__ = 'summary_hourly_activity'
+
+    hour_dt = Column(DateTime, primary_key=True)
+    server_id = Column(Integer, primary_key=True, autoincrement=False)
+    map_id = Column(Integer, primary_key=True, autoincrement=False)
+    game_type_cd = Column(String(10), primary_key=True)
+    games = Column(Integer, nullable=False, default=0)
+    player_games = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<HourlyActivity(%s, %s, %s, %s)>" % (self.hour_dt,
+                self.server_id, self.map_id, self.game_type_cd)
+
+
+class ServerDailyActivity(Base):
+    """
+    Games started on a server in a (UTC) day and the distinct tracked
+    players that played them.
+    """
+    __tablename__ = 'summary_server_days'
+
+    day_dt = Column(Date, primary_key=True)
+    server_id = Column(Integer, primary_key=True, autoincrement=False)
+    games = Column(Integer, nullable=False, default=0)
+    players = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<ServerDailyActivity(%s, %s)>" % (self.day_dt,
+                self.server_id)
+
+
+class MapDailyActivity(Base):
+    """
+    Games started on a map in a (UTC) day and the distinct tracked players
+    that played them.
+    """
+    __tablename__ = 'summary_map_days'
+
+    day_dt = Column(Date, primary_key=True)
+    map_id = Column(Integer, primary_key=True, autoincrement=False)
+    games = Column(Integer, nullable=False, default=0)
+    players = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<MapDailyActivity(%s, %s)>" % (self.day_dt, self.map_id)
+
+
+class ServerDailyPlayer(Base):
+    """
+    A tracked player that played on a server in a day, so that the
+    players of ServerDailyActivity are only counted once.
+    """
+    __tablename__ = 'summary_server_day_players'
+
+    day_dt = Column(Date, primary_key=True)
+    server_id = Column(Integer, primary_key=True, autoincrement=False)
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class MapDailyPlayer(Base):
+    """
+    A tracked player that played on a map in a day, so that the players of
+    MapDailyActivity are only counted once.
+    """
+    __tablename__ = 'summary_map_day_players'
+
+    day_dt = Column(Date, primary_key=True)
+    map_id = Column(Integer, primary_key=True, autoincrement=False)
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+
+
+Index('summary_hourly_activity_server_id_ix',
+        HourlyActivity.__table__.c.server_id,
+        HourlyActivity.__table__.c.hour_dt)
+Index('summary_hourly_activity_map_id_ix',
+        HourlyActivity.__table__.c.map_id, HourlyActivity.__table__.c.hour_dt)
+
+
+class ImportCheckpoint(Base):
+    """
+    How many submissions of a source xonstat_import_games has loaded,
+    updated in the same transaction as every batch it commits.
+    """
+    __tablename__ = 'import_checkpoints'
+
+    source = Column(String(1000), primary_key=True)
+    position = Column(Integer, nullable=False, default=0)
+    update_dt = Column(DateTime, default=datetime.datetime.utcnow,
+            onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<ImportCheckpoint(%s, %s)>" % (self.source, self.position)
+
+
+class SubmissionHash(Base):
+    """
+    Identity of every recorded submission (see xonstat.dedup), so that a
+    game server retrying a POST doesn't record the same game twice.
+    """
+    __tablename__ = 'submission_hashes'
+
+    hash = Column(String(40), primary_key=True)
+    create_dt = Column(DateTime, nullable=False,
+            default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<SubmissionHash(%s)>" % (self.hash)
+
+
+def render_nick(nick=None):
+    """
+    Returns a tuple of the stripped and HTML renderings of a nick, which
+    are stored next to it so pages don't have to convert colour codes.
+    """
+    if nick is None:
+        return (None, None)
+    return (strip_colors(nick), html_colors(nick))
+
+
+def verify_schema(engine=None, fix=False):
+    """
+    Reflects the database and compares it to the declared tables, logging
+    every declared column and index it lacks. Returns the list of
+    problems found. Parameters:
+
+    engine - the engine of the database to check
+    fix - whether to add the missing columns and indexes
+    """
+    reflected = sqlalchemy.MetaData(bind=engine, reflect=True)
+
+    problems = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in reflected.tables:
+            problems.append("table {0} is missing".format(table.name))
+            if fix:
+                table.create(engine)
+            continue
+
+        actual = reflected.tables[table.name]
+        for column in table.c:
+            if column.name not in actual.c:
+                problems.append("column {0}.{1} is missing".format(
+                    table.name, column.name))
+                if fix:
+                    engine.execute("alter table {0} add column {1} "
+                        "{2}".format(table.name, column.name,
+                            column.type.compile(engine.dialect)))
+
+        existing = [[column.name for column in index.columns]
+                for index in actual.indexes]
+        for index in table.indexes:
+            if [column.name for column in index.columns] not in existing:
+                problems.append("index {0} is missing".format(index.name))
+                if fix:
+                    index.create(engine)
+
+    for problem in problems:
+        log.warn("Schema check: {0}.".format(problem))
+
+    return problems
+
+
+def initialize_db(engine=None, verify='off'):
+    """
+    Binds the session to an engine and creates whatever tables are
+    missing, e.g. on an empty database. Tables that exist already are left
+    alone, so the columns and indexes added to them by an upgrade are only
+    found by verify_schema. Parameters:
+
+    engine - the engine to bind to
+    verify - 'check' to reflect the database and log the columns and
+        indexes it lacks (see verify_schema), 'fix' to also add them, e.g.
+        once after an upgrade, or 'off'
+    """
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
-    MetaData = sqlalchemy.MetaData(bind=engine, reflect=True)
-
-    # assign all those tables to an object
-    achievements_table = MetaData.tables['achievements']
-    cd_achievement_table = MetaData.tables['cd_achievement']
-    cd_game_type_table = MetaData.tables['cd_game_type']
-    cd_mutator_table = MetaData.tables['cd_mutator']
-    cd_weapon_table = MetaData.tables['cd_weapon']
-    db_version_table = MetaData.tables['db_version']
-    game_mutators_table = MetaData.tables['game_mutators']
-    games_table = MetaData.tables['games']
-    hashkeys_table = MetaData.tables['hashkeys']
-    map_game_types_table = MetaData.tables['map_game_types']
-    maps_table = MetaData.tables['maps']
-    player_game_stats_table = MetaData.tables['player_game_stats']
-    players_table = MetaData.tables['players']
-    player_weapon_stats_table = MetaData.tables['player_weapon_stats']
-    servers_table = MetaData.tables['servers']
-
-    # now map the tables and the objects together
-    mapper(PlayerAchievement, achievements_table)
-    mapper(Achievement, cd_achievement_table)
-    mapper(GameType, cd_game_type_table)
-    mapper(Mutator, cd_mutator_table)
-    mapper(Weapon, cd_weapon_table)
-    mapper(GameMutator, game_mutators_table)
-    mapper(Game, games_table)
-    mapper(Hashkey, hashkeys_table)
-    mapper(MapGameType, map_game_types_table)
-    mapper(Map, maps_table)
-    mapper(PlayerGameStat, player_game_stats_table)
-    mapper(Player, players_table)
-    mapper(PlayerWeaponStat, player_weapon_stats_table)
-    mapper(Server, servers_table)
+
+    if verify in ('check', 'fix'):
+        verify_schema(engine=engine, fix=verify == 'fix')
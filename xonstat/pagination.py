@@ -0,0 +1,147 @@
+import base64
+import logging
+import sqlalchemy
+from xonstat.cache import IdentityCache
+
+log = logging.getLogger(__name__)
+
+# estimated row counts by name, refreshed every five minutes
+row_counts = IdentityCache(name='row_counts', maxsize=1000, ttl=300)
+
+
+def encode_token(key):
+    """
+    Turns the key of a boundary row into an opaque token for page links.
+    """
+    return base64.urlsafe_b64encode(str(key)).rstrip('=')
+
+
+def decode_token(token):
+    """
+    Returns the key held by a page token, or None if it isn't valid.
+    """
+    try:
+        return int(base64.urlsafe_b64decode(str(token) +
+            '=' * (-len(token) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+class KeysetPage(object):
+    """
+    A page of query results found by seeking on an indexed key instead of
+    counting and skipping rows, so every page is an index range scan. The
+    previous and next pages are addressed by tokens holding the key of the
+    first and last row, passed back as the before and after parameters.
+
+    A page number (from the old /page/N links) without a token is honoured
+    with an OFFSET, once; the links it produces are tokens again.
+    """
+    def __init__(self, query=None, key=None, key_of=None, items_per_page=20,
+            before=None, after=None, page=1, descending=True,
+            item_count=None):
+        """
+        Parameters:
+
+        query - the query to page through, without an ORDER BY
+        key - the unique column to order and seek on
+        key_of - callable returning the key value of a result row
+        items_per_page - number of rows on a page
+        before - token of the row the page ends before, if any
+        after - token of the row the page starts after, if any
+        page - page number to fall back to when there is no token
+        descending - whether the newest (highest) keys come first
+        item_count - estimated total number of rows, for display
+        """
+        self.items_per_page = items_per_page
+        self.item_count = item_count
+
+        before = decode_token(before) if before else None
+        after = decode_token(after) if after else None
+
+        # "forward" is the display order, "backward" the reverse
+        if descending:
+            (forward, backward) = (key.desc(), key.asc())
+            (past, upto) = (key.__lt__, key.__gt__)
+        else:
+            (forward, backward) = (key.asc(), key.desc())
+            (past, upto) = (key.__gt__, key.__lt__)
+
+        # one extra row tells whether there is a page beyond this one
+        limit = items_per_page + 1
+        if before is not None:
+            items = query.filter(upto(before)).order_by(backward).\
+                    limit(limit).all()
+            has_previous = len(items) > items_per_page
+            items = items[:items_per_page]
+            items.reverse()
+            has_next = True
+        else:
+            query = query.order_by(forward)
+            if after is not None:
+                query = query.filter(past(after))
+                has_previous = True
+            else:
+                try:
+                    page = max(int(page), 1)
+                except (TypeError, ValueError):
+                    page = 1
+                if page > 1:
+                    query = query.offset((page - 1) * items_per_page)
+                has_previous = page > 1
+
+            items = query.limit(limit).all()
+            has_next = len(items) > items_per_page
+            items = items[:items_per_page]
+
+        self.items = items
+        if len(items) > 0 and has_previous:
+            self.previous_token = encode_token(key_of(items[0]))
+        else:
+            self.previous_token = None
+        if len(items) > 0 and has_next:
+            self.next_token = encode_token(key_of(items[-1]))
+        else:
+            self.next_token = None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<KeysetPage(%s, %s, %s)>" % (len(self.items),
+                self.previous_token, self.next_token)
+
+
+def estimated_count(name=None, compute=None):
+    """
+    Returns a row count cached under name, calling compute for it when
+    the cached value is missing or stale. Parameters:
+
+    name - key of the count in the cache
+    compute - callable returning the count
+    """
+    count = row_counts.get(name)
+    if count is None:
+        count = int(compute() or 0)
+        row_counts.put(name, count)
+    return count
+
+
+def table_estimate(session=None, name=None):
+    """
+    Returns the planner's estimate of the rows in a table on PostgreSQL,
+    which avoids a full scan, or an exact count elsewhere.
+    """
+    if session.bind.dialect.name == 'postgresql':
+        estimate = session.execute(sqlalchemy.text(
+            "select reltuples::bigint from pg_class where relname = :name"),
+            {'name':name}).scalar()
+        # tables that were never analyzed have no estimate yet
+        if estimate is not None and estimate >= 0:
+            return estimate
+
+    return session.execute(sqlalchemy.text(
+        "select count(*) from {0}".format(name))).scalar()
@@ -0,0 +1,165 @@
+import re
+
+# single-letter keys that describe the game rather than a player
+META_KEYS = frozenset(('V', 'T', 'G', 'M', 'S', 'C', 'R', 'W'))
+
+# maps the suffix of an accuracy event (acc-<weapon_cd>-<suffix>, e.g.
+# acc-nex-cnt-fired) to the PlayerWeaponStat column
+ACCURACY_FIELDS = {
+    'cnt-fired':'fired',
+    'fired':'max',
+    'cnt-hit':'hit',
+    'hit':'actual',
+    'frags':'frags',
+}
+
+NUMBER = re.compile(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+# bots and players who don't want to be tracked are recorded as the
+# players with these ids (see xonstat.models.create_sentinel_players)
+BOT_ID = 1
+ANONYMOUS_ID = 2
+
+BOT_HASHKEY = re.compile(r'^bot#\d+$')
+UNTRACKED_HASHKEY = re.compile(r'^player#\d+$')
+
+
+def sentinel_id(hashkey):
+    """
+    Returns the id of the player a bot (bot#N) or untracked (player#N)
+    hashkey is recorded as, or None for a tracked player.
+    """
+    if BOT_HASHKEY.match(hashkey):
+        return BOT_ID
+    if UNTRACKED_HASHKEY.match(hashkey):
+        return ANONYMOUS_ID
+    return None
+
+
+class WeaponRecord(object):
+    """
+    Accuracy values of one player for one weapon, already converted to
+    integers.
+    """
+    def __init__(self, weapon_cd=None):
+        self.weapon_cd = weapon_cd
+        self.fired = None
+        self.max = None
+        self.hit = None
+        self.actual = None
+        self.frags = None
+
+    def __repr__(self):
+        return "<WeaponRecord(%s, %s, %s)>" % (self.weapon_cd, self.hit,
+                self.fired)
+
+
+class PlayerRecord(object):
+    """
+    Everything a submission says about one player: the hashkey (P), nick
+    (n), team (t), the remaining events (e) with numeric values converted
+    and the accuracy events grouped by weapon. Bots and untracked players
+    are told apart once, from the hashkey, when the record is created.
+    """
+    def __init__(self, hashkey=None):
+        self.hashkey = hashkey
+        self.sentinel_id = sentinel_id(hashkey)
+        self.bot = self.sentinel_id == BOT_ID
+        self.nick = None
+        self.team = None
+        self.events = {}
+        self.weapons = {}
+
+    def played(self):
+        """
+        Whether the player was present at the end of the game, i.e. has a
+        scoreboard entry worth recording.
+        """
+        return 'joins' in self.events and 'matches' in self.events \
+                and 'scoreboardvalid' in self.events
+
+    def __repr__(self):
+        return "<PlayerRecord(%s, %s, %s)>" % (self.hashkey, self.nick,
+                self.team)
+
+
+def convert(value):
+    """
+    Converts an event value to an int or float when it looks like one.
+    """
+    if value.isdigit():
+        return int(value)
+    if NUMBER.match(value):
+        if '.' in value or 'e' in value or 'E' in value:
+            return float(value)
+        return int(value)
+    return value
+
+
+def parse_submission(body):
+    """
+    Parses a stats submission in a single pass over its lines, returning a
+    tuple of the game metadata dictionary and a list of PlayerRecords.
+    Parameters:
+
+    body - the submission, either as a string or as a file-like object
+        (anything yielding lines)
+    """
+    if isinstance(body, basestring):
+        body = body.split('\n')
+
+    game_meta = {}
+    players = []
+    player = None
+
+    for line in body:
+        (key, sep, value) = line.strip().partition(' ')
+        # no key/value pair - move on to the next line
+        if not sep:
+            continue
+
+        if key == 'e':
+            if player is None:
+                continue
+
+            (subkey, sep, subvalue) = value.partition(' ')
+            if not sep:
+                continue
+
+            if subkey.startswith('acc-'):
+                (weapon_cd, sep, field) = subkey[4:].partition('-')
+                column = ACCURACY_FIELDS.get(field)
+            else:
+                column = None
+
+            if column is not None:
+                weapon = player.weapons.get(weapon_cd)
+                if weapon is None:
+                    weapon = player.weapons[weapon_cd] = \
+                            WeaponRecord(weapon_cd)
+                setattr(weapon, column, int(round(float(subvalue))))
+            else:
+                player.events[subkey] = convert(subvalue)
+
+        elif key == 'P':
+            player = PlayerRecord(value)
+            players.append(player)
+
+        elif key == 'n':
+            if player is not None:
+                player.nick = value
+
+        elif key == 't':
+            if player is not None:
+                player.team = convert(value)
+
+        elif key in META_KEYS:
+            game_meta[key] = value
+
+    # a weapon only counts if its shots were reported
+    for player in players:
+        for (weapon_cd, weapon) in player.weapons.items():
+            if weapon.fired is None:
+                del player.weapons[weapon_cd]
+
+    return (game_meta, players)
@@ -0,0 +1,291 @@
+"""
+In-memory leaderboards of the player ratings, one per game type, loaded
+from player_ratings and refreshed after the xonstat.rankings.ttl setting.
+"""
+import bisect
+import logging
+import threading
+import time
+import sqlalchemy.sql.functions as func
+from sqlalchemy import event
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+# rated games a player needs to be ranked by default, so that a few lucky
+# games don't top a leaderboard (the xonstat.rankings.min_games setting)
+MIN_GAMES = 10
+
+# players listed above and below a player by around()
+NEIGHBOURS = 5
+
+# keys per block of a leaderboard; a block is split in two once it holds
+# twice as many
+BLOCK_SIZE = 500
+
+
+class Leaderboard(object):
+    """
+    The ranked players of one game type, as (-rating, player_id) keys kept
+    sorted, best first, in blocks of up to twice block_size keys, and the
+    current key of every player. A Fenwick tree over the block sizes
+    counts the keys ahead of a block, so ranking a player, moving one whose
+    rating changed and finding the nth player each take a binary search
+    over the blocks, one within a block and O(log n) steps in the tree.
+    """
+    def __init__(self, game_type_cd=None, ratings=(),
+            block_size=BLOCK_SIZE):
+        self.game_type_cd = game_type_cd
+        self.load_time = time.time()
+        self.block_size = block_size
+        keys = sorted((-rating, player_id)
+                for (player_id, rating) in ratings)
+        self._blocks = [keys[i:i + block_size]
+                for i in range(0, len(keys), block_size)]
+        self._players = dict((player_id, (key, player_id))
+                for (key, player_id) in keys)
+        self._reindex()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._players)
+
+    def _reindex(self):
+        """
+        Rebuilds the block maximums and the tree after blocks were split
+        or removed.
+        """
+        self._maxes = [block[-1] for block in self._blocks]
+        self._tree = [0] * (len(self._blocks) + 1)
+        for (i, block) in enumerate(self._blocks, 1):
+            self._tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def _resize(self, i, change):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += change
+            i += i & -i
+
+    def _position(self, key):
+        """
+        Returns how many keys come before a key that is in the list.
+        """
+        i = bisect.bisect_left(self._maxes, key)
+        position = bisect.bisect_left(self._blocks[i], key)
+        while i > 0:
+            position += self._tree[i]
+            i -= i & -i
+        return position
+
+    def _insert(self, key):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._reindex()
+            return
+
+        i = min(bisect.bisect_left(self._maxes, key), len(self._blocks) - 1)
+        block = self._blocks[i]
+        bisect.insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2 * self.block_size:
+            self._blocks[i:i + 1] = [block[:self.block_size],
+                    block[self.block_size:]]
+            self._reindex()
+        else:
+            self._resize(i, 1)
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
+            self._resize(i, -1)
+        else:
+            del self._blocks[i]
+            self._reindex()
+
+    def update(self, player_id=None, rating=None):
+        """
+        Ranks a player at a (new) rating.
+        """
+        key = (-rating, player_id)
+        with self._lock:
+            old = self._players.get(player_id)
+            if old is not None:
+                self._remove(old)
+            self._insert(key)
+            self._players[player_id] = key
+
+    def rank(self, player_id=None):
+        """
+        Returns a player's rank (1 for the best), or None if the player
+        isn't ranked.
+        """
+        with self._lock:
+            key = self._players.get(player_id)
+            if key is None:
+                return None
+            return self._position(key) + 1
+
+    def _entries(self, start, stop):
+        start = max(0, start)
+        stop = min(stop, len(self._players))
+        if start >= stop:
+            return []
+
+        # find the block holding the (start + 1)th key in the tree
+        i = 0
+        offset = start
+        step = 1 << (len(self._blocks).bit_length() - 1)
+        while step:
+            if i + step < len(self._tree) and self._tree[i + step] <= offset:
+                i += step
+                offset -= self._tree[i]
+            step >>= 1
+
+        keys = []
+        while len(keys) < stop - start:
+            keys.extend(self._blocks[i][offset:offset + stop - start -
+                len(keys)])
+            i += 1
+            offset = 0
+        return [(rank, player_id, -rating) for (rank, (rating, player_id))
+                in enumerate(keys, start + 1)]
+
+    def top(self, count=10, start=0):
+        """
+        Returns the (rank, player_id, rating) of count players, from the
+        best one down or from the (start + 1)th best.
+        """
+        with self._lock:
+            return self._entries(start, start + count)
+
+    def around(self, player_id=None, count=NEIGHBOURS):
+        """
+        Returns the (rank, player_id, rating) of a player and of up to
+        count players ranked above and below them, or an empty list if the
+        player isn't ranked.
+        """
+        with self._lock:
+            key = self._players.get(player_id)
+            if key is None:
+                return []
+            i = self._position(key)
+            return self._entries(i - count, i + count + 1)
+
+
+def load_leaderboard(session=None, game_type_cd=None, min_games=MIN_GAMES):
+    """
+    Reads the players of a game type with at least min_games rated games
+    from player_ratings.
+    """
+    query = session.query(PlayerRating.player_id, PlayerRating.rating).\
+            filter(PlayerRating.game_type_cd == game_type_cd).\
+            filter(PlayerRating.games >= min_games).\
+            order_by(PlayerRating.rating.desc())
+    return Leaderboard(game_type_cd=game_type_cd, ratings=query.all())
+
+
+class Rankings(object):
+    """
+    The leaderboards of every game type, loaded as they are first asked
+    for and reloaded once older than ttl seconds (never, if ttl is 0).
+    Players are ranked once they have played min_games rated games.
+
+    Rating changes are staged per thread as games are recorded and only
+    applied to the leaderboards when the transaction commits, like the
+    identity caches of xonstat.cache.
+    """
+    def __init__(self, ttl=300, min_games=MIN_GAMES):
+        self.ttl = ttl
+        self.min_games = min_games
+        self._boards = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _staged(self):
+        if not hasattr(self._local, 'staged'):
+            self._local.staged = []
+        return self._local.staged
+
+    def leaderboard(self, session=None, game_type_cd=None):
+        """
+        Returns the Leaderboard of a game type, loading it if needed.
+        """
+        with self._lock:
+            board = self._boards.get(game_type_cd)
+        if board is None or (self.ttl and
+                board.load_time + self.ttl < time.time()):
+            board = load_leaderboard(session=session,
+                    game_type_cd=game_type_cd, min_games=self.min_games)
+            with self._lock:
+                self._boards[game_type_cd] = board
+        return board
+
+    def game_types(self, session=None):
+        """
+        Returns the game types that have ranked players, by how many.
+        """
+        return [game_type_cd for (game_type_cd, players) in
+                session.query(PlayerRating.game_type_cd, func.count()).\
+                        filter(PlayerRating.games >= self.min_games).\
+                        group_by(PlayerRating.game_type_cd).\
+                        order_by(func.count().desc(),
+                            PlayerRating.game_type_cd)]
+
+    def stage(self, game_type_cd=None, player_id=None, rating=None,
+            games=None):
+        """
+        Stages a player's new rating, applied on commit() if the player has
+        played min_games games.
+        """
+        if games >= self.min_games:
+            self._staged().append((game_type_cd, player_id, rating))
+
+    def commit(self):
+        staged = self._staged()
+        for (game_type_cd, player_id, rating) in staged:
+            with self._lock:
+                board = self._boards.get(game_type_cd)
+            # a leaderboard that isn't loaded yet will read it
+            if board is not None:
+                board.update(player_id=player_id, rating=rating)
+        del staged[:]
+
+    def rollback(self):
+        del self._staged()[:]
+
+    def clear(self):
+        self.rollback()
+        with self._lock:
+            self._boards.clear()
+
+
+rankings = Rankings()
+
+
+def configure_rankings(settings):
+    """
+    Applies the xonstat.rankings.ttl and xonstat.rankings.min_games
+    settings.
+    """
+    rankings.ttl = int(settings.get('xonstat.rankings.ttl', rankings.ttl))
+    rankings.min_games = int(settings.get('xonstat.rankings.min_games',
+        rankings.min_games))
+    rankings.clear()
+
+
+def _commit(session):
+    rankings.commit()
+
+
+def _rollback(session):
+    rankings.rollback()
+
+
+event.listen(DBSession, 'after_commit', _commit)
+event.listen(DBSession, 'after_rollback', _rollback)
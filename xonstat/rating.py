@@ -0,0 +1,374 @@
+"""
+Per game type Elo ratings of the tracked players, updated as games are
+recorded and rebuilt from the history by rebuild_ratings.
+"""
+import logging
+import sqlalchemy
+from sqlalchemy.sql.expression import bindparam
+from xonstat.batch import insert_rows, load_rows
+from xonstat.models import *
+from xonstat.ranking import rankings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# the rating every player starts from
+INITIAL_RATING = 1500.0
+
+# players move by up to K_PROVISIONAL points a game for their first
+# PROVISIONAL_GAMES games of a game type, and by up to K_ESTABLISHED after
+PROVISIONAL_GAMES = 20
+K_PROVISIONAL = 40.0
+K_ESTABLISHED = 20.0
+
+# stats read, and ratings written, by the replay at a time
+BATCH_SIZE = 10000
+
+# player pairs the vectorized replay holds in memory at a time
+PAIR_BLOCK = 1000000
+
+
+def k_factor(games):
+    if games < PROVISIONAL_GAMES:
+        return K_PROVISIONAL
+    return K_ESTABLISHED
+
+
+def placements(rows=None, winner=None):
+    """
+    Returns the finishing places of the rated players of a game (lower is
+    better), as a list in the order of the rows, or None if the game can't
+    be rated. Free for all players are placed by rank, or by score if some
+    have no rank; team players are placed by whether their team won, and
+    players without a team in a team game aren't placed (None).
+    Parameters:
+
+    rows - dictionaries of player game stat values of the rated players
+    winner - the winning team, if any
+    """
+    if any(row.get('team') is not None for row in rows):
+        # a team game nobody won says nothing about anyone's skill
+        if winner is None:
+            return None
+        winner = int(winner)
+        places = [None if row.get('team') is None else
+                (0 if row['team'] == winner else 1) for row in rows]
+        teams = set(row['team'] for row in rows
+                if row.get('team') is not None)
+        if len(teams) < 2:
+            return None
+        return places
+
+    if len(rows) < 2:
+        return None
+    if all(row.get('rank') is not None for row in rows):
+        return [row['rank'] for row in rows]
+    return [-(row.get('score') or 0) for row in rows]
+
+
+def rating_changes(ratings=None, games=None, places=None, teams=None):
+    """
+    Returns how much each player's rating changes with a game, given the
+    ratings and games played before it, the places from placements and
+    the teams, or None for players that had nobody to be compared to.
+    The game counts as a match against every opponent (everyone in free
+    for all, the other teams otherwise), and a player moves by
+    K * sum(actual - expected) / opponents with actual 1, 0.5 or 0.
+    """
+    changes = []
+    for i in range(len(ratings)):
+        total = 0.0
+        opponents = 0
+        for j in range(len(ratings)):
+            if i == j or places[i] is None or places[j] is None:
+                continue
+            if teams[i] is not None and teams[i] == teams[j]:
+                continue
+            expected = 1.0 / (1.0 + 10.0 ** ((ratings[j] - ratings[i]) /
+                400.0))
+            if places[i] < places[j]:
+                actual = 1.0
+            elif places[i] == places[j]:
+                actual = 0.5
+            else:
+                actual = 0.0
+            total += actual - expected
+            opponents += 1
+
+        if opponents == 0:
+            changes.append(None)
+        else:
+            changes.append(k_factor(games[i]) * total / opponents)
+    return changes
+
+
+def update_ratings(session=None, game=None, pgstat_rows=None):
+    """
+    Rates a newly recorded game, in the same transaction, with one query
+    for the current ratings of its players and one statement each for the
+    ratings updated and created. Parameters:
+
+    session - SQLAlchemy database session factory
+    game - the Game that was recorded
+    pgstat_rows - dictionaries of the player game stat values of the game
+    """
+    rows = [row for row in pgstat_rows
+            if row['player_id'] > LAST_SENTINEL_ID]
+    places = placements(rows=rows, winner=game.winner)
+    if places is None:
+        return
+
+    player_ids = [row['player_id'] for row in rows]
+    current = dict((row.player_id, row) for row in session.query(
+        PlayerRating.player_id, PlayerRating.rating, PlayerRating.games).\
+                filter(PlayerRating.game_type_cd == game.game_type_cd).\
+                filter(PlayerRating.player_id.in_(player_ids)))
+
+    ratings = []
+    games = []
+    for player_id in player_ids:
+        if player_id in current:
+            ratings.append(current[player_id].rating)
+            games.append(current[player_id].games)
+        else:
+            ratings.append(INITIAL_RATING)
+            games.append(0)
+
+    changes = rating_changes(ratings=ratings, games=games, places=places,
+            teams=[row.get('team') for row in rows])
+
+    updated = []
+    created = []
+    for (player_id, rating, change) in zip(player_ids, ratings, changes):
+        if change is None:
+            continue
+        if player_id in current:
+            updated.append({'k_player_id':player_id, 'v_change':change})
+            played = current[player_id].games + 1
+        else:
+            created.append({'player_id':player_id,
+                'game_type_cd':game.game_type_cd, 'rating':rating + change,
+                'games':1})
+            played = 1
+        rankings.stage(game_type_cd=game.game_type_cd, player_id=player_id,
+                rating=rating + change, games=played)
+
+    # changes are added to the stored ratings, so games of the same players
+    # committed concurrently don't undo each other's changes
+    table = PlayerRating.__table__
+    if updated:
+        session.execute(table.update().\
+                where(table.c.player_id == bindparam('k_player_id')).\
+                where(table.c.game_type_cd == game.game_type_cd).\
+                values(rating=table.c.rating + bindparam('v_change'),
+                    games=table.c.games + 1), updated)
+    insert_ratings(session=session, rows=created)
+
+
+def insert_ratings(session=None, rows=None):
+    """
+    Inserts the ratings of players' first games of a game type. A first
+    game of the same player may be committed concurrently by another
+    transaction; its row then takes this game's change (the difference to
+    INITIAL_RATING) as well, instead of the insert failing.
+    """
+    insert_rows(session=session, table=PlayerRating.__table__, rows=rows,
+            keys=['player_id', 'game_type_cd'],
+            update={'rating':'player_ratings.rating + excluded.rating - '
+                '{0!r}'.format(INITIAL_RATING),
+                'games':'player_ratings.games + excluded.games'})
+
+
+def stat_rows(session=None):
+    """
+    Yields the games in the order they were recorded, as (game type,
+    winner, rows) tuples where the rows are dictionaries holding the
+    player_id, team, rank and score of the tracked players.
+    """
+    query = session.query(Game.game_id, Game.game_type_cd, Game.winner,
+            PlayerGameStat.player_id, PlayerGameStat.team,
+            PlayerGameStat.rank, PlayerGameStat.score).\
+            filter(Game.game_id == PlayerGameStat.game_id).\
+            filter(PlayerGameStat.player_id > LAST_SENTINEL_ID).\
+            order_by(Game.game_id, PlayerGameStat.player_game_stat_id).\
+            execution_options(stream_results=True)
+
+    game = None
+    rows = []
+    for row in query.yield_per(BATCH_SIZE):
+        if game is not None and row.game_id != game.game_id:
+            yield (game.game_type_cd, game.winner, rows)
+            rows = []
+        game = row
+        rows.append({'player_id':row.player_id, 'team':row.team,
+            'rank':row.rank, 'score':row.score})
+    if game is not None:
+        yield (game.game_type_cd, game.winner, rows)
+
+
+def replay_sequential(games=None):
+    """
+    Rates the games one at a time. Returns a dictionary mapping (player_id,
+    game_type_cd) to [rating, games].
+    """
+    ratings = {}
+    for (game_type_cd, winner, rows) in games:
+        places = placements(rows=rows, winner=winner)
+        if places is None:
+            continue
+
+        current = [ratings.get((row['player_id'], game_type_cd),
+            [INITIAL_RATING, 0]) for row in rows]
+        changes = rating_changes(ratings=[rating for (rating, count)
+            in current], games=[count for (rating, count) in current],
+            places=places, teams=[row['team'] for row in rows])
+
+        for (row, (rating, count), change) in zip(rows, current, changes):
+            if change is not None:
+                ratings[(row['player_id'], game_type_cd)] = \
+                        [rating + change, count + 1]
+    return ratings
+
+
+def ranges(starts, sizes):
+    """
+    Returns the concatenated ranges starts[n] to starts[n] + sizes[n].
+    """
+    return numpy.repeat(starts - numpy.cumsum(sizes) + sizes, sizes) + \
+            numpy.arange(sizes.sum())
+
+
+def replay_vectorized(games=None):
+    """
+    Rates the games with NumPy, returning the same as replay_sequential.
+
+    A game only depends on the earlier games of its players, so the games
+    are scheduled into levels: a game's level is one more than the highest
+    level of the earlier games of any of its players. The games of a level
+    share no players and are rated together, each level with a handful of
+    array operations over the pairs of players of all its games, which
+    are generated a block of levels at a time.
+    """
+    slots = {}
+    levels = {}
+    played = {}
+    slot = []
+    place = []
+    team = []
+    k = []
+    game_level = []
+    game_start = []
+
+    for (game_type_cd, winner, rows) in games:
+        places = placements(rows=rows, winner=winner)
+        if places is None:
+            continue
+
+        rated = [(row, p) for (row, p) in zip(rows, places) if p is not None]
+        game_slots = [slots.setdefault((row['player_id'], game_type_cd),
+            len(slots)) for (row, p) in rated]
+        level = 1 + max(levels.get(s, 0) for s in game_slots)
+
+        game_level.append(level)
+        game_start.append(len(slot))
+        for ((row, p), s) in zip(rated, game_slots):
+            levels[s] = level
+            k.append(k_factor(played.get(s, 0)))
+            played[s] = played.get(s, 0) + 1
+            slot.append(s)
+            place.append(p)
+            team.append(-1 if row['team'] is None else row['team'])
+
+    ratings = numpy.empty(len(slots))
+    ratings.fill(INITIAL_RATING)
+    if not game_level:
+        return {}
+
+    # the games of each level in a row, keeping their order within it, and
+    # their players' rows in the same order
+    order = numpy.argsort(numpy.array(game_level), kind='mergesort')
+    game_level = numpy.array(game_level, dtype=numpy.int64)[order]
+    sizes = numpy.diff(numpy.append(game_start, len(slot)))[order]
+    rows = ranges(numpy.array(game_start, dtype=numpy.int64)[order], sizes)
+    starts = numpy.append(numpy.cumsum(sizes) - sizes, len(rows))
+    slot = numpy.array(slot, dtype=numpy.int64)[rows]
+    place = numpy.array(place, dtype=numpy.float64)[rows]
+    team = numpy.array(team, dtype=numpy.int64)[rows]
+    k = numpy.array(k, dtype=numpy.float64)[rows]
+
+    level_games = numpy.searchsorted(game_level, numpy.arange(1,
+        game_level[-1] + 2))
+    pair_counts = numpy.cumsum(numpy.append(0, sizes ** 2))
+
+    first = 0
+    while first < len(level_games) - 1:
+        # as many levels as fit in PAIR_BLOCK pairs, at least one
+        last = first + 1
+        while last < len(level_games) - 1 and pair_counts[
+                level_games[last + 1]] - pair_counts[level_games[first]] \
+                        <= PAIR_BLOCK:
+            last += 1
+
+        block = slice(level_games[first], level_games[last])
+        (r0, r1) = (starts[block.start], starts[block.stop])
+
+        # every player paired with every opponent in their game, the pairs
+        # grouped by the first player in row order
+        row_size = numpy.repeat(sizes[block], sizes[block])
+        i = numpy.repeat(numpy.arange(r0, r1), row_size)
+        j = ranges(numpy.repeat(starts[block], sizes[block]), row_size)
+        compared = (i != j) & ((team[i] == -1) | (team[i] != team[j]))
+        i = i[compared]
+        j = j[compared]
+
+        row_pairs = numpy.searchsorted(i, numpy.arange(r0, r1 + 1))
+        scale = k[r0:r1] / numpy.diff(row_pairs)
+        actual = (place[i] < place[j]) + 0.5 * (place[i] == place[j])
+        slot_i = slot[i]
+        slot_j = slot[j]
+
+        for level in range(first, last):
+            a = starts[level_games[level]] - r0
+            b = starts[level_games[level + 1]] - r0
+            (pa, pb) = (row_pairs[a], row_pairs[b])
+
+            expected = 1.0 / (1.0 + 10.0 ** ((ratings[slot_j[pa:pb]] -
+                ratings[slot_i[pa:pb]]) / 400.0))
+            ratings[slot[r0 + a:r0 + b]] += scale[a:b] * numpy.add.reduceat(
+                    actual[pa:pb] - expected, row_pairs[a:b] - pa)
+        first = last
+
+    result = {}
+    counts = numpy.bincount(slot, minlength=len(slots))
+    for ((player_id, game_type_cd), s) in slots.items():
+        result[(player_id, game_type_cd)] = [float(ratings[s]),
+                int(counts[s])]
+    return result
+
+
+def rebuild_ratings(session=None):
+    """
+    Recomputes the player_ratings table by replaying every game in the
+    order they were recorded. The caller commits.
+    """
+    if numpy is not None:
+        ratings = replay_vectorized(games=stat_rows(session=session))
+    else:
+        log.info("NumPy isn't installed, rating one game at a time.")
+        ratings = replay_sequential(games=stat_rows(session=session))
+
+    session.query(PlayerRating).delete()
+
+    rows = [{'player_id':player_id, 'game_type_cd':game_type_cd,
+        'rating':rating, 'games':games} for ((player_id, game_type_cd),
+            (rating, games)) in ratings.items()]
+    for start in range(0, len(rows), BATCH_SIZE):
+        load_rows(session=session, table=PlayerRating.__table__,
+                rows=rows[start:start + BATCH_SIZE])
+
+    rankings.clear()
+    log.info("Rebuilt {0} ratings.".format(len(rows)))
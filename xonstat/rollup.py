@@ -0,0 +1,101 @@
+import logging
+import sqlalchemy
+from xonstat.batch import increment_rows
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+# PlayerGameStat columns summed as they are into PlayerGameTotal
+GAME_COUNTERS = ('kills', 'deaths', 'suicides', 'score', 'captures',
+        'pickups', 'drops', 'returns', 'carrier_frags', 'collects',
+        'destroys', 'destroys_holding_key', 'pushes', 'pushed')
+
+# PlayerWeaponStat columns summed into PlayerWeaponTotal
+WEAPON_COUNTERS = ('actual', 'max', 'hit', 'fired', 'frags')
+
+
+def update_player_totals(session=None, pgstat_rows=None, pwstat_rows=None):
+    """
+    Adds the stats of a newly recorded game to the per-player totals, in the
+    same transaction. Parameters:
+
+    session - SQLAlchemy database session factory
+    pgstat_rows - list of PlayerGameStat column value dictionaries
+    pwstat_rows - list of PlayerWeaponStat column value dictionaries
+    """
+    game_rows = []
+    # the sentinel players share a row that every game would update, and
+    # nobody looks at their totals
+    for values in pgstat_rows:
+        if values['player_id'] <= LAST_SENTINEL_ID:
+            continue
+
+        row = {'player_id':values['player_id'], 'games':1,
+                'rank_total':values.get('rank') or 0,
+                'ranked_games':int(values.get('rank') is not None),
+                'alivetime_secs':None}
+        if values.get('alivetime') is not None:
+            alivetime = values['alivetime']
+            row['alivetime_secs'] = alivetime.days * 86400 + alivetime.seconds
+        for column in GAME_COUNTERS:
+            row[column] = values.get(column)
+        game_rows.append(row)
+
+    weapon_rows = []
+    for values in pwstat_rows:
+        if values['player_id'] <= LAST_SENTINEL_ID:
+            continue
+
+        row = {'player_id':values['player_id'],
+                'weapon_cd':values['weapon_cd']}
+        for column in WEAPON_COUNTERS:
+            row[column] = values.get(column)
+        weapon_rows.append(row)
+
+    increment_rows(session=session, table=PlayerGameTotal.__table__,
+            keys=['player_id'], rows=game_rows)
+    increment_rows(session=session, table=PlayerWeaponTotal.__table__,
+            keys=['player_id', 'weapon_cd'], rows=weapon_rows)
+
+
+def interval_seconds(session=None, column=None):
+    """
+    Returns SQL for the number of seconds in an interval column.
+    """
+    if session.bind.dialect.name == 'postgresql':
+        return "extract(epoch from {0})".format(column)
+
+    # SQLAlchemy stores intervals as an offset from the epoch elsewhere
+    return "strftime('%s', {0})".format(column)
+
+
+def rebuild_player_totals(session=None):
+    """
+    Recomputes the per-player totals from the player_game_stats and
+    player_weapon_stats tables. The caller commits.
+    """
+    for cls in (PlayerGameTotal, PlayerWeaponTotal):
+        session.query(cls).delete()
+
+    session.execute(sqlalchemy.text(
+        "insert into summary_player_games (player_id, games, rank_total, "
+        "ranked_games, alivetime_secs, {0}) "
+        "select player_id, count(*), coalesce(sum(rank), 0), count(rank), "
+        "sum({1}), {2} "
+        "from player_game_stats "
+        "where player_id > {3} "
+        "group by player_id".format(', '.join(GAME_COUNTERS),
+            interval_seconds(session=session, column='alivetime'),
+            ', '.join('sum({0})'.format(column)
+                for column in GAME_COUNTERS), LAST_SENTINEL_ID)))
+
+    session.execute(sqlalchemy.text(
+        "insert into summary_player_weapons (player_id, weapon_cd, {0}) "
+        "select player_id, weapon_cd, {1} "
+        "from player_weapon_stats "
+        "where player_id > {2} "
+        "group by player_id, weapon_cd".format(', '.join(WEAPON_COUNTERS),
+            ', '.join('coalesce(sum({0}), 0)'.format(column)
+                for column in WEAPON_COUNTERS), LAST_SENTINEL_ID)))
+
+    log.info("Rebuilt player totals.")
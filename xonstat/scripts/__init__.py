@@ -0,0 +1,28 @@
+import os
+from paste.deploy import appconfig
+from xonstat.engine import engine_from_settings
+from xonstat.models import initialize_db
+from xonstat.settings import validate_settings
+
+
+def load_settings(config_uri, name='XonStat'):
+    """
+    Reads the application settings from a PasteDeploy ini file, e.g.
+    development.ini. Parameters:
+
+    config_uri - path of the ini file
+    name - name of the [app:...] section holding the settings
+    """
+    return appconfig('config:' + os.path.abspath(config_uri), name=name)
+
+
+def setup_db(settings):
+    """
+    Creates the database engine from the settings and maps the models,
+    returning the engine.
+    """
+    validate_settings(settings)
+    engine = engine_from_settings(settings)
+    initialize_db(engine, verify=settings.get('xonstat.verify_schema',
+        'off').strip().lower())
+    return engine
@@ -0,0 +1,95 @@
+import logging
+import sys
+from optparse import OptionParser
+from sqlalchemy import and_, select
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.sql.expression import bindparam
+from xonstat.models import *
+from xonstat.scripts import load_settings, setup_db
+
+log = logging.getLogger(__name__)
+
+
+def backfill_nicks(session=None, cls=None, batch_size=1000):
+    """
+    Stores the stripped and HTML renderings of every nick written before
+    they were kept, committing after each batch so the work can be
+    interrupted and resumed. Returns the number of rows updated.
+    Parameters:
+
+    session - SQLAlchemy database session factory
+    cls - mapped class of the table to fill in (Player or PlayerGameStat)
+    batch_size - number of rows read and updated per transaction
+    """
+    table = class_mapper(cls).mapped_table
+    key = list(table.primary_key.columns)[0]
+
+    update = table.update().\
+            where(key == bindparam('key')).\
+            values(stripped_nick=bindparam('stripped'),
+                    nick_html=bindparam('html'))
+
+    updated = 0
+    last = None
+    while True:
+        # walk the table in key order instead of rescanning for NULLs
+        query = select([key, table.c.nick]).\
+                where(and_(table.c.nick_html == None, table.c.nick != None)).\
+                order_by(key).limit(batch_size)
+        if last is not None:
+            query = query.where(key > last)
+
+        rows = session.execute(query).fetchall()
+        if len(rows) == 0:
+            break
+
+        params = []
+        for (row_key, nick) in rows:
+            (stripped, html) = render_nick(nick)
+            params.append({'key':row_key, 'stripped':stripped,
+                'html':html})
+
+        session.execute(update, params)
+        session.commit()
+
+        updated += len(rows)
+        last = rows[-1][0]
+        log.info("Filled in {0} {1} nicks.".format(updated, table.name))
+
+    return updated
+
+
+def main(argv=sys.argv):
+    """
+    Fills in the stored nick renderings of existing players and player
+    game stats, e.g.:
+
+        xonstat_backfill_nicks production.ini --batch-size 5000
+    """
+    parser = OptionParser(usage="%prog config_uri [options]")
+    parser.add_option("--app", dest="app", default="XonStat",
+            help="name of the [app:...] section holding the settings")
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+            default=1000, help="rows updated per transaction")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("a config file is required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    setup_db(load_settings(args[0], name=options.app))
+
+    session = DBSession()
+    try:
+        for cls in (Player, PlayerGameStat):
+            backfill_nicks(session=session, cls=cls,
+                    batch_size=options.batch_size)
+    except:
+        session.rollback()
+        raise
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from optparse import OptionParser
+from xonstat.batch import MAX_PARAMS, load_rows, reserve_ids
+from xonstat.dedup import submission_hash
+from xonstat.models import *
+from xonstat.parser import parse_submission
+from xonstat.scripts import load_settings, setup_db
+from xonstat.scripts.rebuild import REBUILDERS
+from xonstat.views.submission import (player_game_stat_values,
+        player_weapon_stat_values, verify_submission)
+
+log = logging.getLogger(__name__)
+
+
+def read_directory(path):
+    """
+    Yields the submission bodies stored one per file under a directory,
+    in a stable (sorted) order.
+    """
+    for (directory, subdirectories, files) in os.walk(path):
+        subdirectories.sort()
+        for name in sorted(files):
+            with open(os.path.join(directory, name), 'rb') as f:
+                yield f.read()
+
+
+def read_jsonl(path):
+    """
+    Yields the submission bodies of a JSONL file, one per line, either as
+    a JSON string or as an object with a "body" member.
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            value = json.loads(line)
+            if isinstance(value, dict):
+                value = value['body']
+            yield value.encode('utf-8')
+
+
+def parse(body):
+    """
+    Parses and verifies one submission, in a worker process. Returns the
+    game metadata and PlayerRecords, or the reason it was rejected.
+    """
+    try:
+        (game_meta, players) = parse_submission(body)
+        verify_submission(game_meta=game_meta, players=players)
+        return (game_meta, players)
+    except Exception as e:
+        return str(e)
+
+
+class Importer(object):
+    """
+    Writes parsed games straight into the tables with a few bulk loads per
+    batch. Servers, maps and players are resolved against dictionaries
+    read from the database once, so nothing is looked up per game. Only
+    one importer (and no stats_submit) may write at a time, since ids are
+    handed out by the importer itself.
+    """
+    def __init__(self, session=None):
+        self.session = session
+
+        # the lowest id wins when names are duplicated, as in stats_submit
+        self.servers = dict(session.query(Server.name, Server.server_id).\
+                order_by(Server.server_id.desc()))
+        self.maps = dict(session.query(Map.name, Map.map_id).\
+                order_by(Map.map_id.desc()))
+        self.players = dict(session.query(Hashkey.hashkey,
+            Hashkey.player_id))
+        log.info("Loaded {0} servers, {1} maps and {2} players.".format(
+            len(self.servers), len(self.maps), len(self.players)))
+
+    def resolve(self, names, known, column, new_row):
+        """
+        Adds ids for the names that aren't known yet, returning the rows
+        to insert for them.
+        """
+        new = []
+        for name in names:
+            if name not in known and name not in new:
+                new.append(name)
+
+        rows = []
+        for (name, id) in zip(new, reserve_ids(session=self.session,
+                column=column, count=len(new))):
+            known[name] = id
+            rows.append(new_row(id, name))
+        return rows
+
+    def unrecorded(self, games):
+        """
+        Returns the games of a batch that are neither recorded yet nor
+        repeated earlier in the batch, with their submission hashes.
+        """
+        digests = [submission_hash(game_meta)
+                for (game_meta, players) in games]
+
+        seen = set()
+        for start in range(0, len(digests), MAX_PARAMS):
+            seen.update(row[0] for row in self.session.query(
+                SubmissionHash.hash).filter(SubmissionHash.hash.in_(
+                    digests[start:start + MAX_PARAMS])))
+
+        unrecorded = []
+        for (digest, game) in zip(digests, games):
+            if digest not in seen:
+                seen.add(digest)
+                unrecorded.append((digest, game))
+        return unrecorded
+
+    def write(self, games):
+        """
+        Writes a batch of parsed games, given as (game_meta, players)
+        tuples, in the current transaction. Games recorded before are
+        skipped. Returns the number of games written.
+        """
+        session = self.session
+        unrecorded = self.unrecorded(games)
+        hash_rows = [{'hash':digest, 'create_dt':datetime.datetime.utcnow()}
+                for (digest, game) in unrecorded]
+        games = [game for (digest, game) in unrecorded]
+
+        server_rows = self.resolve([game_meta['S'] for (game_meta, players)
+            in games], self.servers, servers_table.c.server_id,
+            lambda id, name: {'server_id':id, 'name':name})
+        map_rows = self.resolve([game_meta['M'] for (game_meta, players)
+            in games], self.maps, maps_table.c.map_id,
+            lambda id, name: {'map_id':id, 'name':name})
+
+        nicks = {}
+        for (game_meta, players) in games:
+            for record in players:
+                if record.sentinel_id is None:
+                    nicks.setdefault(record.hashkey, record.nick)
+
+        hashkey_rows = []
+
+        def new_player(id, hashkey):
+            hashkey_rows.append({'player_id':id, 'hashkey':hashkey})
+            (stripped, html) = render_nick(nicks[hashkey])
+            return {'player_id':id, 'nick':nicks[hashkey],
+                    'stripped_nick':stripped, 'nick_html':html}
+
+        player_rows = self.resolve(nicks.keys(), self.players,
+                players_table.c.player_id, new_player)
+
+        # players sent without a nick are recorded under the one stored
+        # with them, as in stats_submit
+        player_nicks = dict((row['player_id'], row['nick'])
+                for row in player_rows)
+        unnamed = set()
+        for (game_meta, players) in games:
+            for record in players:
+                if record.played() and record.nick is None:
+                    unnamed.add(record.sentinel_id or
+                            self.players[record.hashkey])
+        unnamed = list(unnamed.difference(player_nicks))
+        for start in range(0, len(unnamed), MAX_PARAMS):
+            player_nicks.update(session.query(Player.player_id,
+                Player.nick).filter(Player.player_id.in_(
+                    unnamed[start:start + MAX_PARAMS])))
+
+        game_ids = reserve_ids(session=session, column=games_table.c.game_id,
+                count=len(games))
+        pgstat_ids = iter(reserve_ids(session=session,
+            column=player_game_stats_table.c.player_game_stat_id,
+            count=sum(len([record for record in players if record.played()])
+                for (game_meta, players) in games)))
+
+        game_rows = []
+        pgstat_rows = []
+        pwstat_rows = []
+        for (game_id, (game_meta, players)) in zip(game_ids, games):
+            game = Game(start_dt=datetime.datetime(
+                    *time.gmtime(float(game_meta['T']))[:6]),
+                game_type_cd=game_meta['G'],
+                server_id=self.servers[game_meta['S']],
+                map_id=self.maps[game_meta['M']],
+                winner=game_meta.get('W'))
+            game.game_id = game_id
+            game_rows.append({'game_id':game_id, 'start_dt':game.start_dt,
+                'game_type_cd':game.game_type_cd,
+                'server_id':game.server_id, 'map_id':game.map_id,
+                'winner':game.winner})
+
+            for record in players:
+                if not record.played():
+                    continue
+
+                player = Player()
+                player.player_id = record.sentinel_id or \
+                        self.players[record.hashkey]
+                player.nick = player_nicks.get(player.player_id)
+
+                values = player_game_stat_values(player=player, game=game,
+                        record=record)
+                values['player_game_stat_id'] = pgstat_ids.next()
+                pgstat_rows.append(values)
+
+                if not record.bot:
+                    for weapon_values in player_weapon_stat_values(
+                            player=player, game=game, record=record):
+                        weapon_values['player_game_stat_id'] = \
+                                values['player_game_stat_id']
+                        pwstat_rows.append(weapon_values)
+
+        for (table, rows) in ((SubmissionHash.__table__, hash_rows),
+                (servers_table, server_rows),
+                (maps_table, map_rows), (players_table, player_rows),
+                (hashkeys_table, hashkey_rows), (games_table, game_rows),
+                (player_game_stats_table, pgstat_rows),
+                (player_weapon_stats_table, pwstat_rows)):
+            load_rows(session=session, table=table, rows=rows)
+
+        return len(games)
+
+
+def main(argv=sys.argv):
+    """
+    Loads archived submissions into the database in bulk, much faster than
+    posting them to stats_submit one by one, e.g.:
+
+        xonstat_import_games production.ini submissions.jsonl
+
+    The source is a directory holding one submission per file or a JSONL
+    file. Progress is checkpointed with every batch, so running the same
+    command again resumes after the last batch that was committed. The
+    summary tables are rebuilt at the end.
+    """
+    parser = OptionParser(usage="%prog config_uri source [options]")
+    parser.add_option("--app", dest="app", default="XonStat",
+            help="name of the [app:...] section holding the settings")
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+            default=500, help="games written per transaction")
+    parser.add_option("--processes", dest="processes", type="int",
+            default=multiprocessing.cpu_count(),
+            help="number of parsing processes")
+    parser.add_option("--restart", dest="restart", action="store_true",
+            default=False, help="ignore the checkpoint of the source")
+    parser.add_option("--no-rebuild", dest="rebuild", action="store_false",
+            default=True, help="don't rebuild the summary tables")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("a config file and a source are required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    setup_db(load_settings(args[0], name=options.app))
+
+    source = os.path.abspath(args[1])
+    if os.path.isdir(source):
+        bodies = read_directory(source)
+    else:
+        bodies = read_jsonl(source)
+
+    session = DBSession()
+    checkpoint = session.query(ImportCheckpoint).get(source)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(source=source, position=0)
+        session.add(checkpoint)
+    elif options.restart:
+        checkpoint.position = 0
+    elif checkpoint.position > 0:
+        log.info("Resuming after submission {0}.".format(
+            checkpoint.position))
+
+    importer = Importer(session=session)
+
+    bodies = itertools.islice(bodies, checkpoint.position, None)
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes)
+        parsed = pool.imap(parse, bodies, chunksize=16)
+    else:
+        pool = None
+        parsed = itertools.imap(parse, bodies)
+
+    start = time.time()
+    imported = 0
+    rejected = 0
+    duplicates = 0
+    try:
+        while True:
+            batch = list(itertools.islice(parsed, options.batch_size))
+            if not batch:
+                break
+
+            games = []
+            for (i, result) in enumerate(batch):
+                if isinstance(result, basestring):
+                    log.warn("Skipping submission {0}: {1}".format(
+                        checkpoint.position + i + 1, result))
+                    rejected += 1
+                else:
+                    games.append(result)
+
+            written = importer.write(games)
+            checkpoint.position += len(batch)
+            session.commit()
+
+            imported += written
+            duplicates += len(games) - written
+            log.info("Imported {0} games ({1:.0f} games/s), up to "
+                    "submission {2}.".format(imported,
+                        imported / (time.time() - start),
+                        checkpoint.position))
+    except:
+        session.rollback()
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    log.info("Imported {0} games, skipped {1} invalid and {2} duplicate "
+            "submissions.".format(imported, rejected, duplicates))
+
+    if options.rebuild and imported > 0:
+        for name in sorted(REBUILDERS.keys()):
+            log.info("Rebuilding {0}...".format(name))
+            REBUILDERS[name](session=session)
+        session.commit()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
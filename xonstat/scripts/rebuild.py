@@ -0,0 +1,59 @@
+import logging
+import sys
+from optparse import OptionParser
+from xonstat.activity import rebuild_activity
+from xonstat.dedup import rebuild_submission_hashes
+from xonstat.leaderboard import rebuild_leaderboards
+from xonstat.models import DBSession
+from xonstat.rating import rebuild_ratings
+from xonstat.rollup import rebuild_player_totals
+from xonstat.scripts import load_settings, setup_db
+
+log = logging.getLogger(__name__)
+
+# summaries that can be recomputed from the games and stats tables
+REBUILDERS = {
+    'activity':rebuild_activity,
+    'leaderboards':rebuild_leaderboards,
+    'player_totals':rebuild_player_totals,
+    'ratings':rebuild_ratings,
+    'submission_hashes':rebuild_submission_hashes,
+}
+
+
+def main(argv=sys.argv):
+    """
+    Recomputes the summary tables maintained by stats_submit from the full
+    game history, e.g. after a migration or an import:
+
+        xonstat_rebuild_summaries production.ini --only leaderboards
+    """
+    parser = OptionParser(usage="%prog config_uri [options]")
+    parser.add_option("--app", dest="app", default="XonStat",
+            help="name of the [app:...] section holding the settings")
+    parser.add_option("--only", dest="only", action="append",
+            choices=sorted(REBUILDERS.keys()),
+            help="summary to rebuild (may be repeated, default: all)")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("a config file is required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    setup_db(load_settings(args[0], name=options.app))
+
+    session = DBSession()
+    try:
+        for name in options.only or sorted(REBUILDERS.keys()):
+            log.info("Rebuilding {0}...".format(name))
+            REBUILDERS[name](session=session)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
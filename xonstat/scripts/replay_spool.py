@@ -0,0 +1,54 @@
+import logging
+import sys
+from optparse import OptionParser
+from pyramid.settings import asbool
+from xonstat.scripts import load_settings, setup_db
+from xonstat.spool import Spool, drain
+from xonstat.views.submission import record_submission
+
+log = logging.getLogger(__name__)
+
+
+def main(argv=sys.argv):
+    """
+    Records every due submission in the spool configured by an ini file,
+    e.g.:
+
+        xonstat_replay_spool production.ini --failed
+    """
+    parser = OptionParser(usage="%prog config_uri [options]")
+    parser.add_option("--app", dest="app", default="XonStat",
+            help="name of the [app:...] section holding the settings")
+    parser.add_option("--failed", dest="failed", action="store_true",
+            default=False, help="also retry submissions marked as failed")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("a config file is required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    settings = load_settings(args[0], name=options.app)
+    setup_db(settings)
+
+    spool = Spool(path=settings['xonstat.spool.path'],
+            max_attempts=int(settings.get('xonstat.spool.max_attempts', 5)),
+            retry_delay=int(settings.get('xonstat.spool.retry_delay', 30)))
+
+    if options.failed:
+        log.info("Retrying {0} failed submissions.".format(
+            spool.retry_failed()))
+
+    bulk = asbool(settings.get('xonstat.bulk_submit', False))
+    (recorded, failed) = drain(spool=spool,
+            process=lambda body: record_submission(body=body, bulk=bulk))
+
+    log.info("Recorded {0} submissions, {1} failed. Left in spool: "
+            "{2}".format(recorded, failed, spool.counts()))
+
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
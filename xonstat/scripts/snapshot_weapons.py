@@ -0,0 +1,68 @@
+import logging
+import sys
+import time
+from optparse import OptionParser
+from xonstat.models import *
+from xonstat.scripts import load_settings, setup_db
+from xonstat.snapshot import (SnapshotError, WeaponSnapshot,
+        write_snapshot)
+
+log = logging.getLogger(__name__)
+
+
+def main(argv=sys.argv):
+    """
+    Writes the weapon stats into a columnar snapshot for accuracy
+    comparisons (see xonstat.snapshot), e.g. from cron:
+
+        xonstat_snapshot_weapons production.ini /var/lib/xonstat/weapons
+
+    With --report the accuracy distribution of every weapon is printed
+    from the new snapshot.
+    """
+    parser = OptionParser(usage="%prog config_uri path [options]")
+    parser.add_option("--app", dest="app", default="XonStat",
+            help="name of the [app:...] section holding the settings")
+    parser.add_option("--report", dest="report", action="store_true",
+            default=False, help="print the accuracy of every weapon")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("a config file and a snapshot path are required")
+
+    logging.basicConfig(level=logging.INFO)
+
+    setup_db(load_settings(args[0], name=options.app))
+
+    session = DBSession()
+    try:
+        write_snapshot(session=session, path=args[1])
+    except SnapshotError as e:
+        log.error(e)
+        return 1
+    finally:
+        session.rollback()
+
+    if options.report:
+        start = time.time()
+        snapshot = WeaponSnapshot(path=args[1])
+        log.info("Opened the snapshot in {0:.3f}s.".format(
+            time.time() - start))
+
+        print("%-16s %8s %8s %8s %8s" % ('weapon', 'players', 'p25', 'p50',
+            'p90'))
+        for weapon_cd in snapshot.weapons:
+            distribution = snapshot.distribution(weapon_cd=weapon_cd,
+                    percentiles=(25, 50, 90))
+            if distribution['players'] == 0:
+                continue
+            print("%-16s %8d %8.3f %8.3f %8.3f" % (weapon_cd,
+                distribution['players'],
+                distribution['percentiles'][25],
+                distribution['percentiles'][50],
+                distribution['percentiles'][90]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
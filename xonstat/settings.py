@@ -0,0 +1,99 @@
+import logging
+from pyramid.exceptions import ConfigurationError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import ArgumentError
+
+log = logging.getLogger(__name__)
+
+BOOLEANS = ('true', 'false', 'yes', 'no', 'on', 'off', 't', 'f', 'y', 'n',
+        '1', '0')
+
+
+def boolean(value):
+    if str(value).strip().lower() not in BOOLEANS:
+        raise ValueError("expected true or false")
+
+
+def integer(minimum=None):
+    def check(value):
+        if int(value) < minimum:
+            raise ValueError("must be at least {0}".format(minimum))
+    return check
+
+
+def choice(*choices):
+    def check(value):
+        if str(value).strip().lower() not in choices:
+            raise ValueError("must be one of {0}".format(', '.join(choices)))
+    return check
+
+
+def url(value):
+    try:
+        make_url(value)
+    except ArgumentError as e:
+        raise ValueError(str(e))
+
+
+# checks of the settings the application reads, by name; settings left out
+# of an ini file fall back to their defaults
+CHECKS = {
+    'sqlalchemy.url':url,
+    'sqlalchemy.pool_size':integer(1),
+    'sqlalchemy.max_overflow':integer(-1),
+    'sqlalchemy.pool_timeout':integer(1),
+    'sqlalchemy.pool_recycle':integer(-1),
+    'xonstat.db.pre_ping':boolean,
+    'xonstat.sqlite.journal_mode':choice('delete', 'truncate', 'persist',
+        'memory', 'wal', 'off'),
+    'xonstat.sqlite.synchronous':choice('off', 'normal', 'full', 'extra',
+        '0', '1', '2', '3'),
+    'xonstat.sqlite.mmap_size':integer(0),
+    'xonstat.bulk_submit':boolean,
+    'xonstat.verify_schema':choice('off', 'check', 'fix'),
+    'xonstat.cache.size':integer(1),
+    'xonstat.cache.ttl':integer(1),
+    'xonstat.metrics.enabled':boolean,
+    'xonstat.metrics.slow_query_ms':integer(0),
+    'xonstat.response_cache.enabled':boolean,
+    'xonstat.response_cache.backend':choice('memory', 'disk'),
+    'xonstat.response_cache.size':integer(1),
+    'xonstat.response_cache.ttl':integer(1),
+    'xonstat.rankings.ttl':integer(0),
+    'xonstat.rankings.min_games':integer(1),
+    'xonstat.spool.enabled':boolean,
+    'xonstat.spool.workers':integer(1),
+    'xonstat.spool.max_attempts':integer(1),
+    'xonstat.spool.retry_delay':integer(0),
+}
+
+REQUIRED = ('sqlalchemy.url',)
+
+
+def validate_settings(settings):
+    """
+    Checks the application settings before anything is started, raising a
+    ConfigurationError that lists every invalid or missing setting.
+    """
+    problems = []
+    for name in REQUIRED:
+        if not settings.get(name):
+            problems.append("{0} is required".format(name))
+
+    for (name, check) in sorted(CHECKS.items()):
+        value = settings.get(name)
+        if value is None or value == '':
+            continue
+        try:
+            check(value)
+        except ValueError as e:
+            problems.append("{0} = {1}: {2}".format(name, value, e))
+
+    if settings.get('xonstat.response_cache.backend') == 'disk' and \
+            not settings.get('xonstat.response_cache.path'):
+        problems.append("xonstat.response_cache.path is required for the "
+                "disk backend")
+
+    if problems:
+        raise ConfigurationError("Invalid settings:\n    " +
+                "\n    ".join(problems))
@@ -0,0 +1,257 @@
+"""
+Columnar weapon stat snapshots, a NumPy array per column in a directory,
+for comparing the accuracy of players. NumPy comes with the "analytics"
+extra.
+"""
+import datetime
+import json
+import logging
+import os
+import shutil
+import sqlalchemy
+from xonstat.models import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# rows read from the database at a time
+CHUNK_SIZE = 10000
+
+# integer columns copied as they are, NULL becoming 0
+VALUE_COLUMNS = ('game_id', 'hit', 'fired', 'actual', 'max', 'frags')
+
+# players need this many shots with a weapon to be compared on it, so a
+# couple of lucky hits don't top the distribution
+MIN_FIRED = 50
+
+
+class SnapshotError(Exception):
+    """
+    Raised when the weapon stats change while a snapshot is written, on
+    databases where it can't read them from a single transaction.
+    """
+    def __init__(self):
+        Exception.__init__(self, "player_weapon_stats changed while the "
+                "snapshot was written; run it again.")
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError("Weapon snapshots need NumPy; install XonStat "
+                "with the analytics extra (pip install XonStat[analytics])")
+    return numpy
+
+
+def write_snapshot(session=None, path=None):
+    """
+    Writes the weapon stats of the tracked players into a snapshot
+    directory, replacing any snapshot already there. Rows added while it
+    runs are left for the next snapshot. On PostgreSQL it reads from a
+    REPEATABLE READ transaction, so the session must not have run any
+    statement yet. Elsewhere, rows that change underneath it raise
+    SnapshotError and the old snapshot stays. Returns the number of rows
+    written. Parameters:
+
+    session - SQLAlchemy database session factory
+    path - the snapshot directory
+    """
+    # meta.json holds the row count, the weapon codes and the last row id;
+    # players.npy the sorted player ids, player.npy (int32) and weapon.npy
+    # (uint8) an index into them per row, and the VALUE_COLUMNS a file each
+    require_numpy()
+    table = player_weapon_stats_table
+
+    # the arrays are sized and keyed from the first queries, so the rows
+    # streamed afterwards must come from the same snapshot of the table
+    if session.bind.dialect.name == 'postgresql':
+        session.execute("set transaction isolation level repeatable read, "
+                "read only")
+
+    last_id = session.query(sqlalchemy.func.max(
+        table.c.player_weapon_stats_id)).scalar() or 0
+    included = sqlalchemy.and_(table.c.player_id > LAST_SENTINEL_ID,
+            table.c.player_weapon_stats_id <= last_id)
+
+    rows = session.query(sqlalchemy.func.count()).select_from(table).\
+            filter(included).scalar()
+    players = numpy.array([row[0] for row in session.query(
+        table.c.player_id).filter(included).distinct().\
+                order_by(table.c.player_id)], dtype=numpy.int32)
+    weapons = [row[0] for row in session.query(table.c.weapon_cd).\
+            filter(included).distinct().order_by(table.c.weapon_cd)]
+    weapon_index = dict((weapon_cd, i) for (i, weapon_cd)
+            in enumerate(weapons))
+
+    new_path = path.rstrip('/') + '.new'
+    if os.path.exists(new_path):
+        shutil.rmtree(new_path)
+    os.makedirs(new_path)
+
+    def column(name, dtype):
+        return numpy.lib.format.open_memmap(os.path.join(new_path,
+            name + '.npy'), mode='w+', dtype=dtype, shape=(rows,))
+
+    numpy.save(os.path.join(new_path, 'players.npy'), players)
+    columns = dict((name, column(name, numpy.int32))
+            for name in ('player',) + VALUE_COLUMNS)
+    columns['weapon'] = column('weapon', numpy.uint8)
+
+    query = session.query(*[table.c[name] for name in
+        ('player_id', 'weapon_cd') + VALUE_COLUMNS]).\
+            filter(included).\
+            order_by(table.c.player_weapon_stats_id).\
+            execution_options(stream_results=True)
+
+    start = 0
+    chunk = []
+
+    def flush(chunk, start):
+        values = zip(*chunk)
+        end = start + len(chunk)
+        player_ids = numpy.array(values[0], dtype=numpy.int32)
+        indexes = numpy.searchsorted(players, player_ids)
+        if end > rows or not (indexes < len(players)).all() or \
+                (players[indexes] != player_ids).any() or \
+                not set(values[1]).issubset(weapon_index):
+            raise SnapshotError()
+        columns['player'][start:end] = indexes
+        columns['weapon'][start:end] = [weapon_index[weapon_cd]
+                for weapon_cd in values[1]]
+        for (name, value) in zip(VALUE_COLUMNS, values[2:]):
+            columns[name][start:end] = [v or 0 for v in value]
+        return end
+
+    try:
+        for row in query.yield_per(CHUNK_SIZE):
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                start = flush(chunk, start)
+                chunk = []
+        if chunk:
+            start = flush(chunk, start)
+        if start != rows:
+            raise SnapshotError()
+
+        for array in columns.values():
+            array.flush()
+        columns.clear()
+    except SnapshotError:
+        columns.clear()
+        shutil.rmtree(new_path)
+        raise
+
+    with open(os.path.join(new_path, 'meta.json'), 'w') as f:
+        json.dump({'rows':rows, 'weapons':weapons, 'last_id':last_id,
+            'create_dt':datetime.datetime.utcnow().isoformat()}, f)
+
+    # swap the complete snapshot in for the old one
+    if os.path.exists(path):
+        old_path = path.rstrip('/') + '.old'
+        os.rename(path, old_path)
+        os.rename(new_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(new_path, path)
+
+    log.info("Wrote {0} weapon stats of {1} players to {2}.".format(rows,
+        len(players), path))
+    return rows
+
+
+class WeaponSnapshot(object):
+    """
+    A snapshot written by write_snapshot, memory-mapped. The hits and
+    shots of every player with every weapon are summed once, with a
+    single pass over the columns, when the snapshot is opened; after that
+    percentiles and distributions take a binary search or a sort of one
+    weapon's players.
+    """
+    def __init__(self, path=None, min_fired=MIN_FIRED):
+        require_numpy()
+        self.path = path
+        self.min_fired = min_fired
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.weapons = self.meta['weapons']
+        self.weapon_index = dict((weapon_cd, i) for (i, weapon_cd)
+                in enumerate(self.weapons))
+        self.players = numpy.load(os.path.join(path, 'players.npy'))
+        self.columns = dict((name, numpy.load(os.path.join(path,
+            name + '.npy'), mmap_mode='r'))
+            for name in ('player', 'weapon') + VALUE_COLUMNS)
+
+        # totals per (player, weapon), flattened to player * weapons +
+        # weapon
+        cells = len(self.players) * len(self.weapons)
+        key = self.columns['player'].astype(numpy.int64) * \
+                len(self.weapons) + self.columns['weapon']
+        self.hit = numpy.bincount(key, weights=self.columns['hit'],
+                minlength=cells).reshape(-1, len(self.weapons))
+        self.fired = numpy.bincount(key, weights=self.columns['fired'],
+                minlength=cells).reshape(-1, len(self.weapons))
+        self._sorted = {}
+
+    def accuracies(self, weapon_cd):
+        """
+        Returns the sorted accuracies (hits per shot) of the players that
+        fired a weapon at least min_fired times.
+        """
+        if weapon_cd not in self._sorted:
+            i = self.weapon_index[weapon_cd]
+            compared = self.fired[:, i] >= max(self.min_fired, 1)
+            self._sorted[weapon_cd] = numpy.sort(self.hit[compared, i] /
+                    self.fired[compared, i])
+        return self._sorted[weapon_cd]
+
+    def player_accuracy(self, player_id=None, weapon_cd=None):
+        """
+        Returns a player's accuracy with a weapon and the shots it is
+        based on, or None if the player never fired it.
+        """
+        i = numpy.searchsorted(self.players, player_id)
+        if i == len(self.players) or self.players[i] != player_id or \
+                weapon_cd not in self.weapon_index:
+            return None
+
+        j = self.weapon_index[weapon_cd]
+        if self.fired[i, j] == 0:
+            return None
+        return (self.hit[i, j] / self.fired[i, j], int(self.fired[i, j]))
+
+    def percentile(self, player_id=None, weapon_cd=None):
+        """
+        Returns the percentage of the compared players that are at most
+        as accurate with a weapon as the given player, or None if the
+        player didn't fire it min_fired times.
+        """
+        result = self.player_accuracy(player_id=player_id,
+                weapon_cd=weapon_cd)
+        if result is None or result[1] < max(self.min_fired, 1):
+            return None
+
+        accuracies = self.accuracies(weapon_cd)
+        return 100.0 * numpy.searchsorted(accuracies, result[0],
+                side='right') / len(accuracies)
+
+    def distribution(self, weapon_cd=None, percentiles=(10, 25, 50, 75, 90),
+            bins=20):
+        """
+        Returns how accurate the compared players are with a weapon: their
+        number, the accuracy at the given percentiles and a histogram of
+        the accuracies over bins equal slices of 0 to 1.
+        """
+        accuracies = self.accuracies(weapon_cd)
+        if len(accuracies) == 0:
+            return {'players':0, 'percentiles':{}, 'histogram':[0] * bins}
+
+        (histogram, edges) = numpy.histogram(accuracies, bins=bins,
+                range=(0.0, 1.0))
+        return {'players':len(accuracies),
+                'percentiles':dict(zip(percentiles, numpy.percentile(
+                    accuracies, percentiles).tolist())),
+                'histogram':histogram.tolist()}
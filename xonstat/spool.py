@@ -0,0 +1,240 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pyramid.settings import asbool
+from xonstat.views.submission import record_submission
+
+log = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    A durable queue of raw stats submissions, kept in a local SQLite
+    journal. Submissions are appended by stats_submit and removed once
+    they have been recorded in the database. A submission that keeps
+    failing is retried with an exponential backoff and finally marked as
+    failed, where it stays until it is replayed by hand.
+    """
+    def __init__(self, path=None, max_attempts=5, retry_delay=30,
+            claim_timeout=300):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        conn = self._connect()
+        try:
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("create table if not exists submissions ("
+                    "submission_id integer primary key autoincrement, "
+                    "body blob not null, "
+                    "status text not null default 'pending', "
+                    "attempts integer not null default 0, "
+                    "last_error text, "
+                    "create_dt real not null, "
+                    "next_attempt real not null)")
+            conn.execute("create index if not exists submissions_next_ix "
+                    "on submissions (status, next_attempt)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # a connection per call keeps the spool safe to share across threads
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("pragma synchronous=full")
+        return conn
+
+    def append(self, body):
+        """
+        Durably stores a raw submission body.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("insert into submissions (body, create_dt, "
+                    "next_attempt) values (?, ?, ?)", (buffer(body), now, now))
+        finally:
+            conn.close()
+
+    def claim(self):
+        """
+        Takes the oldest submission that is due, returning a tuple of its
+        id, body and number of previous attempts, or None if nothing is
+        due. A claimed submission that is neither completed nor failed
+        within claim_timeout seconds becomes due again, so submissions held
+        by a crashed worker are not lost.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("begin immediate")
+            row = conn.execute("select submission_id, body, attempts "
+                    "from submissions "
+                    "where status in ('pending', 'claimed') "
+                    "and next_attempt <= ? "
+                    "order by submission_id limit 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("update submissions set status = 'claimed', "
+                        "next_attempt = ? where submission_id = ?",
+                        (now + self.claim_timeout, row[0]))
+            conn.execute("commit")
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        return (row[0], str(row[1]), row[2])
+
+    def complete(self, submission_id):
+        """
+        Removes a submission that has been recorded.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("delete from submissions where submission_id = ?",
+                    (submission_id,))
+        finally:
+            conn.close()
+
+    def fail(self, submission_id, attempts, error):
+        """
+        Schedules a retry of a submission that could not be recorded, or
+        marks it as failed once it has used up its attempts.
+        """
+        attempts += 1
+        if attempts >= self.max_attempts:
+            status = 'failed'
+        else:
+            status = 'pending'
+
+        conn = self._connect()
+        try:
+            conn.execute("update submissions set status = ?, attempts = ?, "
+                    "last_error = ?, next_attempt = ? "
+                    "where submission_id = ?", (status, attempts,
+                        error.decode('utf-8', 'replace'),
+                        time.time() + self.retry_delay * 2 ** (attempts - 1),
+                        submission_id))
+        finally:
+            conn.close()
+
+    def retry_failed(self):
+        """
+        Makes every failed submission due again, returning how many there
+        were.
+        """
+        conn = self._connect()
+        try:
+            return conn.execute("update submissions set status = 'pending', "
+                    "attempts = 0, next_attempt = ? "
+                    "where status = 'failed'", (time.time(),)).rowcount
+        finally:
+            conn.close()
+
+    def counts(self):
+        """
+        Returns the number of spooled submissions by status.
+        """
+        conn = self._connect()
+        try:
+            return dict(conn.execute("select status, count(*) "
+                "from submissions group by status").fetchall())
+        finally:
+            conn.close()
+
+
+def drain(spool=None, process=None, stop=None):
+    """
+    Processes due submissions until the spool has none left, returning a
+    tuple of how many were recorded and how many failed. Parameters:
+
+    spool - the Spool to drain
+    process - callable recording one raw submission body
+    stop - optional threading.Event that ends the loop early when set
+    """
+    recorded = 0
+    failed = 0
+    while stop is None or not stop.is_set():
+        claimed = spool.claim()
+        if claimed is None:
+            break
+
+        (submission_id, body, attempts) = claimed
+        try:
+            process(body)
+        except Exception as e:
+            # repr keeps messages with non-ASCII text from failing again
+            log.warn("Spooled submission {0} failed (attempt {1}): "
+                    "{2!r}".format(submission_id, attempts + 1, e))
+            spool.fail(submission_id, attempts, repr(e))
+            failed += 1
+        else:
+            spool.complete(submission_id)
+            recorded += 1
+
+    return (recorded, failed)
+
+
+class SpoolWorker(threading.Thread):
+    """
+    Background thread that drains a spool, polling it when it is empty.
+    """
+    def __init__(self, spool=None, process=None, poll_interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.spool = spool
+        self.process = process
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                drain(spool=self.spool, process=self.process,
+                        stop=self.stopped)
+            except Exception as e:
+                log.error("Spool worker error: {0!r}".format(e))
+            self.stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def spool_from_settings(settings):
+    """
+    Returns the Spool configured by the xonstat.spool.* settings, or None
+    when spooling is disabled.
+    """
+    if not asbool(settings.get('xonstat.spool.enabled', False)):
+        return None
+
+    return Spool(path=settings['xonstat.spool.path'],
+            max_attempts=int(settings.get('xonstat.spool.max_attempts', 5)),
+            retry_delay=int(settings.get('xonstat.spool.retry_delay', 30)))
+
+
+def start_workers(spool=None, settings=None):
+    """
+    Starts the pool of threads that record spooled submissions, sized by
+    the xonstat.spool.workers setting. Returns the started workers.
+    """
+    bulk = asbool(settings.get('xonstat.bulk_submit', False))
+
+    def process(body):
+        record_submission(body=body, bulk=bulk)
+
+    workers = []
+    for i in range(int(settings.get('xonstat.spool.workers', 2))):
+        worker = SpoolWorker(spool=spool, process=process)
+        worker.start()
+        workers.append(worker)
+
+    log.info("Started {0} spool workers on {1}.".format(len(workers),
+        spool.path))
+    return workers
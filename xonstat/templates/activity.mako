@@ -0,0 +1,32 @@
+<%def name="activity_chart(activity)">
+
+## Parameters:
+## activity is the list of days returned by xonstat.activity.daily_activity,
+## oldest first. Each day has the following keys:
+##
+## day = the date
+## games = games started that day
+## players = distinct tracked players that day
+## peak = games started in the busiest hour of the day
+
+<%
+most_games = max([1] + [day['games'] for day in activity])
+%>
+<table class="activity" border="1" cellpadding="3">
+<thead>
+    <th>Day</th>
+    <th>Games</th>
+    <th>Players</th>
+    <th>Busiest Hour</th>
+</thead>
+% for day in reversed(activity):
+<tr>
+    <td>${day['day'].strftime('%m/%d/%Y')}</td>
+    <td><span class="bar" style="width:${int(day['games'] * 200 / most_games)}px"></span>${day['games']}</td>
+    <td>${day['players']}</td>
+    <td>${day['peak']}</td>
+</tr>
+% endfor
+</table>
+
+</%def>
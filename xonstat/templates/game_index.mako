@@ -1,5 +1,6 @@
 <%inherit file="base.mako"/>
 <%namespace file="scoreboard.mako" import="scoreboard" />
+<%namespace file="navlinks.mako" import="navlinks" />
 
 <%block name="title">
 Game Index - ${parent.title()}
@@ -39,9 +40,4 @@ Game Index - ${parent.title()}
 </div><!-- #recent-games-list -->
 % endif
 
-% if games.previous_page:
-<a href="${request.route_url("game_index_paged", page=games.previous_page)}" name="Previous Page">Previous</a>
-% endif
-% if games.next_page:
-<a href="${request.route_url("game_index_paged", page=games.next_page)}" name="Next Page">Next</a>
-% endif
+${navlinks("game_index", games, "games")}
@@ -8,30 +8,30 @@ Main Page - ${parent.title()}
 
 ##### TOP PLAYERS #####
 <h2>Top Players</h2>
-<table id="top-players">
+% if not top_players:
+<p>No ranked players yet.</p>
+% endif
+% for (game_type_cd, ranked, players) in top_players:
+<h3><a href="${request.route_url('ranking_index', game_type_cd=game_type_cd)}" title="Go to the ${game_type_cd} rankings">${game_type_cd}</a> (${'{0:,}'.format(ranked)} ranked)</h3>
+<table class="top-players">
 	<thead>
 		<tr>
 			<th>#</th>
 			<th>Nick</th>
-			<th>Score</th>
+			<th>Rating</th>
 		</tr>
 	</thead>
 	<tbody>
-	<% i = 1 %>
-	% for (player_id, nick, score) in top_players:
+	% for (rank, player_id, nick, rating) in players:
 		<tr>
-			<td>${i}</td>
-			% if player_id != '-':
+			<td>${rank}</td>
 			<td><a href="${request.route_url('player_info', id=player_id)}" title="Go to the player info page for this player">${nick|n}</a></td>
-			% else:
-			<td>${nick}</td>
-			% endif
-			<td>${score}</td>
+			<td>${rating}</td>
 		</tr>
-		<% i = i+1 %>
 	% endfor
 	</tbody>
 </table>
+% endfor
 
 ##### TOP SERVERS #####
 <h2>Top Servers</h2>
@@ -1,4 +1,5 @@
 <%inherit file="base.mako"/>
+<%namespace file="activity.mako" import="activity_chart" />
 
 <%block name="title">
 % if gmap:
@@ -18,4 +19,9 @@ ID: ${gmap.map_id} <br />
 Name: ${gmap.name} <br />
 PK3 Name: ${gmap.pk3_name} <br />
 Curl URL: ${gmap.curl_url} <br />
+
+% if activity:
+<h2>Activity</h2>
+${activity_chart(activity)}
+% endif
 % endif
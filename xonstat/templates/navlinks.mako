@@ -0,0 +1,13 @@
+## previous/next links for a KeysetPage, passing its boundary tokens back to
+## route_name; kwargs fill in the route's pattern
+<%def name="navlinks(route_name, page, noun, **kwargs)">
+% if page.item_count:
+<p class="item-count">About ${page.item_count} ${noun}.</p>
+% endif
+% if page.previous_token:
+<a href="${request.route_url(route_name, _query={'before':page.previous_token}, **kwargs)}" name="Previous Page">Previous</a>
+% endif
+% if page.next_token:
+<a href="${request.route_url(route_name, _query={'after':page.next_token}, **kwargs)}" name="Next Page">Next</a>
+% endif
+</%def>
@@ -1,4 +1,5 @@
 <%inherit file="base.mako"/>
+<%namespace file="navlinks.mako" import="navlinks" />
 
 <%block name="title">
 Player Game Index for ${player.nick_html_colors()|n} - ${parent.title()}
@@ -15,9 +16,4 @@ Player Game Index for ${player.nick_html_colors()|n} - ${parent.title()}
 <br />
 % endif
 
-% if games.previous_page:
-<a href="${request.route_url("player_game_index", player_id=player.player_id, page=games.previous_page)}" name="Previous Page">Previous</a>
-% endif
-% if games.next_page:
-<a href="${request.route_url("player_game_index", player_id=player.player_id, page=games.next_page)}" name="Next Page">Next</a>
-% endif
+${navlinks("player_game_index_default", games, "games", player_id=player.player_id)}
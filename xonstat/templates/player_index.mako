@@ -1,4 +1,5 @@
 <%inherit file="base.mako"/>
+<%namespace file="navlinks.mako" import="navlinks" />
 
 <%block name="title">
 Player Index - ${parent.title()}
@@ -25,9 +26,4 @@ Player Index - ${parent.title()}
 </table>
 % endif
 
-% if players.previous_page:
-<a href="${request.route_url("player_index_paged", page=players.previous_page)}" name="Previous Page">Previous</a>
-% endif
-% if players.next_page:
-<a href="${request.route_url("player_index_paged", page=players.next_page)}" name="Next Page">Next</a>
-% endif
+${navlinks("player_index", players, "players")}
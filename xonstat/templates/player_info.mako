@@ -36,6 +36,38 @@ ${parent.title()}
 % endif
 
 
+##### RATINGS #####
+% if ranks:
+<h2>Ratings</h2>
+<table id="player-ratings">
+	<thead>
+		<tr>
+			<th>Game Type</th>
+			<th>Rating</th>
+			<th>Games</th>
+			<th>Rank</th>
+		</tr>
+	</thead>
+	<tbody>
+	% for rank in ranks:
+		<tr>
+			<td>${rank['game_type_cd']}</td>
+			<td>${rank['rating']}</td>
+			<td>${rank['games']}</td>
+			% if rank['rank'] is not None:
+			<td><a href="${request.route_url('ranking_index', game_type_cd=rank['game_type_cd'], _query={'player':player.player_id})}" title="See the players ranked around this player">#${'{0:,}'.format(rank['rank'])} of ${'{0:,}'.format(rank['ranked'])}</a></td>
+			% elif rank['needed']:
+			<td>Unranked (${rank['needed']} more games)</td>
+			% else:
+			<td>Unranked</td>
+			% endif
+		</tr>
+	% endfor
+	</tbody>
+</table>
+% endif
+
+
 ##### STATS #####
 % if game_stats:
 <h2>Overall Game Stats</h2>
@@ -0,0 +1,38 @@
+<%inherit file="base.mako"/>
+
+<%block name="title">
+${game_type_cd} Rankings - ${parent.title()}
+</%block>
+
+% if not players:
+<h2>Sorry, no ranked ${game_type_cd} players yet. Get playing!</h2>
+
+% else:
+<h2>${game_type_cd} Rankings</h2>
+<p class="item-count">${'{0:,}'.format(ranked)} ranked players.</p>
+<table border="1">
+  <tr>
+    <th>#</th>
+    <th>Nick</th>
+    <th>Rating</th>
+  </tr>
+% for (rank, id, nick, rating) in players:
+  <tr${' class="highlight"' if id == player_id else ''|n}>
+    <td>${'{0:,}'.format(rank)}</td>
+    <td><a href="${request.route_url("player_info", id=id)}" title="Go to this player's info page">${nick|n}</a></td>
+    <td>${rating}</td>
+  </tr>
+% endfor
+</table>
+% endif
+
+% if player_id is not None:
+<a href="${request.route_url('ranking_index', game_type_cd=game_type_cd)}" name="Top Players">Top</a>
+% else:
+% if page > 1:
+<a href="${request.route_url('ranking_index', game_type_cd=game_type_cd, _query={'page':page - 1})}" name="Previous Page">Previous</a>
+% endif
+% if page < last_page:
+<a href="${request.route_url('ranking_index', game_type_cd=game_type_cd, _query={'page':page + 1})}" name="Next Page">Next</a>
+% endif
+% endif
@@ -1,4 +1,5 @@
 <%inherit file="base.mako"/>
+<%namespace file="navlinks.mako" import="navlinks" />
 
 <%block name="title">
 Server Game Index for ${server.name} - ${parent.title()}
@@ -15,9 +16,4 @@ Server Game Index for ${server.name} - ${parent.title()}
 % endfor
 % endif
 
-% if games.previous_page:
-<a href="${request.route_url("server_game_index", server_id=server.server_id, page=games.previous_page)}" name="Previous Page">Previous</a>
-% endif
-% if games.next_page:
-<a href="${request.route_url("server_game_index", server_id=server.server_id, page=games.next_page)}" name="Next Page">Next</a>
-% endif
+${navlinks("server_game_index_default", games, "games", server_id=server.server_id)}
@@ -1,4 +1,5 @@
 <%inherit file="base.mako"/>
+<%namespace file="activity.mako" import="activity_chart" />
 
 <%block name="title">
 % if server:
@@ -18,6 +19,11 @@ IP Address: ${server.ip_addr} <br />
 Revision: ${server.revision} <br />
 Created: ${server.create_dt.strftime('%m/%d/%Y at %I:%M %p')} <br />
 
+% if activity:
+<h2>Activity</h2>
+${activity_chart(activity)}
+% endif
+
 % if recent_games:
 <h2>Recent Games</h2>
 % for (game, theserver, map) in recent_games:
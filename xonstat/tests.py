@@ -1,24 +1,1534 @@
 import unittest
+from contextlib import contextmanager
 from pyramid.config import Configurator
 from pyramid import testing
+from sqlalchemy import create_engine, event
+
+_engine = None
+_statements = None
+
 
 def _initTestingDB():
-    from sqlalchemy import create_engine
-    from xonstat.models import initialize_sql
-    session = initialize_sql(create_engine('sqlite://'))
-    return session
+    global _engine
+    from xonstat.models import DBSession, initialize_db
+    if _engine is None:
+        # one in-memory database for the whole run, created from the
+        # declared tables
+        _engine = create_engine('sqlite://')
+        event.listen(_engine, 'before_cursor_execute', _record_statement)
+        initialize_db(_engine)
+    return DBSession
+
+
+def _record_statement(conn, cursor, statement, parameters, context,
+        executemany):
+    if _statements is not None:
+        _statements.append(statement)
+
+
+@contextmanager
+def captured_statements():
+    """
+    Collects the SQL statements executed inside the with block.
+    """
+    global _statements
+    _statements = []
+    try:
+        yield _statements
+    finally:
+        _statements = None
+
 
-class TestMyView(unittest.TestCase):
+class ViewTestCase(unittest.TestCase):
     def setUp(self):
+        from xonstat.pagination import row_counts
+        from xonstat.ranking import rankings
         self.config = testing.setUp()
+        self.session = _initTestingDB()()
+        row_counts.clear()
+        rankings.clear()
+
+    def tearDown(self):
+        # nothing is committed, so each test starts from an empty database
+        self.session.rollback()
+        testing.tearDown()
+
+    def add(self, *instances):
+        for instance in instances:
+            self.session.add(instance)
+        self.session.flush()
+
+    def assertLimited(self, statements, table):
+        """
+        Asserts that a statement selecting from table applies the limit in
+        the database.
+        """
+        for statement in statements:
+            sql = ' '.join(statement.lower().split())
+            if 'from ' + table in sql or ', ' + table in sql:
+                if 'limit' in sql:
+                    return
+        self.fail("no limited select from {0} in: {1}".format(table,
+            statements))
+
+
+    def assertConstantStatements(self, view, request, populate, sizes=(1, 5)):
+        """
+        N+1 detector: runs view once after each call to populate(size) and
+        asserts the number of statements it executes does not grow with the
+        number of rows.
+        """
+        counts = []
+        for size in sizes:
+            populate(size)
+            # warm up cached lookups (e.g. row count estimates) first
+            view(request)
+            with captured_statements() as statements:
+                view(request)
+            counts.append(len(statements))
+        self.assertEqual(len(set(counts)), 1, "{0} issued {1} statements "
+            "for sizes {2}".format(view.__name__, counts, sizes))
+
+
+class TestBulkSubmit(ViewTestCase):
+    BODY = "\n".join(["T 1306014455", "G ctf", "M test", "S test",
+        "P key1", "n ^1one", "t 5", "e matches 1", "e joins 1",
+        "e scoreboardvalid 1", "e rank 1", "e scoreboard-score 20",
+        "e scoreboard-kills 12", "e alivetime 600",
+        "e acc-nex-cnt-fired 20", "e acc-nex-fired 1600",
+        "e acc-nex-cnt-hit 8", "e acc-nex-hit 480", "e acc-nex-frags 6",
+        "e acc-laser-cnt-fired 50", "e acc-laser-fired 2000",
+        "e acc-laser-cnt-hit 10", "e acc-laser-hit 300",
+        "e acc-laser-frags 1",
+        "P key2", "n two", "t 14", "e matches 1", "e joins 1",
+        "e scoreboardvalid 1", "e rank 2", "e scoreboard-score 5",
+        "e alivetime 500", "e acc-nex-cnt-fired 10", "e acc-nex-fired 800",
+        "e acc-nex-cnt-hit 2", "e acc-nex-hit 120", "e acc-nex-frags 1",
+        "P bot#1", "n [BOT]bot", "t 5", "e matches 1", "e joins 1",
+        "e scoreboardvalid 1", "e rank 3", "e scoreboard-score 2",
+        "e acc-nex-cnt-fired 5", "e acc-nex-fired 400",
+        "e acc-nex-cnt-hit 1", "e acc-nex-hit 60",
+        "P key3", "n spectator", "e joins 1"])
+
+    def rows(self):
+        """
+        Returns the rows of the written tables, without their create_dt.
+        """
+        rows = []
+        for table in ('games', 'player_game_stats', 'player_weapon_stats'):
+            rows.append(sorted(sorted((key, value) for (key, value) in
+                row.items() if key != 'create_dt') for row in
+                self.session.execute("select * from " + table)))
+        return rows
+
+    def test_matches_orm(self):
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        written = []
+        for bulk in (True, False):
+            (game_meta, players) = parse_submission(self.BODY)
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=bulk)
+            written.append(self.rows())
+            self.session.rollback()
+
+        (games, pgstats, pwstats) = written[0]
+        # the spectator has no stats and the bot no weapon stats
+        self.assertEqual((len(games), len(pgstats), len(pwstats)),
+                (1, 3, 3))
+        self.assertEqual(written[0], written[1])
+
+    def test_constant_statements(self):
+        import itertools
+        from xonstat.bench import make_body
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        # every submission is a new game of new players
+        bodies = []
+        seeds = itertools.count()
+        def populate(size):
+            for i in range(2):
+                seed = next(seeds)
+                bodies.append(make_body(players=size, seed=seed,
+                    timestamp=1306014455 + seed))
+
+        def submit(request):
+            (game_meta, players) = parse_submission(bodies.pop(0))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=True)
+
+        # (up to the players whose weapon stats fit one statement, see
+        # xonstat.batch.MAX_PARAMS)
+        self.assertConstantStatements(submit, None, populate, sizes=(2, 8))
+
+
+class TestIdentityCache(ViewTestCase):
+    def test_lookups(self):
+        from xonstat.cache import IdentityCache
+        cache = IdentityCache(name='test', maxsize=2, ttl=60)
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual((cache.get('a'), cache.get('b')), (1, 2))
+        self.assertEqual(cache.stats(), {'size':2, 'hits':2, 'misses':1})
+
+        # b was used last, so a is the one evicted
+        cache.get('b')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+                (None, 2, 3))
+        self.assertEqual(cache.stats()['size'], 2)
+
+        cache.ttl = -1
+        cache.put('d', 4)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.stats(), {'size':1, 'hits':5, 'misses':3})
+
+    def test_staged_until_commit(self):
+        import threading
+        from xonstat.cache import player_ids
+        from xonstat.models import Player
+        player = Player()
+        self.add(player)
+        player_ids.put('key', player.player_id, staged=True)
+
+        # only the thread that staged it sees it
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(
+            player_ids.get('key')))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+        self.assertEqual(player_ids.get('key'), player.player_id)
+
+        # the row is gone after a rollback, and so is its id
+        self.session.rollback()
+        self.assertEqual(player_ids.get('key'), None)
+        player_ids.commit()
+        self.assertEqual(player_ids.get('key'), None)
+
+        player_ids.put('key', 3, staged=True)
+        player_ids.commit()
+        self.session.rollback()
+        self.assertEqual(player_ids.get('key'), 3)
+        player_ids.clear()
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_submission(self):
+        from xonstat.parser import parse_submission
+        (game_meta, players) = parse_submission("\n".join(["V 1",
+            "T 1306014455", "G ctf", "M stormkeep", "S server", "X ignored",
+            "e orphan 1", "P key", "n nick", "t 5", "e scoreboard-score 10",
+            "e alivetime 61.5", "e rank first", "e acc-nex-cnt-fired 20",
+            "e acc-nex-fired 400.4", "e acc-nex-cnt-hit 5",
+            "e acc-nex-hit 99.6", "e acc-nex-frags 2", "e acc-laser-hit 10",
+            "C 1", "P bot#3", "P player#7", "R 2"]))
+        # the meta keys are picked up wherever they are, unknown keys not
+        self.assertEqual(game_meta, {'V':'1', 'T':'1306014455', 'G':'ctf',
+            'M':'stormkeep', 'S':'server', 'C':'1', 'R':'2'})
+        self.assertEqual([(record.hashkey, record.sentinel_id, record.bot)
+            for record in players], [('key', None, False),
+                ('bot#3', 1, True), ('player#7', 2, False)])
+
+        record = players[0]
+        self.assertEqual((record.nick, record.team), ('nick', 5))
+        self.assertEqual(record.events, {'scoreboard-score':10,
+            'alivetime':61.5, 'rank':'first'})
+        # the laser reported no shots fired, so it is dropped
+        self.assertEqual(record.weapons.keys(), ['nex'])
+        weapon = record.weapons['nex']
+        self.assertEqual((weapon.fired, weapon.max, weapon.hit,
+            weapon.actual, weapon.frags), (20, 400, 5, 100, 2))
+
+
+class FileDBTestCase(unittest.TestCase):
+    """
+    Runs against a database file with the schema of the test database, for
+    code that commits, or works from other threads or processes.
+    """
+    def setUp(self):
+        import os
+        import tempfile
+        from xonstat.models import DBSession
         _initTestingDB()
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'stats.db')
+        self.engine = create_engine(self.url)
+        for (sql,) in _engine.execute("select sql from sqlite_master "
+                "where sql is not null").fetchall():
+            self.engine.execute(sql)
+        DBSession.remove()
+        DBSession.configure(bind=self.engine)
+
+    def tearDown(self):
+        import shutil
+        from xonstat.cache import caches
+        from xonstat.models import DBSession
+        DBSession.remove()
+        self.engine.dispose()
+        DBSession.configure(bind=_engine)
+        # the ids cached by the commits only exist in the file
+        for cache in caches:
+            cache.clear()
+        shutil.rmtree(self.directory)
+
+    def count(self, table):
+        from xonstat.models import DBSession
+        try:
+            return DBSession().execute("select count(*) from " +
+                    table).scalar()
+        finally:
+            DBSession.remove()
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from xonstat.spool import Spool
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(path=os.path.join(self.directory, 'spool.db'),
+                max_attempts=3, retry_delay=10)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def delays(self):
+        """
+        Returns the seconds until each spooled submission is due, by id.
+        """
+        import sqlite3
+        import time
+        conn = sqlite3.connect(self.spool.path)
+        try:
+            return dict((submission_id, next_attempt - time.time())
+                    for (submission_id, next_attempt) in conn.execute(
+                        "select submission_id, next_attempt "
+                        "from submissions"))
+        finally:
+            conn.close()
+
+    def make_due(self):
+        import sqlite3
+        conn = sqlite3.connect(self.spool.path)
+        try:
+            conn.execute("update submissions set next_attempt = 0")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_claim_and_complete(self):
+        self.spool.append('first')
+        self.spool.append('second')
+        (first_id, body, attempts) = self.spool.claim()
+        self.assertEqual((body, attempts), ('first', 0))
+        self.assertEqual(self.spool.claim()[1:], ('second', 0))
+        self.assertEqual(self.spool.claim(), None)
+        self.assertEqual(self.spool.counts(), {'claimed':2})
+
+        self.spool.complete(first_id)
+        self.assertEqual(self.spool.counts(), {'claimed':1})
+
+        # a claim that outlives claim_timeout is taken again
+        self.make_due()
+        self.assertEqual(self.spool.claim()[1:], ('second', 0))
+
+    def test_fail_and_retry(self):
+        self.spool.append('body')
+        for (attempt, delay) in enumerate((10, 20)):
+            (submission_id, body, attempts) = self.spool.claim()
+            self.assertEqual(attempts, attempt)
+            self.spool.fail(submission_id, attempts, 'error')
+            self.assertEqual(self.spool.counts(), {'pending':1})
+            self.assertTrue(delay - 1 < self.delays()[submission_id] <= delay)
+            self.assertEqual(self.spool.claim(), None)
+            self.make_due()
+
+        # the third failure uses up max_attempts
+        (submission_id, body, attempts) = self.spool.claim()
+        self.spool.fail(submission_id, attempts, 'error')
+        self.assertEqual(self.spool.counts(), {'failed':1})
+        self.make_due()
+        self.assertEqual(self.spool.claim(), None)
+
+        self.assertEqual(self.spool.retry_failed(), 1)
+        self.assertEqual(self.spool.claim(), (submission_id, 'body', 0))
+
+    def test_drain(self):
+        from xonstat.spool import drain
+        recorded = []
+        def process(body):
+            if body == 'bad':
+                raise Exception("can't record it")
+            recorded.append(body)
+
+        for body in ('one', 'bad', 'two'):
+            self.spool.append(body)
+        self.assertEqual(drain(spool=self.spool, process=process), (2, 1))
+        self.assertEqual(recorded, ['one', 'two'])
+        self.assertEqual(self.spool.counts(), {'pending':1})
+
+    def test_drain_non_ascii_error(self):
+        import sqlite3
+        from xonstat.spool import drain
+        def process(body):
+            raise ValueError(u"unknown map \xe9t\xe9")
+
+        self.spool.append('body')
+        self.assertEqual(drain(spool=self.spool, process=process), (0, 1))
+        conn = sqlite3.connect(self.spool.path)
+        try:
+            self.assertEqual(conn.execute("select last_error "
+                "from submissions").fetchall(),
+                [(u"ValueError(u'unknown map \\xe9t\\xe9',)",)])
+        finally:
+            conn.close()
+
+
+class TestSpoolRecording(FileDBTestCase):
+    def setUp(self):
+        import os
+        from xonstat.spool import Spool
+        FileDBTestCase.setUp(self)
+        self.config = testing.setUp()
+        self.spool = Spool(path=os.path.join(self.directory, 'spool.db'),
+                max_attempts=3, retry_delay=10)
 
     def tearDown(self):
         testing.tearDown()
+        FileDBTestCase.tearDown(self)
+
+    def test_submit_then_record(self):
+        import time
+        from xonstat.bench import make_body
+        from xonstat.spool import start_workers
+        from xonstat.views.submission import stats_submit
+        self.config.registry.spool = self.spool
+        for seed in range(2):
+            request = testing.DummyRequest()
+            request.body = make_body(players=4, timestamp=1306014455 + seed,
+                    seed=seed)
+            self.assertEqual(stats_submit(request).status, '200 OK')
+
+        # answered before anything was recorded
+        self.assertEqual(self.spool.counts(), {'pending':2})
+        self.assertEqual(self.count('games'), 0)
+
+        workers = start_workers(spool=self.spool,
+                settings={'xonstat.spool.workers':'1'})
+        try:
+            deadline = time.time() + 10
+            while self.spool.counts() and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            for worker in workers:
+                worker.stop()
+                worker.join()
+        self.assertEqual(self.spool.counts(), {})
+        self.assertEqual(self.count('games'), 2)
+
+    def replay(self, *options):
+        """
+        Runs the replay script in a process of its own, as from the command
+        line, returning its exit status.
+        """
+        import os
+        import subprocess
+        import sys
+        config = os.path.join(self.directory, 'test.ini')
+        with open(config, 'w') as f:
+            f.write("[app:XonStat]\nuse = egg:XonStat\n"
+                    "sqlalchemy.url = {0}\nxonstat.spool.path = {1}\n"
+                    "xonstat.spool.max_attempts = 3\n".format(self.url,
+                        self.spool.path))
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call([sys.executable, '-m',
+                'xonstat.scripts.replay_spool', config] + list(options),
+                cwd=os.path.dirname(os.path.dirname(__file__)),
+                stdout=devnull, stderr=devnull)
+
+    def test_replay_script(self):
+        from xonstat.bench import make_body
+        self.spool.append(make_body(players=4))
+        (submission_id, body, attempts) = self.spool.claim()
+        self.spool.fail(submission_id, 2, 'error')
+        self.spool.append('bad')
+
+        # the failed submission is only retried with --failed
+        self.assertEqual(self.replay(), 1)
+        self.assertEqual(self.spool.counts(), {'failed':1, 'pending':1})
+        self.assertEqual(self.count('games'), 0)
+
+        # the bad one waits out its backoff
+        self.assertEqual(self.replay('--failed'), 0)
+        self.assertEqual(self.spool.counts(), {'pending':1})
+        self.assertEqual(self.count('games'), 1)
+
+
+class TestReserveIds(FileDBTestCase):
+    def test_takes_write_lock(self):
+        import sqlite3
+        from sqlalchemy.orm import class_mapper
+        from xonstat.batch import reserve_ids
+        from xonstat.models import DBSession, Player
+        session = DBSession()
+        try:
+            ids = reserve_ids(session=session,
+                    column=class_mapper(Player).mapped_table.c.player_id,
+                    count=2)
+            self.assertEqual(len(ids), 2)
+
+            # nobody can insert the ids before this transaction ends
+            conn = sqlite3.connect(self.url[len('sqlite:///'):], timeout=0)
+            try:
+                self.assertRaises(sqlite3.OperationalError, conn.execute,
+                        "insert into players (player_id) values (?)",
+                        (ids[0],))
+            finally:
+                conn.close()
+        finally:
+            DBSession.remove()
+
+
+class TestLeaderboards(ViewTestCase):
+    def record_games(self):
+        from xonstat.bench import make_body
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        for (seed, server_name, map_name) in ((0, 'one', 'a'),
+                (1, 'one', 'b'), (2, 'two', 'a'), (3, 'one', 'a')):
+            (game_meta, players) = parse_submission(make_body(players=4,
+                timestamp=1306014455 + seed, seed=seed,
+                server_name=server_name, map_name=map_name))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=bool(seed % 2))
+
+    def summaries(self):
+        return (self.session.execute("select * from summary_server_games "
+            "order by server_id").fetchall(),
+            self.session.execute("select * from summary_map_games "
+            "order by map_id").fetchall())
+
+    def test_summaries_match_rebuild(self):
+        from xonstat.leaderboard import rebuild_leaderboards
+        self.record_games()
+        summaries = self.summaries()
+        (servers, maps) = summaries
+        self.assertEqual(sorted(row['games'] for row in servers), [1, 3])
+        self.assertEqual(sorted(row['games'] for row in maps), [1, 3])
+
+        rebuild_leaderboards(session=self.session)
+        self.assertEqual(self.summaries(), summaries)
+
+    def test_main_index_reads_summaries(self):
+        from xonstat.views import main_index
+        self.record_games()
+        with captured_statements() as statements:
+            info = main_index(testing.DummyRequest())
+        self.assertLimited(statements, 'summary_server_games')
+        self.assertLimited(statements, 'summary_map_games')
+
+        # nothing is counted from the games or their stats, and only the
+        # limited recent games are read from games
+        for statement in statements:
+            sql = ' '.join(statement.lower().split())
+            self.assertFalse('player_game_stats' in sql, sql)
+            self.assertFalse('group by' in sql and 'player_ratings' not in
+                    sql, sql)
+            if 'from games' in sql:
+                self.assertTrue('limit' in sql, sql)
+        self.assertEqual([(name, games) for (server_id, name, games)
+            in info['top_servers'][:3]], [('one', 3), ('two', 1),
+                ('-', '-')])
+
+
+class TestLimits(ViewTestCase):
+    def test_main_index_limits_recent_games(self):
+        from xonstat.views import main_index
+        with captured_statements() as statements:
+            info = main_index(testing.DummyRequest())
+        self.assertLimited(statements, 'games')
+        self.assertEqual(len(info['recent_games']), 32)
+
+    def test_server_info_limits_recent_games(self):
+        from xonstat.models import Server
+        from xonstat.views import server_info
+        self.add(Server(name='test'))
+        request = testing.DummyRequest()
+        request.matchdict['id'] = 1
+        with captured_statements() as statements:
+            info = server_info(request)
+        self.assertLimited(statements, 'games')
+        self.assertEqual(info['recent_games'], [])
+
+    def test_player_info_limits_recent_games(self):
+        from xonstat.models import Player
+        from xonstat.views import player_info
+        self.add(Player())
+        request = testing.DummyRequest()
+        request.matchdict['id'] = 1
+        with captured_statements() as statements:
+            info = player_info(request)
+        self.assertLimited(statements, 'player_game_stats')
+        self.assertEqual(info['recent_games'], [])
+
+
+class TestStatementCounts(ViewTestCase):
+    def add_games(self, count):
+        import datetime
+        from xonstat.models import Game, Map, PlayerGameStat, Server
+        server = Server(name='test')
+        gmap = Map(name='test')
+        self.add(server, gmap)
+        for i in range(count):
+            game = Game(start_dt=datetime.datetime.now(), game_type_cd='dm',
+                    server_id=server.server_id, map_id=gmap.map_id)
+            self.add(game)
+            for rank in (1, 2):
+                pgstat = PlayerGameStat()
+                (pgstat.player_id, pgstat.game_id, pgstat.nick) = \
+                        (1, game.game_id, 'test')
+                (pgstat.rank, pgstat.score) = (rank, 10 - rank)
+                self.add(pgstat)
+
+    def test_game_index_scoreboards(self):
+        from xonstat.views import game_index
+        self.assertConstantStatements(game_index, testing.DummyRequest(),
+                self.add_games)
+
+
+class TestPlayerTotals(ViewTestCase):
+    BODY = "\n".join(["T {2}", "G dm", "M test", "S test",
+        "P key", "n nick", "e matches 1", "e joins 1", "e scoreboardvalid 1",
+        "e rank {0}", "e scoreboard-kills {1}", "e alivetime 100.4",
+        "e acc-nex-cnt-fired 10",
+        "e acc-nex-fired 100", "e acc-nex-cnt-hit 4", "e acc-nex-hit 40",
+        "e acc-nex-frags 2"])
+
+    def totals(self):
+        return (self.session.execute("select * from summary_player_games "
+            "order by player_id").fetchall(),
+            self.session.execute("select * from summary_player_weapons "
+            "order by player_id, weapon_cd").fetchall())
+
+    def test_totals_match_rebuild(self):
+        from xonstat.parser import parse_submission
+        from xonstat.rollup import rebuild_player_totals
+        from xonstat.views.submission import record_game
+        for (rank, kills, bulk) in ((1, 5, True), (2, 7, False)):
+            (game_meta, players) = parse_submission(
+                    self.BODY.format(rank, kills, 1306014455 + rank))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=bulk)
+
+        totals = self.totals()
+        (games, weapons) = totals
+        self.assertEqual(len(games), 1)
+        self.assertEqual((games[0]['games'], games[0]['kills'],
+            games[0]['rank_total'], games[0]['deaths'],
+            games[0]['alivetime_secs']), (2, 12, 3, 0, 200))
+        self.assertEqual(weapons[0]['fired'], 20)
+
+        rebuild_player_totals(session=self.session)
+        self.assertEqual(self.totals(), totals)
+
+
+class TestConcurrentKeys(ViewTestCase):
+    """
+    Rows created for a key that another transaction inserted first, after
+    this one looked, are added to instead of failing with a unique
+    violation.
+    """
+    def test_increment_existing_key(self):
+        import datetime
+        from xonstat.batch import increment_rows, insert_rows
+        from xonstat.models import MapDailyActivity
+        table = MapDailyActivity.__table__
+        day = datetime.date(2011, 5, 21)
+        row = {'day_dt':day, 'map_id':7, 'games':1, 'players':2}
+
+        # as committed by the other transaction
+        insert_rows(session=self.session, table=table, rows=[row])
+        increment_rows(session=self.session, table=table,
+                keys=['day_dt', 'map_id'], rows=[row, dict(row, players=None)])
+        increment_rows(session=self.session, table=table,
+                keys=['day_dt', 'map_id'], rows=[row])
+        self.assertEqual(self.session.execute("select games, players from "
+            "summary_map_days").fetchall(), [(4, 6)])
+
+    def test_record_players_twice(self):
+        import datetime
+        from xonstat.activity import record_players
+        from xonstat.models import ServerDailyPlayer
+        day = datetime.date(2011, 5, 21)
+        for (player_ids, new) in (([3, 4], 2), ([4, 5], 1), ([3, 5], 0)):
+            self.assertEqual(record_players(session=self.session,
+                cls=ServerDailyPlayer, key='server_id', day=day, value=1,
+                player_ids=player_ids), new)
+        self.assertEqual(self.session.execute("select count(*) from "
+            "summary_server_day_players").scalar(), 3)
+
+    def test_first_rating_twice(self):
+        from xonstat.models import PlayerRating
+        from xonstat.rating import INITIAL_RATING, insert_ratings
+        for change in (10.0, -4.0):
+            insert_ratings(session=self.session, rows=[{'player_id':3,
+                'game_type_cd':'dm', 'rating':INITIAL_RATING + change,
+                'games':1}])
+        rating = self.session.query(PlayerRating).one()
+        self.assertEqual((rating.rating, rating.games),
+                (INITIAL_RATING + 6.0, 2))
+
+    def test_new_player_twice(self):
+        from xonstat.bench import make_body
+        from xonstat.models import Hashkey, Player
+        from xonstat.parser import parse_submission
+        from xonstat.views import submission
+        (game_meta, players) = parse_submission(make_body(players=2, seed=1))
+        reserve_ids = submission.reserve_ids
+
+        def reserve_after_other(**kwargs):
+            # the other transaction creates the first player after this
+            # one looked the hashkeys up
+            self.session.execute("insert into players (player_id, nick) "
+                    "values (100, 'other')")
+            self.session.execute("insert into hashkeys (player_id, hashkey) "
+                    "values (100, :hashkey)", {'hashkey':players[0].hashkey})
+            return reserve_ids(**kwargs)
+
+        submission.reserve_ids = reserve_after_other
+        try:
+            resolved = submission.get_or_create_players(session=self.session,
+                    players=players)
+        finally:
+            submission.reserve_ids = reserve_ids
+
+        self.assertEqual(resolved[players[0].hashkey].player_id, 100)
+        self.assertEqual(sorted(player_id for (player_id,) in
+            self.session.query(Hashkey.player_id)),
+            sorted(player.player_id for player in resolved.values()))
+        self.assertEqual(self.session.query(Player).filter(
+            Player.player_id > 2).count(), 2)
+
+
+class TestActivity(ViewTestCase):
+    def test_rollups_match_rebuild(self):
+        import datetime
+        from xonstat.activity import daily_activity, rebuild_activity
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        # two games in one hour, one later that day on another map and
+        # one the next day, with players "a" and "b" coming back
+        for (timestamp, map_name, hashkeys) in (
+                (1306014455, 'a', ('a', 'b', 'bot#1')),
+                (1306014755, 'a', ('a', 'c')),
+                (1306017455, 'b', ('b', 'player#1')),
+                (1306104455, 'a', ('a',))):
+            lines = ["T %d" % timestamp, "G dm", "M " + map_name, "S test"]
+            for hashkey in hashkeys:
+                lines.extend(["P " + hashkey, "n nick", "e matches 1",
+                    "e joins 1", "e scoreboardvalid 1"])
+            (game_meta, players) = parse_submission("\n".join(lines))
+            game = record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=True)
+
+        def activity():
+            return [daily_activity(session=self.session, days=3,
+                today=datetime.date(2011, 5, 22), **{key:value})
+                for (key, value) in (('server_id', game.server_id),
+                    ('map_id', game.map_id))]
+
+        def rows():
+            return [self.session.execute("select * from " + table +
+                " order by 1, 2, 3").fetchall() for table in (
+                    'summary_hourly_activity', 'summary_server_days',
+                    'summary_map_days', 'summary_server_day_players',
+                    'summary_map_day_players')]
 
-    def test_it(self):
-        from xonstat.views import my_view
+        (server, gmap) = activity()
+        self.assertEqual([(day['day'].day, day['games'], day['players'],
+            day['peak']) for day in server],
+            [(20, 0, 0, 0), (21, 3, 3, 2), (22, 1, 1, 1)])
+        self.assertEqual([(day['games'], day['players']) for day in gmap],
+            [(0, 0), (2, 3), (1, 1)])
+
+        before = rows()
+        rebuild_activity(session=self.session)
+        self.assertEqual(rows(), before)
+        self.assertEqual(activity(), [server, gmap])
+
+
+class TestExport(ViewTestCase):
+    def export(self, kind, format, **params):
+        from xonstat.views.export import export
+        request = testing.DummyRequest(params=params)
+        request.matchdict = {'kind':kind, 'format':format}
+        return ''.join(export(request).app_iter)
+
+    def test_streams_filtered_rows(self):
+        import json
+        from xonstat.bench import make_body
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        (game_meta, players) = parse_submission(make_body(players=4,
+            game_type_cd='dm', seed=1))
+        game = record_game(session=self.session, game_meta=game_meta,
+                players=players)
+
+        lines = self.export('scoreboards', 'ndjson',
+                server_id=str(game.server_id), **{'from':'2011-05-21'})
+        self.assertEqual([json.loads(line)['game_id']
+            for line in lines.splitlines()], [game.game_id] * 4)
+
+        lines = self.export('games', 'csv').splitlines()
+        self.assertEqual(lines[0].split(',')[:3],
+                ['game_id', 'start_dt', 'game_type_cd'])
+        self.assertEqual(lines[1].split(',')[:3],
+                [str(game.game_id), '2011-05-21T21:47:35', 'dm'])
+
+        self.assertEqual(self.export('weapons', 'csv',
+            map_id=str(game.map_id + 1)).splitlines(),
+            ['player_weapon_stats_id,game_id,player_game_stat_id,player_id,'
+                'weapon_cd,actual,max,hit,fired,frags'])
+
+
+class TestWeaponSnapshot(ViewTestCase):
+    def test_matches_totals(self):
+        import shutil
+        import tempfile
+        from xonstat.bench import make_body
+        from xonstat.parser import parse_submission
+        from xonstat.snapshot import WeaponSnapshot, numpy, write_snapshot
+        from xonstat.views.submission import record_game
+        if numpy is None:
+            self.skipTest("NumPy is not installed")
+
+        for seed in range(3):
+            (game_meta, players) = parse_submission(make_body(players=4,
+                timestamp=1306014455 + seed, seed=seed))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players)
+
+        path = tempfile.mkdtemp()
+        try:
+            write_snapshot(session=self.session, path=path + '/weapons')
+            snapshot = WeaponSnapshot(path=path + '/weapons', min_fired=0)
+        finally:
+            shutil.rmtree(path)
+
+        totals = self.session.execute("select player_id, weapon_cd, hit, "
+                "fired from summary_player_weapons where fired > 0").\
+                        fetchall()
+        self.assertTrue(totals)
+        for (player_id, weapon_cd, hit, fired) in totals:
+            self.assertEqual(snapshot.player_accuracy(player_id=player_id,
+                weapon_cd=weapon_cd), (float(hit) / fired, fired))
+
+        (player_id, weapon_cd) = totals[0][:2]
+        accuracies = snapshot.accuracies(weapon_cd)
+        self.assertEqual(snapshot.percentile(player_id=player_id,
+            weapon_cd=weapon_cd), 100.0 * len([accuracy
+                for accuracy in accuracies if accuracy <=
+                snapshot.player_accuracy(player_id=player_id,
+                    weapon_cd=weapon_cd)[0]]) / len(accuracies))
+        self.assertEqual(sum(snapshot.distribution(
+            weapon_cd=weapon_cd)['histogram']), len(accuracies))
+
+
+class TestSnapshotChanges(FileDBTestCase):
+    def test_rows_changed(self):
+        import os
+        from xonstat.bench import make_body
+        from xonstat.models import DBSession
+        from xonstat.parser import parse_submission
+        from xonstat.snapshot import SnapshotError, numpy, write_snapshot
+        from xonstat.views.submission import record_game
+        if numpy is None:
+            self.skipTest("NumPy is not installed")
+
+        session = DBSession()
+        (game_meta, players) = parse_submission(make_body(players=4))
+        record_game(session=session, game_meta=game_meta, players=players)
+        session.commit()
+
+        def delete_row(conn, cursor, statement, parameters, context,
+                executemany):
+            # a row deleted after the rows were counted
+            if 'order by player_weapon_stats.player_weapon_stats_id' in \
+                    statement.lower() and not deleted:
+                deleted.append(True)
+                conn.execute("delete from player_weapon_stats where "
+                        "player_weapon_stats_id = (select max("
+                        "player_weapon_stats_id) from player_weapon_stats)")
+
+        deleted = []
+        event.listen(self.engine, 'before_cursor_execute', delete_row)
+        try:
+            self.assertRaises(SnapshotError, write_snapshot,
+                    session=session, path=self.directory + '/weapons')
+        finally:
+            DBSession.remove()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['stats.db'])
+
+
+class TestRatings(ViewTestCase):
+    def test_rating_changes(self):
+        from xonstat.rating import INITIAL_RATING, placements, rating_changes
+        rows = [{'player_id':3, 'rank':2}, {'player_id':4, 'rank':1},
+                {'player_id':5, 'rank':3}]
+        self.assertEqual(placements(rows=rows), [2, 1, 3])
+        changes = rating_changes(ratings=[INITIAL_RATING] * 3,
+                games=[0] * 3, places=[2, 1, 3], teams=[None] * 3)
+        self.assertEqual(changes, [0.0, 20.0, -20.0])
+
+        # the favourite gains less for winning than the underdog would
+        (favourite, underdog) = rating_changes(ratings=[1700.0, 1500.0],
+                games=[30, 30], places=[0, 1], teams=[5, 14])
+        self.assertTrue(0 < favourite < 10)
+        self.assertAlmostEqual(favourite, -underdog)
+        self.assertEqual(placements(rows=[{'team':5}, {'team':14}]), None)
+
+    def test_replay_matches_submissions(self):
+        from xonstat.bench import make_body
+        from xonstat.parser import parse_submission
+        from xonstat.models import PlayerRating
+        from xonstat.rating import (numpy, rebuild_ratings, replay_sequential,
+                replay_vectorized, stat_rows)
+        from xonstat.views.submission import record_game
+        hashkeys = ['%040x' % i for i in range(8)]
+        for seed in range(12):
+            (game_meta, players) = parse_submission(make_body(
+                players=4 + seed % 3, game_type_cd=('dm', 'ctf')[seed % 2],
+                timestamp=1306014455 + seed, seed=seed, hashkeys=hashkeys,
+                bots=seed % 2))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players)
+
+        recorded = dict(((row.player_id, row.game_type_cd),
+            [row.rating, row.games]) for row in
+            self.session.query(PlayerRating))
+        self.assertEqual(len(recorded), 16)
+        self.assertEqual(sum(games for (rating, games) in recorded.values()),
+                6 * 5 + 6 * 4)
+
+        replays = [replay_sequential(games=stat_rows(session=self.session))]
+        if numpy is not None:
+            replays.append(replay_vectorized(
+                games=stat_rows(session=self.session)))
+        for replayed in replays:
+            self.assertEqual(sorted(replayed.keys()), sorted(recorded.keys()))
+            for (key, (rating, games)) in recorded.items():
+                self.assertAlmostEqual(replayed[key][0], rating)
+                self.assertEqual(replayed[key][1], games)
+
+        rebuild_ratings(session=self.session)
+        for row in self.session.query(PlayerRating):
+            self.assertAlmostEqual(row.rating,
+                    recorded[(row.player_id, row.game_type_cd)][0])
+
+
+class TestRankings(ViewTestCase):
+    def test_leaderboard_queries(self):
+        import random
+        from xonstat.ranking import Leaderboard
+        rand = random.Random(1)
+        ratings = dict((player_id, float(rand.randint(1400, 1600)))
+                for player_id in range(3, 503))
+        board = Leaderboard(game_type_cd='dm', ratings=ratings.items())
+        for player_id in rand.sample(ratings.keys(), 50):
+            ratings[player_id] = rand.uniform(1300, 1700)
+            board.update(player_id=player_id, rating=ratings[player_id])
+        board.update(player_id=503, rating=1500.0)
+        ratings[503] = 1500.0
+
+        expected = [(rank, player_id, ratings[player_id])
+                for (rank, player_id) in enumerate(sorted(ratings,
+                    key=lambda player_id: (-ratings[player_id], player_id)),
+                    1)]
+        self.assertEqual(len(board), 501)
+        self.assertEqual(board.top(count=10), expected[:10])
+        self.assertEqual(board.top(count=10, start=495), expected[495:])
+        for (rank, player_id, rating) in expected:
+            self.assertEqual(board.rank(player_id=player_id), rank)
+        self.assertEqual(board.around(player_id=expected[1][1], count=3),
+                expected[:5])
+        self.assertEqual(board.rank(player_id=1), None)
+        self.assertEqual(board.around(player_id=1), [])
+
+    def test_leaderboard_blocks(self):
+        import random
+        from xonstat.ranking import Leaderboard
+        rand = random.Random(2)
+        ratings = dict((player_id, float(rand.randint(1400, 1600)))
+                for player_id in range(20))
+        # small blocks, so that they split and empty
+        board = Leaderboard(game_type_cd='dm', ratings=ratings.items(),
+                block_size=2)
+        for i in range(300):
+            player_id = rand.randrange(40)
+            ratings[player_id] = rand.choice((1000.0, 2000.0,
+                rand.uniform(1300, 1700)))
+            board.update(player_id=player_id, rating=ratings[player_id])
+
+        expected = [(rank, player_id, ratings[player_id])
+                for (rank, player_id) in enumerate(sorted(ratings,
+                    key=lambda player_id: (-ratings[player_id], player_id)),
+                    1)]
+        self.assertEqual(len(board), len(ratings))
+        self.assertEqual(board.top(count=len(ratings) + 5), expected)
+        for (rank, player_id, rating) in expected:
+            self.assertEqual(board.rank(player_id=player_id), rank)
+            self.assertEqual(board.top(count=3, start=rank - 1),
+                    expected[rank - 1:rank + 2])
+            self.assertEqual(board.around(player_id=player_id, count=2),
+                    expected[max(0, rank - 3):rank + 2])
+
+    def test_ranks_in_views(self):
+        from xonstat.models import GameType, Player, PlayerRating
+        from xonstat.ranking import MIN_GAMES, rankings
+        from xonstat.views import main_index, ranking_index
+        from xonstat.views.ranking import player_ranks
+        players = [Player() for i in range(4)]
+        for (i, player) in enumerate(players):
+            player.set_nick('player{0}'.format(i))
+        self.add(*players)
+        self.add(*[PlayerRating(player_id=player.player_id,
+            game_type_cd='dm', rating=1500.0 + 10 * i,
+            games=MIN_GAMES + i - 1) for (i, player) in enumerate(players)])
+
+        # the first player hasn't played enough games to be ranked
+        ranks = player_ranks(player_id=players[1].player_id)
+        self.assertEqual([(rank['rank'], rank['ranked'], rank['rating'])
+            for rank in ranks], [(3, 3, 1510)])
+        self.assertEqual(player_ranks(player_id=players[0].player_id)[0][
+            'needed'], 1)
+
+        info = main_index(testing.DummyRequest())
+        self.assertEqual([(game_type_cd, ranked, [player_id
+            for (rank, player_id, nick, rating) in top])
+            for (game_type_cd, ranked, top) in info['top_players']],
+            [('dm', 3, [players[3].player_id, players[2].player_id,
+                players[1].player_id])])
+
+        # committed rating changes move players without a reload
+        rankings.stage(game_type_cd='dm', player_id=players[1].player_id,
+                rating=1600.0, games=MIN_GAMES + 1)
+        rankings.commit()
+        request = testing.DummyRequest(params={'player':
+            str(players[2].player_id)})
+        request.matchdict = {'game_type_cd':'dm'}
+        self.assertEqual(ranking_index(request).status_int, 404)
+
+        game_type = GameType()
+        game_type.game_type_cd = 'dm'
+        game_type.descr = 'Deathmatch'
+        self.add(game_type)
+        info = ranking_index(request)
+        self.assertEqual([(rank, player_id) for (rank, player_id, nick,
+            rating) in info['players']], [(1, players[1].player_id),
+                (2, players[3].player_id), (3, players[2].player_id)])
+
+    def test_min_games_setting(self):
+        from xonstat.models import Player, PlayerRating
+        from xonstat.ranking import MIN_GAMES, configure_rankings
+        from xonstat.views import main_index
+        player = Player()
+        player.set_nick('new')
+        self.add(player)
+        self.add(PlayerRating(player_id=player.player_id, game_type_cd='dm',
+            rating=1510.0, games=1))
+        try:
+            self.assertEqual(main_index(testing.DummyRequest())[
+                'top_players'], [])
+
+            # a small installation ranks players from their first game
+            configure_rankings({'xonstat.rankings.min_games':'1'})
+            self.assertEqual([(game_type_cd, ranked) for (game_type_cd,
+                ranked, top) in main_index(testing.DummyRequest())[
+                    'top_players']], [('dm', 1)])
+        finally:
+            configure_rankings({'xonstat.rankings.min_games':
+                str(MIN_GAMES)})
+
+
+class TestSentinelPlayers(ViewTestCase):
+    def test_bots_cost_no_lookups(self):
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        lines = ["T 1306014455", "G dm", "M test", "S test"]
+        for hashkey in ("key", "bot#1", "bot#2", "player#1"):
+            lines.extend(["P " + hashkey, "n nick", "e matches 1",
+                "e joins 1", "e scoreboardvalid 1", "e acc-nex-cnt-fired 1"])
+        (game_meta, players) = parse_submission("\n".join(lines))
+        self.assertEqual([(record.sentinel_id, record.bot)
+            for record in players],
+            [(None, False), (1, True), (1, True), (2, False)])
+
+        for (i, bulk) in enumerate((True, False, True)):
+            game_meta['T'] = str(1306014455 + i)
+            with captured_statements() as statements:
+                game = record_game(session=self.session,
+                        game_meta=game_meta, players=players, bulk=bulk)
+
+        # the server, map and tracked player are cached by now too
+        self.assertEqual([statement for statement in statements
+            if 'FROM players' in statement], [])
+        self.assertEqual(self.session.execute("select player_id, "
+            "count(*) from player_weapon_stats where game_id = :game_id "
+            "group by player_id order by player_id",
+            {'game_id':game.game_id}).fetchall(), [(2, 1), (3, 1)])
+
+
+class TestDuplicateSubmissions(ViewTestCase):
+    def test_retry_rejected(self):
+        from xonstat.cache import submissions
+        from xonstat.dedup import (DuplicateSubmission,
+                rebuild_submission_hashes)
+        from xonstat.models import Game, SubmissionHash
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        (game_meta, players) = parse_submission("\n".join(["T 1306014455",
+            "G dm", "M test", "S test", "P key", "n nick", "e matches 1",
+            "e joins 1", "e scoreboardvalid 1"]))
+        record_game(session=self.session, game_meta=game_meta,
+                players=players)
+
+        # answered from memory, then by the table once that is forgotten
+        with captured_statements() as statements:
+            self.assertRaises(DuplicateSubmission, record_game,
+                    session=self.session, game_meta=game_meta,
+                    players=players)
+        self.assertEqual(statements, [])
+        submissions.clear()
+        self.assertRaises(DuplicateSubmission, record_game,
+                session=self.session, game_meta=game_meta, players=players)
+        self.assertEqual(self.session.query(Game).count(), 1)
+
+        hashes = self.session.query(SubmissionHash.hash).all()
+        rebuild_submission_hashes(session=self.session)
+        self.assertEqual(self.session.query(SubmissionHash.hash).all(),
+                hashes)
+
+
+class TestImporter(ViewTestCase):
+    def test_matches_submission(self):
+        from xonstat.bench import make_body
+        from xonstat.scripts.import_games import Importer, parse
+        from xonstat.views.submission import record_game
+        def bodies(timestamp):
+            return [make_body(players=6, game_type_cd='ctf', bots=1,
+                untracked=1, timestamp=timestamp + seed, seed=seed)
+                for seed in range(3)]
+
+        for body in bodies(1306014455):
+            (game_meta, players) = parse(body)
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players)
+
+        def rows(query):
+            return sorted(tuple(row) for row in self.session.execute(query))
+
+        # the same games a day later, and again the recorded ones
+        players = rows("select player_id, nick from players")
+        importer = Importer(session=self.session)
+        self.assertEqual(importer.write([parse(body)
+            for body in bodies(1306014455 + 86400)]), 3)
+        self.assertEqual(importer.write([parse(body)
+            for body in bodies(1306014455)]), 0)
+        self.assertEqual(rows("select player_id, nick from players"),
+                players)
+
+        # every row is there twice, once per way in
+        for query in ("select game_type_cd, server_id, map_id from games",
+                "select player_id, nick, team, kills, score, alivetime "
+                "from player_game_stats",
+                "select player_id, weapon_cd, fired, hit, frags "
+                "from player_weapon_stats"):
+            result = rows(query)
+            self.assertEqual(result[::2], result[1::2])
+
+    def test_missing_nick(self):
+        from xonstat.bench import make_body
+        from xonstat.scripts.import_games import Importer, parse
+        from xonstat.views.submission import record_game
+        body = make_body(players=4, game_type_cd='dm', bots=1, untracked=1,
+                timestamp=1306014455, seed=0)
+        (game_meta, players) = parse(body)
+        record_game(session=self.session, game_meta=game_meta,
+                players=players)
+
+        # the same game a day later, sent without the nicks
+        later = '\n'.join(line for line in body.replace('T 1306014455',
+            'T 1306100855').split('\n') if not line.startswith('n '))
+        self.assertEqual(Importer(session=self.session).write(
+            [parse(later)]), 1)
+
+        stored = dict(self.session.execute("select player_id, nick "
+            "from players").fetchall())
+        rows = self.session.execute("select player_id, nick "
+                "from player_game_stats where game_id = (select max(game_id) "
+                "from games)").fetchall()
+        self.assertEqual(len(rows), 4)
+        for (player_id, nick) in rows:
+            self.assertEqual(nick, stored[player_id])
+
+
+class TestColors(unittest.TestCase):
+    def test_html_colors(self):
+        from xonstat.util import html_colors
+        self.assertEqual(html_colors('^1a^xF0cb'),
+            "<span style='color:#FF9900'>a<span style='color:#FF00cc'>b"
+            "</span></span>")
+        self.assertEqual(html_colors('^^a^x1'), '^^a^x1')
+
+    def test_strip_colors(self):
+        from xonstat.util import strip_colors
+        self.assertEqual(strip_colors('^1a^xF0cb^'), 'ab^')
+
+
+class TestStoredNicks(ViewTestCase):
+    def test_nicks_rendered_on_write(self):
+        from xonstat.models import Player, PlayerGameStat
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        for bulk in (True, False):
+            (game_meta, players) = parse_submission("\n".join([
+                "T %d" % (1306014455 + bulk), "G dm", "M test", "S test",
+                "P key", "n ^1ni^x0f0ck", "e matches 1", "e joins 1",
+                "e scoreboardvalid 1"]))
+            record_game(session=self.session, game_meta=game_meta,
+                    players=players, bulk=bulk)
+
+        self.session.expire_all()
+        rows = self.session.query(Player.stripped_nick, Player.nick_html).\
+                filter(Player.player_id > 2).all() + \
+                self.session.query(PlayerGameStat.stripped_nick,
+                    PlayerGameStat.nick_html).all()
+        self.assertEqual(len(rows), 3)
+        for (stripped, html) in rows:
+            self.assertEqual(stripped, 'nick')
+            self.assertEqual(html, "<span style='color:#FF9900'>ni"
+                "<span style='color:#00ff00'>ck</span></span>")
+
+
+class TestKeysetPagination(ViewTestCase):
+    def add_players(self, count):
+        from xonstat.models import Player
+        self.add(*[Player() for i in range(count)])
+
+    def test_player_index_pages(self):
+        from xonstat.views import player_index
+        # the bot and anonymous players (ids 1 and 2) are left out
+        self.add_players(45)
+
+        seen = []
+        request = testing.DummyRequest()
+        while True:
+            with captured_statements() as statements:
+                players = player_index(request)['players']
+            if 'after' in request.params:
+                # seeks past the token, besides leaving out ids 1 and 2
+                self.assertEqual(statements[-1].count('players.player_id >'),
+                        2)
+            seen.extend(player.player_id for player in players)
+            if players.next_token is None:
+                break
+            request = testing.DummyRequest(params={'after':players.next_token})
+        self.assertEqual(seen, range(3, 48))
+
+        request = testing.DummyRequest(params={'before':
+            players.previous_token})
+        players = player_index(request)['players']
+        self.assertEqual([player.player_id for player in players],
+                range(23, 43))
+        self.assertEqual(players.item_count, 47)
+
+    def test_legacy_page_number(self):
+        from xonstat.views import player_index
+        self.add_players(45)
         request = testing.DummyRequest()
-        info = my_view(request)
-        self.assertEqual(info['root'].name, 'root')
-        self.assertEqual(info['project'], 'XonStat')
+        request.matchdict['page'] = 2
+        players = player_index(request)['players']
+        self.assertEqual(list(players)[0].player_id, 23)
+        self.assertTrue(players.previous_token and players.next_token)
+
+
+class TestResponseCache(ViewTestCase):
+    def setUp(self):
+        from xonstat.httpcache import response_cache
+        ViewTestCase.setUp(self)
+        response_cache.clear()
+        self.renders = 0
+
+    def view(self, context, request):
+        from pyramid.response import Response
+        self.renders += 1
+        return Response('player {0}'.format(request.matchdict['id']))
+
+    def get(self, view, path, **headers):
+        from pyramid.request import Request
+        request = Request.blank(path, headers=headers)
+        request.matchdict = {'id':path.split('/')[-1]}
+        return view(None, request)
+
+    def test_invalidated_by_submission(self):
+        from xonstat.httpcache import _commit, cached_view
+        from xonstat.parser import parse_submission
+        from xonstat.views.submission import record_game
+        view = cached_view('player:{id}')(self.view)
+        self.assertEqual(self.get(view, '/player/3').headers['X-Cache'],
+                'MISS')
+        response = self.get(view, '/player/3')
+        self.assertEqual((response.headers['X-Cache'], response.body),
+                ('HIT', 'player 3'))
+        self.assertEqual(self.get(view, '/player/3',
+            **{'If-None-Match':response.etag}).status_int, 304)
+        self.get(view, '/player/4')
+        self.assertEqual(self.renders, 2)
+
+        # the submission's player is the first one created, id 3
+        (game_meta, players) = parse_submission("\n".join(["T 1306014455",
+            "G dm", "M test", "S test", "P key", "n nick", "e matches 1",
+            "e joins 1", "e scoreboardvalid 1"]))
+        record_game(session=self.session, game_meta=game_meta,
+                players=players)
+        _commit(self.session)
+
+        self.assertEqual(self.get(view, '/player/3').headers['X-Cache'],
+                'MISS')
+        self.assertEqual(self.get(view, '/player/4').headers['X-Cache'],
+                'HIT')
+
+    def test_immutable(self):
+        from xonstat.httpcache import cached_view
+        view = cached_view(immutable=True)(self.view)
+        self.get(view, '/game/1')
+        response = self.get(view, '/game/1')
+        self.assertTrue('immutable' in response.headers['Cache-Control'])
+        self.assertEqual(self.get(view, '/game/1',
+            **{'If-Modified-Since':response.headers['Last-Modified']}).\
+                    status_int, 304)
+        self.assertEqual(self.renders, 1)
+
+
+class TestMetrics(ViewTestCase):
+    # the engine is shared by the tests, so it is instrumented once
+    instrumented = False
+
+    def setUp(self):
+        from xonstat.metrics import instrument_engine, metrics
+        ViewTestCase.setUp(self)
+        if not TestMetrics.instrumented:
+            instrument_engine(self.session.bind)
+            TestMetrics.instrumented = True
+        metrics.reset()
+
+    def serve(self, app):
+        """
+        Calls the application through the middleware the way a server does,
+        closing the response body once it is read.
+        """
+        from pyramid.request import Request
+        from xonstat.metrics import MetricsMiddleware
+        body = MetricsMiddleware(app)(Request.blank('/').environ,
+                lambda status, headers, exc_info=None: None)
+        try:
+            return ''.join(body)
+        finally:
+            body.close()
+
+    def test_request_timing(self):
+        from xonstat.metrics import metrics, prometheus_text
+        # every statement counts as slow
+        metrics.slow_query = 1e-9
+
+        def app(environ, start_response):
+            metrics.current().route = 'test'
+            self.session.execute("select 1")
+            self.session.execute("select 2")
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+
+        self.serve(app)
+        text = prometheus_text()
+        for line in ('xonstat_request_duration_seconds_count{route="test"} 1',
+                'xonstat_request_statements_total{route="test"} 2',
+                'xonstat_request_errors_total{route="test"} 0',
+                'xonstat_slow_queries_total 2'):
+            self.assertTrue(line in text.splitlines(), text)
+        metrics.slow_query = 0
+
+    def test_streamed_body(self):
+        from xonstat.metrics import metrics, prometheus_text
+
+        def app(environ, start_response):
+            metrics.current().route = 'stream'
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            for n in range(3):
+                self.session.execute("select 1")
+                yield 'row\n'
+
+        self.assertEqual(self.serve(app), 'row\n' * 3)
+        self.assertEqual(metrics.current(), None)
+        text = prometheus_text()
+        for line in (
+                'xonstat_request_duration_seconds_count{route="stream"} 1',
+                'xonstat_request_statements_total{route="stream"} 3'):
+            self.assertTrue(line in text.splitlines(), text)
+
+
+class TestEngineSettings(unittest.TestCase):
+    def test_invalid_settings(self):
+        from pyramid.exceptions import ConfigurationError
+        from xonstat.settings import validate_settings
+        settings = {'sqlalchemy.url':'sqlite://',
+                'sqlalchemy.pool_size':'0',
+                'xonstat.sqlite.journal_mode':'sometimes',
+                'xonstat.spool.enabled':'maybe'}
+        try:
+            validate_settings(settings)
+        except ConfigurationError as e:
+            for name in ('pool_size', 'journal_mode', 'spool.enabled'):
+                self.assertTrue(name in str(e), str(e))
+        else:
+            self.fail("invalid settings were accepted")
+
+        validate_settings({'sqlalchemy.url':'sqlite://',
+            'sqlalchemy.pool_size':'5', 'xonstat.spool.enabled':'off',
+            'xonstat.verify_schema':'check'})
+
+    def test_schema_check(self):
+        from xonstat.models import DBSession, initialize_db
+        engine = create_engine('sqlite://')
+        try:
+            initialize_db(engine)
+            # a database from before the index was declared
+            engine.execute("drop index games_start_dt_ix")
+            initialize_db(engine)
+            initialize_db(engine, verify='check')
+
+            def indexes():
+                return [row[0] for row in engine.execute("select name "
+                    "from sqlite_master where tbl_name = 'games' "
+                    "and type = 'index'")]
+            self.assertFalse('games_start_dt_ix' in indexes())
+            initialize_db(engine, verify='fix')
+            self.assertTrue('games_start_dt_ix' in indexes())
+        finally:
+            DBSession.remove()
+            if _engine is not None:
+                initialize_db(_engine)
+
+    def test_sqlite_file_engine(self):
+        import os
+        import shutil
+        import tempfile
+        from xonstat.engine import checkout_stats, engine_from_settings
+        directory = tempfile.mkdtemp()
+        try:
+            engine = engine_from_settings({
+                'sqlalchemy.url':'sqlite:///' + os.path.join(directory,
+                    'test.db'),
+                'sqlalchemy.pool_size':'2',
+                'xonstat.db.pre_ping':'true',
+                'xonstat.sqlite.journal_mode':'wal',
+                'xonstat.sqlite.synchronous':'normal'})
+            checkout_stats.reset()
+            self.assertEqual(engine.execute("pragma journal_mode").scalar(),
+                    'wal')
+            self.assertEqual(engine.execute("pragma synchronous").scalar(), 1)
+            self.assertEqual(checkout_stats.snapshot()['checkouts'], 2)
+            engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestLoadHarness(unittest.TestCase):
+    def test_make_bodies(self):
+        from xonstat.bench.load import make_bodies
+        from xonstat.parser import parse_submission
+        bodies = make_bodies(count=20, min_players=2, max_players=8, pool=10,
+                seed=1)
+        self.assertEqual(bodies, make_bodies(count=20, min_players=2,
+            max_players=8, pool=10, seed=1))
+
+        # tracked players come back from the pool across submissions
+        hashkeys = set()
+        for body in bodies:
+            (game_meta, players) = parse_submission(body)
+            self.assertTrue(2 <= len(players) <= 8)
+            hashkeys.update(record.hashkey for record in players
+                    if not record.hashkey.startswith(('bot#', 'player#')))
+        self.assertTrue(len(hashkeys) <= 10)
+
+    def test_run(self):
+        from xonstat.bench.load import run
+
+        class Target(object):
+            def post(self, body):
+                if body == 'error':
+                    raise IOError(body)
+                return int(body)
+
+        (elapsed, latencies, failed) = run(target=Target(),
+                bodies=['200', '500', 'error', '200'], threads=3)
+        self.assertEqual(len(latencies), 4)
+        self.assertEqual(failed, 2)
+
+    def test_submit_statements(self):
+        from xonstat.bench.load import percentile, submit_statements
+        self.assertEqual(submit_statements(
+            'xonstat_request_statements_total{route="main_index"} 3.0\n'
+            'xonstat_request_statements_total{route="stats_submit"} 42.0\n'),
+            42)
+        self.assertEqual(submit_statements(''), 0)
+        self.assertEqual(percentile([3, 1, 2, 4], 0.5), 3)
+        self.assertEqual(percentile([3, 1, 2, 4], 0.99), 4)
+
+
+class TestDataset(FileDBTestCase):
+    def test_generate(self):
+        from xonstat.bench.dataset import generate
+        from xonstat.models import DBSession
+        generate(engine=self.engine, games=50, servers=5, maps=4, players=30,
+                seed=1)
+        self.assertEqual([self.count(table) for table in ('games', 'servers',
+            'maps', 'players', 'hashkeys')], [50, 5, 4, 30, 30])
+
+        # the summaries are rebuilt from the generated games
+        session = DBSession()
+        try:
+            self.assertEqual(session.execute("select sum(games) "
+                "from summary_server_games").scalar(), 50)
+            self.assertEqual(session.execute("select sum(games) "
+                "from summary_player_games").scalar(),
+                session.execute("select count(*) from player_game_stats "
+                    "where player_id > 2").scalar())
+        finally:
+            DBSession.remove()
+
+    def test_view_cases(self):
+        from xonstat.bench.dataset import generate
+        from xonstat.bench.views import find_cases, time_case
+        from xonstat.models import DBSession
+        generate(engine=self.engine, games=50, servers=5, maps=4, players=30,
+                seed=1)
+        try:
+            cases = find_cases(DBSession())
+        finally:
+            DBSession.remove()
+        self.assertEqual(len(cases), 8)
+        (name, view, matchdict, params) = cases[1]
+        result = time_case([], view, matchdict, params, runs=2)
+        self.assertTrue(result['min'] <= result['median'] <= result['max'])
+
+    def test_zipf(self):
+        import random
+        from xonstat.bench.dataset import Zipf
+        ranks = Zipf(100, s=1.0, rand=random.Random(0))
+        draws = [ranks.draw() for i in range(1000)]
+        self.assertTrue(all(0 <= rank < 100 for rank in draws))
+        # the first ranks take a large share of the draws
+        self.assertTrue(draws.count(0) > draws.count(50) * 10)
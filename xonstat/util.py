@@ -1,31 +1,75 @@
 import re
 from datetime import datetime
 
+# a colour code: ^x followed by three hex digits, or ^ and a palette digit
+COLOR_CODE = re.compile(r'\^(?:x(\w)(\w)(\w)|(\d))')
+
+PALETTE = {
+    '0':'#333333',
+    '1':'#FF9900',
+    '2':'#33FF00',
+    '3':'#FFFF00',
+    '4':'#3366FF',
+    '5':'#33FFFF',
+    '6':'#FF3366',
+    '7':'#FFFFFF',
+    '8':'#999999',
+    '9':'#666666',
+}
+
+# nicks repeat across scoreboards and pages, so rendered forms are kept
+# until this many distinct nicks have been seen
+MEMO_SIZE = 10000
+
+
+def memoize(func):
+    """
+    Caches the results of a single-argument function in a bounded
+    dictionary, which is emptied when it fills up.
+    """
+    memo = {}
+
+    def wrapper(arg):
+        try:
+            return memo[arg]
+        except KeyError:
+            pass
+
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        result = memo[arg] = func(arg)
+        return result
+
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.memo = memo
+    return wrapper
+
+
+@memoize
 def strip_colors(str=None):
-    str = re.sub(r'\^x\w\w\w', '', str)
-    str = re.sub(r'\^\d', '', str)
-    return str
+    """
+    Removes the colour codes from a nick.
+    """
+    return COLOR_CODE.sub('', str)
 
 
+def _color_span(match):
+    if match.group(4) is not None:
+        color = PALETTE[match.group(4)]
+    else:
+        color = '#' + ''.join(c + c for c in match.group(1, 2, 3))
+    return "<span style='color:{0}'>".format(color)
+
+
+@memoize
 def html_colors(str=None):
-    orig = str
-    str = re.sub(r'\^x(\w)(\w)(\w)', 
-            "<span style='color:#\g<1>\g<1>\g<2>\g<2>\g<3>\g<3>'>", str)
-    str = re.sub(r'\^1', "<span style='color:#FF9900'>", str)
-    str = re.sub(r'\^2', "<span style='color:#33FF00'>", str)
-    str = re.sub(r'\^3', "<span style='color:#FFFF00'>", str)
-    str = re.sub(r'\^4', "<span style='color:#3366FF'>", str)
-    str = re.sub(r'\^5', "<span style='color:#33FFFF'>", str)
-    str = re.sub(r'\^6', "<span style='color:#FF3366'>", str)
-    str = re.sub(r'\^7', "<span style='color:#FFFFFF'>", str)
-    str = re.sub(r'\^8', "<span style='color:#999999'>", str)
-    str = re.sub(r'\^9', "<span style='color:#666666'>", str)
-    str = re.sub(r'\^0', "<span style='color:#333333'>", str)
-
-    for span in range(len(re.findall(r'\^x\w\w\w|\^\d', orig))):
-        str += "</span>"
-
-    return str
+    """
+    Turns the colour codes of a nick into nested spans in a single pass,
+    closing every span at the end.
+    """
+    (html, spans) = COLOR_CODE.subn(_color_span, str)
+    return html + "</span>" * spans
 
 
 def page_url(page):
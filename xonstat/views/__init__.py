@@ -4,3 +4,6 @@ from xonstat.views.game import game_index, game_info
 from xonstat.views.map import map_info, map_index
 from xonstat.views.server import server_info, server_game_index, server_index
 from xonstat.views.main import main_index
+from xonstat.views.ranking import ranking_index
+from xonstat.views.status import db_status, prometheus_metrics
+from xonstat.views.export import export
@@ -0,0 +1,178 @@
+import csv
+import cStringIO
+import datetime
+import json
+import logging
+from collections import OrderedDict
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
+from xonstat.models import *
+
+log = logging.getLogger(__name__)
+
+# rows fetched from the cursor, and written to the response, at a time
+CHUNK_SIZE = 1000
+
+CONTENT_TYPES = {
+    'ndjson':'application/x-ndjson',
+    'csv':'text/csv',
+}
+
+
+def _columns(table, *names):
+    return [table.c[name] for name in names]
+
+
+# what each export holds: the key it is ordered (and resumed) by and its
+# columns, in output order
+EXPORTS = {
+    'games':(games_table.c.game_id,
+        _columns(games_table, 'game_id', 'start_dt', 'game_type_cd',
+            'server_id') + [servers_table.c.name.label('server_name'),
+            games_table.c.map_id, maps_table.c.name.label('map_name')] +
+        _columns(games_table, 'duration', 'winner')),
+    'scoreboards':(player_game_stats_table.c.player_game_stat_id,
+        _columns(player_game_stats_table, 'player_game_stat_id', 'game_id',
+            'player_id', 'nick', 'stripped_nick', 'team', 'rank',
+            'alivetime', 'kills', 'deaths', 'suicides', 'score', 'time',
+            'held', 'captures', 'pickups', 'carrier_frags', 'drops',
+            'returns', 'collects', 'destroys', 'destroys_holding_key',
+            'pushes', 'pushed')),
+    'weapons':(player_weapon_stats_table.c.player_weapon_stats_id,
+        _columns(player_weapon_stats_table, 'player_weapon_stats_id',
+            'game_id', 'player_game_stat_id', 'player_id', 'weapon_cd',
+            'actual', 'max', 'hit', 'fired', 'frags')),
+}
+
+
+def export_filters(params=None):
+    """
+    Returns the game filters of an export request:
+
+    from - first day (YYYY-MM-DD) of the games to export
+    to - last day of the games to export
+    server_id, map_id, game_type - games on that server, map or game type
+    """
+    filters = []
+    if 'from' in params:
+        filters.append(games_table.c.start_dt >= datetime.datetime.strptime(
+            params['from'], '%Y-%m-%d'))
+    if 'to' in params:
+        filters.append(games_table.c.start_dt < datetime.datetime.strptime(
+            params['to'], '%Y-%m-%d') + datetime.timedelta(days=1))
+    if 'server_id' in params:
+        filters.append(games_table.c.server_id == int(params['server_id']))
+    if 'map_id' in params:
+        filters.append(games_table.c.map_id == int(params['map_id']))
+    if 'game_type' in params:
+        filters.append(games_table.c.game_type_cd == params['game_type'])
+    return filters
+
+
+def export_value(value):
+    """
+    Converts a column value to what is written out: times as ISO 8601
+    text and intervals as seconds.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def ndjson_lines(names, rows):
+    for row in rows:
+        yield json.dumps(OrderedDict(zip(names, [export_value(value)
+            for value in row]))) + '\n'
+
+
+def csv_lines(names, rows):
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+
+    def line(values):
+        writer.writerow(values)
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    yield line(names)
+    for row in rows:
+        values = []
+        for value in row:
+            value = export_value(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append(value)
+        yield line(values)
+
+
+def stream_export(session=None, query=None, names=None, format=None):
+    """
+    Yields the rows of an export query in chunks of CHUNK_SIZE rows. The
+    rows are fetched CHUNK_SIZE at a time too (from a server side cursor
+    on PostgreSQL), so memory use doesn't grow with the export. The
+    session is closed once the export is done or abandoned.
+    """
+    if format == 'csv':
+        lines = csv_lines(names, query.yield_per(CHUNK_SIZE))
+    else:
+        lines = ndjson_lines(names, query.yield_per(CHUNK_SIZE))
+
+    try:
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+    finally:
+        session.close()
+
+
+def export(request):
+    """
+    Streams the games, scoreboards (player game stats) or weapon stats
+    matching the filters as newline delimited JSON or CSV, e.g.:
+
+        /export/scoreboards.csv?from=2011-05-01&to=2011-05-31&server_id=4
+
+    Rows come in the order of their ids. An interrupted export can be
+    resumed by passing the last id received as "after".
+    """
+    kind = request.matchdict['kind']
+    format = request.matchdict['format']
+    (key, columns) = EXPORTS[kind]
+
+    try:
+        filters = export_filters(request.params)
+        if 'after' in request.params:
+            filters.append(key > int(request.params['after']))
+    except ValueError as e:
+        return HTTPBadRequest(explanation="Invalid filter: {0}".format(e))
+
+    # a session of its own, as the rows are read after the view returns
+    session = DBSession.session_factory()
+    query = session.query(*columns).\
+            execution_options(stream_results=True).\
+            order_by(key)
+
+    if kind == 'games':
+        query = query.filter(games_table.c.server_id ==
+                    servers_table.c.server_id).\
+                filter(games_table.c.map_id == maps_table.c.map_id)
+    elif filters:
+        query = query.filter(key.table.c.game_id == games_table.c.game_id)
+    for condition in filters:
+        query = query.filter(condition)
+
+    response = Response(content_type=CONTENT_TYPES[format], charset='utf-8',
+            app_iter=stream_export(session=session, query=query,
+                names=[column.name for column in columns], format=format))
+    response.content_disposition = 'attachment; filename="{0}.{1}"'.format(
+            kind, format)
+    return response
@@ -4,9 +4,8 @@ import re
 import time
 from pyramid.response import Response
 from sqlalchemy import desc
-from webhelpers.paginate import Page, PageURL
 from xonstat.models import *
-from xonstat.util import page_url
+from xonstat.pagination import KeysetPage, estimated_count, table_estimate
 
 log = logging.getLogger(__name__)
 
@@ -24,17 +23,26 @@ def game_index(request):
 
     games_q = DBSession.query(Game, Server, Map).\
             filter(Game.server_id == Server.server_id).\
-            filter(Game.map_id == Map.map_id).\
-            order_by(Game.game_id.desc())
+            filter(Game.map_id == Map.map_id)
 
-    games = Page(games_q, current_page, url=page_url)
+    games = KeysetPage(games_q, key=Game.game_id,
+            key_of=lambda row: row[0].game_id,
+            before=request.GET.get('before'), after=request.GET.get('after'),
+            page=current_page, item_count=estimated_count('games',
+                lambda: table_estimate(DBSession, 'games')))
 
+    # fetch the scoreboards of every game on the page in one query
     pgstats = {}
     for (game, server, map) in games:
-        pgstats[game.game_id] = DBSession.query(PlayerGameStat).\
-                filter(PlayerGameStat.game_id == game.game_id).\
+        pgstats[game.game_id] = []
+
+    if len(pgstats) > 0:
+        for pgstat in DBSession.query(PlayerGameStat).\
+                filter(PlayerGameStat.game_id.in_(pgstats.keys())).\
+                order_by(PlayerGameStat.game_id).\
                 order_by(PlayerGameStat.rank).\
-                order_by(PlayerGameStat.score).all()
+                order_by(PlayerGameStat.score):
+            pgstats[pgstat.game_id].append(pgstat)
 
     return {'games':games, 
             'pgstats':pgstats}
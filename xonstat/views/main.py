@@ -3,7 +3,9 @@ import sqlalchemy.sql.functions as func
 import sqlalchemy.sql.expression as expr
 from pyramid.response import Response
 from xonstat.models import *
+from xonstat.ranking import rankings
 from xonstat.util import *
+from xonstat.views.ranking import ranked_players
 
 log = logging.getLogger(__name__)
 
@@ -11,39 +13,33 @@ def main_index(request):
     leaderboard_count = 10
     recent_games_count = 32
 
-    # top players by score
-    top_players = DBSession.query(Player.player_id, Player.nick, 
-            func.sum(PlayerGameStat.score)).\
-            filter(Player.player_id == PlayerGameStat.player_id).\
-            filter(Player.player_id > 2).\
-            order_by(expr.desc(func.sum(PlayerGameStat.score))).\
-            group_by(Player.nick).\
-            group_by(Player.player_id).all()[0:10]
+    # the leaderboards are read from summary tables kept up to date by
+    # stats_submit (see xonstat.leaderboard)
 
-    top_players = [(player_id, html_colors(nick), score) \
-            for (player_id, nick, score) in top_players]
-
-    for i in range(leaderboard_count-len(top_players)):
-        top_players.append(('-', '-', '-'))
+    # top players by rating, per game type (see xonstat.ranking)
+    top_players = []
+    for game_type_cd in rankings.game_types(session=DBSession):
+        board = rankings.leaderboard(session=DBSession,
+                game_type_cd=game_type_cd)
+        top_players.append((game_type_cd, len(board),
+            ranked_players(board.top(count=leaderboard_count))))
 
     # top servers by number of total players played
     top_servers = DBSession.query(Server.server_id, Server.name, 
-            func.count()).\
-            filter(Game.server_id==Server.server_id).\
-            order_by(expr.desc(func.count(Game.game_id))).\
-            group_by(Server.server_id).\
-            group_by(Server.name).all()[0:10]
+            ServerGameSummary.games).\
+            filter(ServerGameSummary.server_id==Server.server_id).\
+            order_by(expr.desc(ServerGameSummary.games)).\
+            limit(leaderboard_count).all()
 
     for i in range(leaderboard_count-len(top_servers)):
         top_servers.append(('-', '-', '-'))
 
     # top maps by total times played
     top_maps = DBSession.query(Map.map_id, Map.name, 
-            func.count(Game.game_id)).\
-            filter(Map.map_id==Game.game_id).\
-            order_by(expr.desc(func.count(Game.game_id))).\
-            group_by(Map.map_id).\
-            group_by(Map.name).all()[0:10]
+            MapGameSummary.games).\
+            filter(MapGameSummary.map_id==Map.map_id).\
+            order_by(expr.desc(MapGameSummary.games)).\
+            limit(leaderboard_count).all()
 
     for i in range(leaderboard_count-len(top_maps)):
         top_maps.append(('-', '-', '-'))
@@ -51,7 +47,8 @@ def main_index(request):
     recent_games = DBSession.query(Game, Server, Map).\
             filter(Game.server_id==Server.server_id).\
             filter(Game.map_id==Map.map_id).\
-            order_by(expr.desc(Game.start_dt)).all()[0:recent_games_count]
+            order_by(expr.desc(Game.start_dt)).\
+            limit(recent_games_count).all()
 
     for i in range(recent_games_count-len(recent_games)):
         recent_games.append(('-', '-', '-'))
@@ -1,6 +1,7 @@
 import logging
 from pyramid.response import Response
 from webhelpers.paginate import Page, PageURL
+from xonstat.activity import daily_activity
 from xonstat.models import *
 from xonstat.util import page_url
 
@@ -35,6 +36,9 @@ def map_info(request):
     map_id = request.matchdict['id']
     try:
         gmap = DBSession.query(Map).filter_by(map_id=map_id).one()
+        activity = daily_activity(session=DBSession, map_id=map_id)
     except:
         gmap = None
-    return {'gmap':gmap}
+        activity = None
+    return {'gmap':gmap,
+            'activity':activity}
@@ -4,9 +4,9 @@ import re
 import time
 from pyramid.response import Response
 from sqlalchemy import desc
-from webhelpers.paginate import Page, PageURL
 from xonstat.models import *
-from xonstat.util import page_url
+from xonstat.pagination import KeysetPage, estimated_count, table_estimate
+from xonstat.views.ranking import player_ranks
 
 log = logging.getLogger(__name__)
 
@@ -22,10 +22,14 @@ def player_index(request):
 
     try:
         player_q = DBSession.query(Player).\
-                filter(Player.player_id > 2).\
-                order_by(Player.player_id)
+                filter(Player.player_id > 2)
 
-        players = Page(player_q, current_page, url=page_url)
+        players = KeysetPage(player_q, key=Player.player_id,
+                key_of=lambda player: player.player_id,
+                before=request.GET.get('before'),
+                after=request.GET.get('after'), page=current_page,
+                descending=False, item_count=estimated_count('players',
+                    lambda: table_estimate(DBSession, 'players')))
 
         
     except Exception as e:
@@ -42,74 +46,73 @@ def player_info(request):
     try:
         player = DBSession.query(Player).filter_by(player_id=player_id).one()
 
-        weapon_stats = DBSession.query("descr", "weapon_cd", "actual_total", 
-                "max_total", "hit_total", "fired_total", "frags_total").\
-                from_statement(
-                    "select cw.descr, cw.weapon_cd, sum(actual) actual_total, "
-                    "sum(max) max_total, sum(hit) hit_total, "
-                    "sum(fired) fired_total, sum(frags) frags_total "
-                    "from xonstat.player_weapon_stats ws, xonstat.cd_weapon cw "
-                    "where ws.weapon_cd = cw.weapon_cd "
-                    "and player_id = :player_id "
-                    "group by descr, cw.weapon_cd "
-                    "order by descr"
-                ).params(player_id=player_id).all()
+        weapon_stats = DBSession.query(Weapon.descr, Weapon.weapon_cd,
+                PlayerWeaponTotal.actual, PlayerWeaponTotal.max,
+                PlayerWeaponTotal.hit, PlayerWeaponTotal.fired,
+                PlayerWeaponTotal.frags).\
+                filter(PlayerWeaponTotal.player_id == player_id).\
+                filter(PlayerWeaponTotal.weapon_cd == Weapon.weapon_cd).\
+                order_by(Weapon.descr).all()
 
         recent_games = DBSession.query(PlayerGameStat, Game, Server, Map).\
                 filter(PlayerGameStat.player_id == player_id).\
                 filter(PlayerGameStat.game_id == Game.game_id).\
                 filter(Game.server_id == Server.server_id).\
                 filter(Game.map_id == Map.map_id).\
-                order_by(Game.game_id.desc())[0:10]
+                order_by(Game.game_id.desc()).\
+                limit(10).all()
+
+        # totals kept up to date by stats_submit
+        totals = DBSession.query(PlayerGameTotal).get(player_id)
+        if totals is None:
+            totals = PlayerGameTotal(games=0, ranked_games=0)
 
         game_stats = {}
-        (game_stats['avg_rank'], game_stats['total_kills'], 
-                game_stats['total_deaths'], game_stats['total_suicides'], 
-                game_stats['total_score'], game_stats['total_time'], 
-                game_stats['total_held'], game_stats['total_captures'], 
-                game_stats['total_pickups'],game_stats['total_drops'], 
-                game_stats['total_returns'], game_stats['total_collects'], 
-                game_stats['total_destroys'], game_stats['total_dhk'], 
-                game_stats['total_pushes'], game_stats['total_pushed'], 
-                game_stats['total_carrier_frags'], 
-                game_stats['total_alivetime'],
-                game_stats['total_games_played']) = DBSession.\
-                        query("avg_rank", "total_kills", "total_deaths", 
-                "total_suicides", "total_score", "total_time", "total_held",
-                "total_captures", "total_pickups", "total_drops", 
-                "total_returns", "total_collects", "total_destroys", 
-                "total_dhk", "total_pushes", "total_pushed", 
-                "total_carrier_frags", "total_alivetime", 
-                "total_games_played").\
-                from_statement(
-                    "select round(avg(rank)) avg_rank, sum(kills) total_kills, "
-                    "sum(deaths) total_deaths, sum(suicides) total_suicides, "
-                    "sum(score) total_score, sum(time) total_time, "
-                    "sum(held) total_held, sum(captures) total_captures, "
-                    "sum(pickups) total_pickups, sum(drops) total_drops, "
-                    "sum(returns) total_returns, sum(collects) total_collects, "
-                    "sum(destroys) total_destroys, sum(destroys_holding_key) total_dhk, "
-                    "sum(pushes) total_pushes, sum(pushed) total_pushed, "
-                    "sum(carrier_frags) total_carrier_frags, "
-                    "sum(alivetime) total_alivetime, count(*) total_games_played "
-                    "from player_game_stats "
-                    "where player_id=:player_id"
-                ).params(player_id=player_id).one()
+        if totals.ranked_games:
+            game_stats['avg_rank'] = int(round(
+                float(totals.rank_total) / totals.ranked_games))
+        else:
+            game_stats['avg_rank'] = None
+        game_stats['total_kills'] = totals.kills
+        game_stats['total_deaths'] = totals.deaths
+        game_stats['total_suicides'] = totals.suicides
+        game_stats['total_score'] = totals.score
+        game_stats['total_captures'] = totals.captures
+        game_stats['total_pickups'] = totals.pickups
+        game_stats['total_drops'] = totals.drops
+        game_stats['total_returns'] = totals.returns
+        game_stats['total_collects'] = totals.collects
+        game_stats['total_destroys'] = totals.destroys
+        game_stats['total_dhk'] = totals.destroys_holding_key
+        game_stats['total_pushes'] = totals.pushes
+        game_stats['total_pushed'] = totals.pushed
+        game_stats['total_carrier_frags'] = totals.carrier_frags
+        if totals.alivetime_secs is not None:
+            game_stats['total_alivetime'] = datetime.timedelta(
+                    seconds=totals.alivetime_secs)
+        else:
+            game_stats['total_alivetime'] = None
+        game_stats['total_games_played'] = totals.games
 
         for (key,value) in game_stats.items():
             if value == None:
                 game_stats[key] = '-'
 
+        # ranks are looked up in the in-memory leaderboards
+        ranks = player_ranks(player_id=player.player_id)
+
     except Exception as e:
         player = None
         weapon_stats = None
         game_stats = None
         recent_games = None
+        ranks = None
 
     return {'player':player, 
             'recent_games':recent_games,
             'weapon_stats':weapon_stats,
-            'game_stats':game_stats}
+            'game_stats':game_stats,
+            'ranks':ranks}
 
 
 def player_game_index(request):
@@ -132,10 +135,17 @@ def player_game_index(request):
                 filter(PlayerGameStat.player_id == player_id).\
                 filter(PlayerGameStat.game_id == Game.game_id).\
                 filter(Game.server_id == Server.server_id).\
-                filter(Game.map_id == Map.map_id).\
-                order_by(Game.game_id.desc())
-
-        games = Page(games_q, current_page, url=page_url)
+                filter(Game.map_id == Map.map_id)
+
+        # seek on player_game_stats.game_id, which the (player_id, game_id)
+        # index covers
+        games = KeysetPage(games_q, key=PlayerGameStat.game_id,
+                key_of=lambda row: row[0].game_id,
+                before=request.GET.get('before'),
+                after=request.GET.get('after'), page=current_page,
+                item_count=estimated_count('player_games:' + str(player_id),
+                    lambda: DBSession.query(PlayerGameTotal.games).\
+                            filter_by(player_id=player_id).scalar()))
 
         
     except Exception as e:
@@ -0,0 +1,87 @@
+import logging
+from pyramid.httpexceptions import HTTPNotFound
+from xonstat.models import *
+from xonstat.ranking import rankings
+from xonstat.util import html_colors
+
+log = logging.getLogger(__name__)
+
+# players on a page of a leaderboard
+PAGE_SIZE = 20
+
+
+def ranked_players(entries):
+    """
+    Adds the nicks to the (rank, player_id, rating) entries of a
+    leaderboard, returning (rank, player_id, nick_html, rating) tuples
+    with the rating rounded for display.
+    """
+    player_ids = [player_id for (rank, player_id, rating) in entries]
+    nicks = {}
+    if player_ids:
+        for (player_id, nick, nick_html) in DBSession.query(Player.player_id,
+                Player.nick, Player.nick_html).\
+                        filter(Player.player_id.in_(player_ids)):
+            # nick_html is missing on rows that predate it
+            nicks[player_id] = nick_html or html_colors(nick)
+
+    return [(rank, player_id, nicks.get(player_id, ''), int(round(rating)))
+            for (rank, player_id, rating) in entries]
+
+
+def player_ranks(player_id=None):
+    """
+    Returns the rating, games, rank and number of ranked players of every
+    game type a player is rated in, as dictionaries, most played first.
+    The rank is None while the player hasn't played enough games; needed
+    is how many more they need.
+    """
+    ranks = []
+    for row in DBSession.query(PlayerRating).\
+            filter(PlayerRating.player_id == player_id).\
+            order_by(PlayerRating.games.desc()):
+        board = rankings.leaderboard(session=DBSession,
+                game_type_cd=row.game_type_cd)
+        ranks.append({'game_type_cd':row.game_type_cd,
+            'rating':int(round(row.rating)), 'games':row.games,
+            'rank':board.rank(player_id=player_id), 'ranked':len(board),
+            'needed':max(0, rankings.min_games - row.games)})
+    return ranks
+
+
+def ranking_index(request):
+    """
+    Provides the leaderboard of a game type by rating, a page at a time
+    (?page=N), or the players ranked around a player (?player=ID).
+    """
+    game_type_cd = request.matchdict['game_type_cd']
+
+    # leaderboards are only held for the game types there are
+    if DBSession.query(GameType).get(game_type_cd) is None:
+        return HTTPNotFound()
+
+    board = rankings.leaderboard(session=DBSession,
+            game_type_cd=game_type_cd)
+
+    player_id = None
+    page = 1
+    try:
+        if 'player' in request.GET:
+            player_id = int(request.GET['player'])
+        else:
+            page = max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        pass
+
+    if player_id is not None:
+        entries = board.around(player_id=player_id)
+    else:
+        entries = board.top(count=PAGE_SIZE, start=(page - 1) * PAGE_SIZE)
+
+    return {'game_type_cd':game_type_cd,
+            'ranked':len(board),
+            'players':ranked_players(entries),
+            'player_id':player_id,
+            'page':page,
+            'last_page':(len(board) + PAGE_SIZE - 1) / PAGE_SIZE,
+            }
@@ -4,7 +4,9 @@ import time
 from pyramid.response import Response
 from sqlalchemy import desc
 from webhelpers.paginate import Page, PageURL
+from xonstat.activity import daily_activity
 from xonstat.models import *
+from xonstat.pagination import KeysetPage, estimated_count
 from xonstat.util import page_url
 
 log = logging.getLogger(__name__)
@@ -42,13 +44,17 @@ def server_info(request):
                 filter(Game.server_id == server_id).\
                 filter(Game.server_id == Server.server_id).\
                 filter(Game.map_id == Map.map_id).\
-                order_by(Game.game_id.desc())[0:10]
+                order_by(Game.game_id.desc()).\
+                limit(10).all()
+        activity = daily_activity(session=DBSession, server_id=server_id)
 
     except Exception as e:
         server = None
         recent_games = None
+        activity = None
     return {'server':server,
-            'recent_games':recent_games}
+            'recent_games':recent_games,
+            'activity':activity}
 
 
 def server_game_index(request):
@@ -56,7 +62,11 @@ def server_game_index(request):
     List the games played on a given server. Paginated.
     """
     server_id = request.matchdict['server_id']
-    current_page = request.matchdict['page']
+
+    if 'page' in request.matchdict:
+        current_page = request.matchdict['page']
+    else:
+        current_page = 1
 
     try:
         server = DBSession.query(Server).filter_by(server_id=server_id).one()
@@ -64,10 +74,15 @@ def server_game_index(request):
         games_q = DBSession.query(Game, Server, Map).\
                 filter(Game.server_id == server_id).\
                 filter(Game.server_id == Server.server_id).\
-                filter(Game.map_id == Map.map_id).\
-                order_by(Game.game_id.desc())
+                filter(Game.map_id == Map.map_id)
 
-        games = Page(games_q, current_page, url=page_url)
+        games = KeysetPage(games_q, key=Game.game_id,
+                key_of=lambda row: row[0].game_id,
+                before=request.GET.get('before'),
+                after=request.GET.get('after'), page=current_page,
+                item_count=estimated_count('server_games:' + str(server_id),
+                    lambda: DBSession.query(ServerGameSummary.games).\
+                            filter_by(server_id=server_id).scalar()))
     except Exception as e:
         server = None
         games = None
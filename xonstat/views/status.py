@@ -0,0 +1,31 @@
+import logging
+from pyramid.response import Response
+from xonstat.cache import cache_stats
+from xonstat.engine import checkout_stats, pool_status
+from xonstat.httpcache import response_cache
+from xonstat.metrics import prometheus_text
+from xonstat.models import DBSession
+
+log = logging.getLogger(__name__)
+
+
+def db_status(request):
+    """
+    Reports the state of the database connection pool and how long
+    requests waited to check out a connection, as JSON.
+    """
+    return pool_status(engine=DBSession.bind)
+
+
+def prometheus_metrics(request):
+    """
+    Reports the per route request timings along with the pool and cache
+    counters, in the Prometheus text format.
+    """
+    caches = cache_stats()
+    caches['responses'] = response_cache.stats()
+
+    response = Response(prometheus_text(checkout=checkout_stats.snapshot(),
+        caches=caches))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
@@ -3,8 +3,20 @@ import logging
 import re
 import time
 from pyramid.response import Response
+from pyramid.settings import asbool
+from sqlalchemy.orm import class_mapper
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from xonstat.activity import update_activity
+from xonstat.batch import insert_rows, reserve_ids
+from xonstat.cache import (cached_instance, map_ids, player_ids,
+        sentinel_player, server_ids)
+from xonstat.dedup import DuplicateSubmission, check_recent, claim_submission
+from xonstat.httpcache import game_tags, invalidate_on_commit
+from xonstat.leaderboard import update_leaderboards
 from xonstat.models import *
+from xonstat.parser import parse_submission, sentinel_id
+from xonstat.rating import update_ratings
+from xonstat.rollup import update_player_totals
 
 log = logging.getLogger(__name__)
 
@@ -16,15 +28,22 @@ def get_or_create_server(session=None, name=None):
     session - SQLAlchemy database session factory
     name - server name of the server to be found or created
     """
+    server_id = server_ids.get(name)
+    if server_id is not None:
+        return cached_instance(session=session, cls=Server,
+                server_id=server_id, name=name)
+
     try:
         # find one by that name, if it exists
         server = session.query(Server).filter_by(name=name).one()
+        server_ids.put(name, server.server_id)
         log.debug("Found server id {0} with name {1}.".format(
             server.server_id, server.name))
     except NoResultFound, e:
         server = Server(name=name)
         session.add(server)
         session.flush()
+        server_ids.put(name, server.server_id, staged=True)
         log.debug("Created server id {0} with name {1}".format(
             server.server_id, server.name))
     except MultipleResultsFound, e:
@@ -33,6 +52,7 @@ def get_or_create_server(session=None, name=None):
         servers = session.query(Server).filter_by(name=name).order_by(
                 Server.server_id).all()
         server = servers[0]
+        server_ids.put(name, server.server_id)
         log.debug("Created server id {0} with name {1} but found \
                 multiple".format(
             server.server_id, server.name))
@@ -46,15 +66,22 @@ def get_or_create_map(session=None, name=None):
     session - SQLAlchemy database session factory
     name - map name of the map to be found or created
     """
+    map_id = map_ids.get(name)
+    if map_id is not None:
+        return cached_instance(session=session, cls=Map, map_id=map_id,
+                name=name)
+
     try:
         # find one by the name, if it exists
         gmap = session.query(Map).filter_by(name=name).one()
+        map_ids.put(name, gmap.map_id)
         log.debug("Found map id {0} with name {1}.".format(gmap.map_id, 
             gmap.name))
     except NoResultFound, e:
         gmap = Map(name=name)
         session.add(gmap)
         session.flush()
+        map_ids.put(name, gmap.map_id, staged=True)
         log.debug("Created map id {0} with name {1}.".format(gmap.map_id,
             gmap.name))
     except MultipleResultsFound, e:
@@ -63,6 +90,7 @@ def get_or_create_map(session=None, name=None):
         gmaps = session.query(Map).filter_by(name=name).order_by(
                 Map.map_id).all()
         gmap = gmaps[0]
+        map_ids.put(name, gmap.map_id)
         log.debug("Found map id {0} with name {1} but found \
                 multiple.".format(gmap.map_id, gmap.name))
 
@@ -102,14 +130,17 @@ def get_or_create_player(session=None, hashkey=None, nick=None):
     hashkey - hashkey of the player to be found or created
     nick - nick of the player (in case of a first time create)
     """
-    # if we have a bot
-    if re.search('^bot#\d+$', hashkey):
-        player = session.query(Player).filter_by(player_id=1).one()
-    # if we have an untracked player
-    elif re.search('^player#\d+$', hashkey):
-        player = session.query(Player).filter_by(player_id=2).one()
+    # bots and untracked players share the pinned records with ids 1 and 2
+    player_id = sentinel_id(hashkey)
+    if player_id is not None:
+        player = sentinel_player(session=session, player_id=player_id)
     # else it is a tracked player
     else:
+        player_id = player_ids.get(hashkey)
+        if player_id is not None:
+            return cached_instance(session=session, cls=Player,
+                    player_id=player_id)
+
         # see if the player is already in the database
         # if not, create one and the hashkey along with it
         try:
@@ -117,80 +148,206 @@ def get_or_create_player(session=None, hashkey=None, nick=None):
                     hashkey=hashkey).one()
             player = session.query(Player).filter_by(
                     player_id=hashkey.player_id).one()
+            player_ids.put(hashkey.hashkey, player.player_id)
             log.debug("Found existing player {0} with hashkey {1}.".format(
                 player.player_id, hashkey.hashkey))
         except:
             player = Player()
 
             if nick:
-                player.nick = nick
+                player.set_nick(nick)
 
             session.add(player)
             session.flush()
             hashkey = Hashkey(player_id=player.player_id, hashkey=hashkey)
             session.add(hashkey)
+            player_ids.put(hashkey.hashkey, player.player_id, staged=True)
             log.debug("Created player {0} with hashkey {1}.".format(
                 player.player_id, hashkey.hashkey))
 
     return player
 
-def create_player_game_stat(session=None, player=None, 
-        game=None, player_events=None):
+def get_or_create_players(session=None, players=None):
     """
-    Creates game statistics for a given player in a given game. Parameters:
+    Finds or creates the Player records of every player in a submission at
+    once, returning them in a dictionary keyed by hashkey. Existing players
+    are found with a single query and new players are flushed together,
+    with their ids reserved up front so that they are inserted by a single
+    executemany instead of one statement each. A new hashkey that a
+    concurrent submission creates first resolves to that submission's
+    player. Parameters:
+
+    session - SQLAlchemy database session factory
+    players - list of PlayerRecords from the submission
+    """
+    resolved = {}
+    tracked = set()
+
+    for record in players:
+        # bots and untracked players share the pinned records with ids 1
+        # and 2, classified when the submission was parsed
+        if record.sentinel_id is not None:
+            resolved[record.hashkey] = sentinel_player(session=session,
+                    player_id=record.sentinel_id)
+        else:
+            tracked.add(record.hashkey)
+
+    for hashkey in list(tracked):
+        player_id = player_ids.get(hashkey)
+        if player_id is not None:
+            resolved[hashkey] = cached_instance(session=session, cls=Player,
+                    player_id=player_id)
+            tracked.remove(hashkey)
+
+    if len(tracked) > 0:
+        for (hashkey, player) in session.query(Hashkey.hashkey, Player).\
+                filter(Hashkey.player_id == Player.player_id).\
+                filter(Hashkey.hashkey.in_(tracked)):
+            resolved[hashkey] = player
+            player_ids.put(hashkey, player.player_id)
+
+    new = [record for record in players if record.hashkey not in resolved]
+    new_ids = reserve_ids(session=session,
+            column=class_mapper(Player).mapped_table.c.player_id,
+            count=len(new))
+
+    created = []
+    for (player_id, record) in zip(new_ids, new):
+        hashkey = record.hashkey
+        if hashkey not in resolved:
+            player = Player()
+            player.player_id = player_id
+            if record.nick:
+                player.set_nick(record.nick)
+
+            session.add(player)
+            resolved[hashkey] = player
+            created.append(hashkey)
+
+    if len(created) > 0:
+        session.flush()
+        written = insert_rows(session=session,
+                table=class_mapper(Hashkey).mapped_table,
+                rows=[{'player_id':resolved[hashkey].player_id,
+                    'hashkey':hashkey} for hashkey in created],
+                keys=['hashkey'])
+
+        # the hashkeys that weren't written belong to the players another
+        # transaction committed meanwhile; the duplicates made here go
+        if written < len(created):
+            for (hashkey, player) in session.query(Hashkey.hashkey,
+                    Player).\
+                    filter(Hashkey.player_id == Player.player_id).\
+                    filter(Hashkey.hashkey.in_(created)):
+                if player is not resolved[hashkey]:
+                    log.debug("Player {0} with hashkey {1} was created "
+                            "concurrently.".format(player.player_id,
+                                hashkey))
+                    session.delete(resolved[hashkey])
+                    resolved[hashkey] = player
+
+        for hashkey in created:
+            player_ids.put(hashkey, resolved[hashkey].player_id, staged=True)
+            log.debug("Created player {0} with hashkey {1}.".format(
+                resolved[hashkey].player_id, hashkey))
+
+    return resolved
+
+
+# scoreboard events and the PlayerGameStat columns they are stored in
+SCOREBOARD_EVENTS = {
+    'rank':'rank',
+    'scoreboard-drops':'drops',
+    'scoreboard-returns':'returns',
+    'scoreboard-fckills':'carrier_frags',
+    'scoreboard-pickups':'pickups',
+    'scoreboard-caps':'captures',
+    'scoreboard-score':'score',
+    'scoreboard-deaths':'deaths',
+    'scoreboard-kills':'kills',
+    'scoreboard-suicides':'suicides',
+}
+
+
+def player_game_stat_values(player=None, game=None, record=None):
+    """
+    Translates the parsed events of a player into PlayerGameStat column
+    values. Parameters:
 
-    session - SQLAlchemy session factory
     player - Player record of the player who owns the stats
     game - Game record for the game to which the stats pertain
-    player_events - dictionary for the actual stats that need to be transformed
+    record - PlayerRecord holding the stats that need to be transformed
     """
-
     # in here setup default values (e.g. if game type is CTF then
     # set kills=0, score=0, captures=0, pickups=0, fckills=0, etc
     # TODO: use game's create date here instead of now()
-    pgstat = PlayerGameStat(create_dt=datetime.datetime.now())
+    values = {'create_dt':datetime.datetime.now()}
 
     # set player id from player record
-    pgstat.player_id = player.player_id
+    values['player_id'] = player.player_id
 
     #set game id from game record
-    pgstat.game_id = game.game_id
+    values['game_id'] = game.game_id
 
     # all games have a score
-    pgstat.score = 0
+    values['score'] = 0
 
     if game.game_type_cd == 'dm':
-        pgstat.kills = 0
-        pgstat.deaths = 0
-        pgstat.suicides = 0
+        values['kills'] = 0
+        values['deaths'] = 0
+        values['suicides'] = 0
     elif game.game_type_cd == 'ctf':
-        pgstat.kills = 0
-        pgstat.captures = 0
-        pgstat.pickups = 0
-        pgstat.drops = 0
-        pgstat.returns = 0
-        pgstat.carrier_frags = 0
-
-    for (key,value) in player_events.items():
-        if key == 'n': pgstat.nick = value
-        if key == 't': pgstat.team = value
-        if key == 'rank': pgstat.rank = value
-        if key == 'alivetime': 
-            pgstat.alivetime = datetime.timedelta(seconds=int(round(float(value))))
-        if key == 'scoreboard-drops': pgstat.drops = value
-        if key == 'scoreboard-returns': pgstat.returns = value
-        if key == 'scoreboard-fckills': pgstat.carrier_frags = value
-        if key == 'scoreboard-pickups': pgstat.pickups = value
-        if key == 'scoreboard-caps': pgstat.captures = value
-        if key == 'scoreboard-score': pgstat.score = value
-        if key == 'scoreboard-deaths': pgstat.deaths = value
-        if key == 'scoreboard-kills': pgstat.kills = value
-        if key == 'scoreboard-suicides': pgstat.suicides = value
+        values['kills'] = 0
+        values['captures'] = 0
+        values['pickups'] = 0
+        values['drops'] = 0
+        values['returns'] = 0
+        values['carrier_frags'] = 0
+
+    if record.team is not None:
+        values['team'] = record.team
+
+    if 'alivetime' in record.events:
+        values['alivetime'] = datetime.timedelta(
+                seconds=int(round(record.events['alivetime'])))
+
+    for (event, column) in SCOREBOARD_EVENTS.items():
+        if event in record.events:
+            values[column] = record.events[event]
 
     # check to see if we had a name, and if 
     # not use the name from the player id
-    if pgstat.nick == None:
-        pgstat.nick = player.nick
+    if record.nick is not None:
+        values['nick'] = record.nick
+    else:
+        values['nick'] = player.nick
+
+    (values['stripped_nick'], values['nick_html']) = render_nick(
+            values['nick'])
+
+    return values
+
+
+def create_player_game_stat(session=None, player=None, 
+        game=None, record=None, values=None):
+    """
+    Creates game statistics for a given player in a given game. Parameters:
+
+    session - SQLAlchemy session factory
+    player - Player record of the player who owns the stats
+    game - Game record for the game to which the stats pertain
+    record - PlayerRecord holding the stats that need to be transformed
+    values - the column values, if player_game_stat_values was called
+        already
+    """
+    if values is None:
+        values = player_game_stat_values(player=player, game=game,
+                record=record)
+
+    pgstat = PlayerGameStat(create_dt=values['create_dt'])
+    for (key, value) in values.items():
+        if key != 'create_dt':
+            setattr(pgstat, key, value)
 
     session.add(pgstat)
     session.flush()
@@ -198,8 +355,40 @@ def create_player_game_stat(session=None, player=None,
     return pgstat
 
 
+def player_weapon_stat_values(player=None, game=None, record=None):
+    """
+    Translates the accuracy values of a player into one dictionary of
+    PlayerWeaponStat column values per weapon used. Parameters:
+
+    player - Player record who owns the weapon stats
+    game - Game record in which the stats were created
+    record - PlayerRecord holding the weapon values, grouped by weapon
+    """
+    weapon_values = []
+
+    if record.nick is not None:
+        nick = record.nick
+    else:
+        nick = record.hashkey
+
+    for weapon in record.weapons.values():
+        weapon_values.append({
+            'player_id':player.player_id,
+            'game_id':game.game_id,
+            'weapon_cd':weapon.weapon_cd,
+            'nick':nick,
+            'fired':weapon.fired,
+            'max':weapon.max,
+            'hit':weapon.hit,
+            'actual':weapon.actual,
+            'frags':weapon.frags,
+        })
+
+    return weapon_values
+
+
 def create_player_weapon_stats(session=None, player=None, 
-        game=None, pgstat=None, player_events=None):
+        game=None, pgstat=None, record=None, weapon_values=None):
     """
     Creates accuracy records for each weapon used by a given player in a
     given game. Parameters:
@@ -208,44 +397,24 @@ def create_player_weapon_stats(session=None, player=None,
     player - Player record who owns the weapon stats
     game - Game record in which the stats were created
     pgstat - Corresponding PlayerGameStat record for these weapon stats
-    player_events - dictionary containing the raw weapon values that need to be
-        transformed
+    record - PlayerRecord holding the weapon values, grouped by weapon
+    weapon_values - the column values, if player_weapon_stat_values was
+        called already
     """
     pwstats = []
 
-    for (key,value) in player_events.items():
-        matched = re.search("acc-(.*?)-cnt-fired", key)
-        if matched:
-            weapon_cd = matched.group(1)
-            pwstat = PlayerWeaponStat()
-            pwstat.player_id = player.player_id
-            pwstat.game_id = game.game_id
-            pwstat.player_game_stat_id = pgstat.player_game_stat_id
-            pwstat.weapon_cd = weapon_cd
-
-            if 'n' in player_events:
-                pwstat.nick = player_events['n']
-            else:
-                pwstat.nick = player_events['P']
-
-            if 'acc-' + weapon_cd + '-cnt-fired' in player_events:
-                pwstat.fired = int(round(float(
-                        player_events['acc-' + weapon_cd + '-cnt-fired'])))
-            if 'acc-' + weapon_cd + '-fired' in player_events:
-                pwstat.max = int(round(float(
-                        player_events['acc-' + weapon_cd + '-fired'])))
-            if 'acc-' + weapon_cd + '-cnt-hit' in player_events:
-                pwstat.hit = int(round(float(
-                        player_events['acc-' + weapon_cd + '-cnt-hit'])))
-            if 'acc-' + weapon_cd + '-hit' in player_events:
-                pwstat.actual = int(round(float(
-                        player_events['acc-' + weapon_cd + '-hit'])))
-            if 'acc-' + weapon_cd + '-frags' in player_events:
-                pwstat.frags = int(round(float(
-                        player_events['acc-' + weapon_cd + '-frags'])))
-
-            session.add(pwstat)
-            pwstats.append(pwstat)
+    if weapon_values is None:
+        weapon_values = player_weapon_stat_values(player=player, game=game,
+                record=record)
+
+    for values in weapon_values:
+        pwstat = PlayerWeaponStat()
+        pwstat.player_game_stat_id = pgstat.player_game_stat_id
+        for (key, value) in values.items():
+            setattr(pwstat, key, value)
+
+        session.add(pwstat)
+        pwstats.append(pwstat)
 
     return pwstats
 
@@ -254,62 +423,215 @@ def parse_body(request):
     """
     Parses the POST request body for a stats submission
     """
-    # storage vars for the request body
-    game_meta = {}
-    player_events = {}
-    current_team = None
-    players = []
-    
     log.debug(request.body)
 
-    for line in request.body.split('\n'):
-        try:
-            (key, value) = line.strip().split(' ', 1)
-    
-            if key in 'V' 'T' 'G' 'M' 'S' 'C' 'R' 'W':
-                game_meta[key] = value
-
-            if key == 'P':
-                # if we were working on a player record already, append
-                # it and work on a new one (only set team info)
-                if len(player_events) != 0:
-                    players.append(player_events)
-                    player_events = {}
-    
-                player_events[key] = value
-
-            if key == 'e':
-                (subkey, subvalue) = value.split(' ', 1)
-                player_events[subkey] = subvalue
-            if key == 'n':
-                player_events[key] = value
-            if key == 't':
-                player_events[key] = value
-        except:
-            # no key/value pair - move on to the next line
-            pass
-    
-    # add the last player we were working on
-    if len(player_events) > 0:
-        players.append(player_events)
-
-    return (game_meta, players)
+    return parse_submission(request.body)
 
 
 def create_player_stats(session=None, player=None, game=None, 
-        player_events=None):
+        record=None):
     """
-    Creates player game and weapon stats according to what type of player
+    Creates player game and weapon stats according to what type of player.
+    Returns the column values written, as a list of PlayerGameStat and a
+    list of PlayerWeaponStat dictionaries.
     """
-    if 'joins' in player_events and 'matches' in player_events\
-            and 'scoreboardvalid' in player_events:
+    pgstat_rows = []
+    pwstat_rows = []
+    if record.played():
+                values = player_game_stat_values(player=player, game=game,
+                        record=record)
                 pgstat = create_player_game_stat(session=session, 
-                        player=player, game=game, player_events=player_events)
-                if not re.search('^bot#\d+$', player_events['P']):
+                        player=player, game=game, record=record,
+                        values=values)
+                pgstat_rows.append(values)
+                if not record.bot:
+                        weapon_values = player_weapon_stat_values(
+                                player=player, game=game, record=record)
                         create_player_weapon_stats(session=session, 
                             player=player, game=game, pgstat=pgstat,
-                            player_events=player_events)
-    
+                            record=record, weapon_values=weapon_values)
+                        pwstat_rows.extend(weapon_values)
+    return (pgstat_rows, pwstat_rows)
+
+
+def create_game_stats_bulk(session=None, game=None, players=None,
+        resolved=None):
+    """
+    Creates the player game and weapon stats of every player in a game using
+    multi-row inserts, so the number of statements does not grow with the
+    number of players. Parameters:
+
+    session - SQLAlchemy session factory
+    game - Game record to which the stats pertain
+    players - list of PlayerRecords from the submission
+    resolved - dictionary of Player records keyed by hashkey, as returned by
+        get_or_create_players
+
+    Returns the rows written, as a list of PlayerGameStat and a list of
+    PlayerWeaponStat column value dictionaries.
+    """
+    pgstat_table = class_mapper(PlayerGameStat).mapped_table
+    pwstat_table = class_mapper(PlayerWeaponStat).mapped_table
+
+    counted = [record for record in players if record.played()]
+
+    # player_game_stat_id is needed up front to link the weapon stats
+    pgstat_ids = reserve_ids(session=session,
+            column=pgstat_table.c.player_game_stat_id, count=len(counted))
+
+    pgstat_rows = []
+    pwstat_rows = []
+    for (pgstat_id, record) in zip(pgstat_ids, counted):
+        player = resolved[record.hashkey]
+
+        values = player_game_stat_values(player=player, game=game,
+                record=record)
+        values['player_game_stat_id'] = pgstat_id
+        pgstat_rows.append(values)
+
+        if not record.bot:
+            for values in player_weapon_stat_values(player=player,
+                    game=game, record=record):
+                values['player_game_stat_id'] = pgstat_id
+                pwstat_rows.append(values)
+
+    # anything pending (e.g. new hashkeys) must be written before the stats
+    session.flush()
+    insert_rows(session=session, table=pgstat_table, rows=pgstat_rows)
+    insert_rows(session=session, table=pwstat_table, rows=pwstat_rows)
+    return (pgstat_rows, pwstat_rows)
+
+
+def verify_submission(game_meta=None, players=None):
+    """
+    Raises an exception if a parsed submission can't be recorded, before any
+    database work is done. Parameters:
+
+    game_meta - dictionary of game metadata from the submission
+    players - list of PlayerRecords from the submission
+    """
+    # verify required metadata is present
+    if 'T' not in game_meta or\
+        'G' not in game_meta or\
+        'M' not in game_meta or\
+        'S' not in game_meta:
+        log.debug("Required game meta fields (T, G, M, or S) missing. "\
+                "Can't continue.")
+        raise Exception("Required game meta fields (T, G, M, or S) missing.")
+
+    has_real_players = False
+    for record in players:
+        if not record.bot:
+            if record.played():
+                has_real_players = True
+
+    if not has_real_players:
+        raise Exception("No real players found. Stats ignored.")
+
+
+def record_game(session=None, game_meta=None, players=None, bulk=False):
+    """
+    Creates the game of a verified submission along with its server, map,
+    players and their stats. The caller commits. Parameters:
+
+    session - SQLAlchemy database session factory
+    game_meta - dictionary of game metadata from the submission
+    players - list of PlayerRecords from the submission
+    bulk - whether to write the stats with multi-row inserts
+    """
+    # a retried submission is turned away before anything is looked up
+    claim_submission(session=session, game_meta=game_meta)
+
+    server = get_or_create_server(session=session, name=game_meta['S'])
+    gmap = get_or_create_map(session=session, name=game_meta['M'])
+
+    if bulk:
+        resolved = get_or_create_players(session=session, players=players)
+
+    if 'W' in game_meta:
+        winner = game_meta['W']
+    else:
+        winner = None
+
+    game = create_game(session=session, 
+            start_dt=datetime.datetime(
+                *time.gmtime(float(game_meta['T']))[:6]), 
+            server_id=server.server_id, game_type_cd=game_meta['G'], 
+            map_id=gmap.map_id, winner=winner)
+
+    if bulk:
+        (pgstat_rows, pwstat_rows) = create_game_stats_bulk(session=session,
+                game=game, players=players, resolved=resolved)
+    else:
+        # find or create a record for each player
+        # and add stats for each if they were present at the end
+        # of the game
+        resolved = {}
+        pgstat_rows = []
+        pwstat_rows = []
+        for record in players:
+            if record.sentinel_id is not None:
+                player = sentinel_player(session=session,
+                        player_id=record.sentinel_id)
+            else:
+                player = get_or_create_player(session=session, 
+                        hashkey=record.hashkey, nick=record.nick)
+            resolved[record.hashkey] = player
+            log.debug('Creating stats for %s' % record.hashkey)
+            (player_pgstat_rows, player_pwstat_rows) = create_player_stats(
+                    session=session, player=player, game=game, record=record)
+            pgstat_rows.extend(player_pgstat_rows)
+            pwstat_rows.extend(player_pwstat_rows)
+
+    # the players that have stats in this game
+    participants = [(resolved[record.hashkey], record) for record in players
+            if record.played()]
+
+    update_leaderboards(session=session, game=game)
+
+    # the summaries are built from the stat rows just written
+    update_player_totals(session=session, pgstat_rows=pgstat_rows,
+            pwstat_rows=pwstat_rows)
+
+    update_activity(session=session, game=game, participants=participants)
+
+    update_ratings(session=session, game=game, pgstat_rows=pgstat_rows)
+
+    # cached pages showing the server, map or players go stale on commit
+    invalidate_on_commit(game_tags(game=game, players=resolved.values()))
+
+    return game
+
+
+def record_submission(body=None, bulk=False):
+    """
+    Parses, verifies and records a raw submission body in its own
+    transaction. Used to process submissions outside of a request, e.g.
+    from the spool. Returns the game, or None if the submission had been
+    recorded already. Parameters:
+
+    body - the raw submission body
+    bulk - whether to write the stats with multi-row inserts
+    """
+    session = DBSession()
+    try:
+        (game_meta, players) = parse_submission(body)
+        verify_submission(game_meta=game_meta, players=players)
+        game = record_game(session=session, game_meta=game_meta,
+                players=players, bulk=bulk)
+        session.commit()
+        log.debug('Recorded game {0}.'.format(game.game_id))
+        return game
+    except DuplicateSubmission as e:
+        session.rollback()
+        log.info(str(e))
+        return None
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        DBSession.remove()
+
 
 def stats_submit(request):
     """
@@ -319,58 +641,29 @@ def stats_submit(request):
         session = DBSession()
 
         (game_meta, players) = parse_body(request)  
-    
-        # verify required metadata is present
-        if 'T' not in game_meta or\
-            'G' not in game_meta or\
-            'M' not in game_meta or\
-            'S' not in game_meta:
-            log.debug("Required game meta fields (T, G, M, or S) missing. "\
-                    "Can't continue.")
-            raise Exception("Required game meta fields (T, G, M, or S) missing.")
-    
-        has_real_players = False
-        for player_events in players:
-            if not player_events['P'].startswith('bot'):
-                if 'joins' in player_events and 'matches' in player_events\
-                    and 'scoreboardvalid' in player_events:
-                    has_real_players = True
-
-        if not has_real_players:
-            raise Exception("No real players found. Stats ignored.")
-
-        server = get_or_create_server(session=session, name=game_meta['S'])
-        gmap = get_or_create_map(session=session, name=game_meta['M'])
-
-        if 'W' in game_meta:
-            winner = game_meta['W']
-        else:
-            winner = None
-
-        game = create_game(session=session, 
-                start_dt=datetime.datetime(
-                    *time.gmtime(float(game_meta['T']))[:6]), 
-                server_id=server.server_id, game_type_cd=game_meta['G'], 
-                map_id=gmap.map_id, winner=winner)
-    
-        # find or create a record for each player
-        # and add stats for each if they were present at the end
-        # of the game
-        for player_events in players:
-            if 'n' in player_events:
-                nick = player_events['n']
-            else:
-                nick = None
-
-            player = get_or_create_player(session=session, 
-                    hashkey=player_events['P'], nick=nick)
-            log.debug('Creating stats for %s' % player_events['P'])
-            create_player_stats(session=session, player=player, game=game, 
-                    player_events=player_events)
-    
+        verify_submission(game_meta=game_meta, players=players)
+        check_recent(game_meta)
+
+        # with a spool configured the database work happens in the
+        # background, so acknowledge as soon as the body is stored
+        spool = getattr(request.registry, 'spool', None)
+        if spool is not None:
+            spool.append(request.body)
+            log.debug('Success! Stats spooled.')
+            return Response('200 OK')
+
+        record_game(session=session, game_meta=game_meta, players=players,
+                bulk=asbool(request.registry.settings.get(
+                    'xonstat.bulk_submit', False)))
+
         session.commit()
         log.debug('Success! Stats recorded.')
         return Response('200 OK')
+    except DuplicateSubmission as e:
+        # acknowledge it, or the server keeps retrying
+        session.rollback()
+        log.info(str(e))
+        return Response('200 OK')
     except Exception as e:
         session.rollback()
         raise e